@@ -0,0 +1,126 @@
+""" Totales de producción de RespiraBot en memoria.
+Cada conversación guardada suma sus cantidades a los totales por provincia, por municipio y por día,
+así que /resumen contesta al momento sin leer la hoja de Google. Se alimenta con las filas ya
+serializadas por esquema.py, de modo que al arrancar se reconstruye con el mismo código a partir
+de una lectura de la hoja o del diario local.
+"""
+
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from esquema import CONFIRMADAS, PROGRAMADAS, NA
+from flujo import esSi, normalizar
+
+# Cantidades que se suman de cada pestaña: (nombre del total, columna del esquema)
+CANTIDADES = {
+    PROGRAMADAS.nombre: (("osakidetza_preparadas", "cantidad_osakidetza_preparada"),
+                         ("anterior_preparadas", "cantidad_anterior_preparada")),
+    CONFIRMADAS.nombre: (("osakidetza_entregadas", "cantidad_osakidetza"),
+                         ("anterior_entregadas", "modelo_anterior"),
+                         ("bobinas_devueltas", "cantidad_bobinas_entregadas")),
+}
+
+# Texto de cada total en /resumen, en el orden en que se muestran
+ETIQUETAS = (
+    ("recogidas_programadas", "Recogidas programadas"),
+    ("osakidetza_preparadas", "Viseras Osakidetza preparadas para recoger"),
+    ("anterior_preparadas", "Viseras modelo anterior preparadas para recoger"),
+    ("entregas_confirmadas", "Entregas confirmadas"),
+    ("recogidas_fallidas", "Recogidas fallidas"),
+    ("osakidetza_entregadas", "Viseras Osakidetza entregadas"),
+    ("anterior_entregadas", "Viseras modelo anterior entregadas"),
+    ("bobinas_devueltas", "Bobinas devueltas"),
+    ("pla_1.75", "Peticiones de PLA 1.75mm"),
+    ("pla_3", "Peticiones de PLA 3mm"),
+)
+
+
+def _numero(valor):
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _dia(fecha):
+    """ Día en ISO (2020-04-05) a partir de la fecha de fin dd/mm/YYYY HH:MM:SS """
+    try:
+        return datetime.strptime(str(fecha)[:10], "%d/%m/%Y").date().isoformat()
+    except ValueError:
+        return NA
+
+
+class Aggregates:
+    """ Totales incrementales. Cada fila suma en O(1) a cuatro vistas:
+        - total: todo
+        - porProvincia[provincia]
+        - porMunicipio[(provincia, municipio)]
+        - porDia[dia]
+        Provincias y municipios se agrupan por su texto normalizado (flujo.normalizar) y se muestran
+        con la primera forma en que se escribieron
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.total = Counter()
+            self.porProvincia = defaultdict(Counter)
+            self.porMunicipio = defaultdict(Counter)
+            self.porDia = defaultdict(Counter)
+            self.nombres = {}
+            self.filas = 0
+
+    def _clave(self, texto):
+        texto = str(texto or NA).strip()
+        clave = normalizar(texto) or normalizar(NA)
+        self.nombres.setdefault(clave, texto)
+        return clave
+
+    def add(self, schema, row):
+        """ Suma una fila serializada con schema (CONFIRMADAS o PROGRAMADAS) """
+        provincia = row[schema.position("provincia")]
+        municipio = row[schema.position("municipio")] if schema is PROGRAMADAS else NA
+        dia = _dia(row[schema.position("Fecha fin")])
+
+        valores = Counter()
+        for nombre, columna in CANTIDADES[schema.nombre]:
+            valores[nombre] = _numero(row[schema.position(columna)])
+        if schema is PROGRAMADAS:
+            valores["recogidas_programadas"] = 1
+        else:
+            if esSi(row[schema.position("entregado_osakidetza")]):
+                valores["entregas_confirmadas"] = 1
+            else:
+                valores["recogidas_fallidas"] = 1
+            if esSi(row[schema.position("recepcion_pla")]):
+                valores["pla_%s" % row[schema.position("diametro")]] = 1
+
+        with self._lock:
+            provincia, municipio = self._clave(provincia), self._clave(municipio)
+            self.total.update(valores)
+            self.porProvincia[provincia].update(valores)
+            self.porMunicipio[(provincia, municipio)].update(valores)
+            self.porDia[dia].update(valores)
+            self.filas += 1
+
+    def rebuild(self, filas):
+        """ Vuelve a calcular todo a partir de (schema, row) """
+        self.clear()
+        for schema, row in filas:
+            self.add(schema, row)
+        return self.filas
+
+    def snapshot(self, provincia=None):
+        """ Copia de los totales, de todo o de una provincia con el desglose por municipio """
+        with self._lock:
+            if provincia is None:
+                return {"total": dict(self.total),
+                        "provincias": {self.nombres[p]: dict(c) for p, c in self.porProvincia.items()},
+                        "dias": {d: dict(c) for d, c in self.porDia.items()}}
+            clave = normalizar(provincia)
+            return {"total": dict(self.porProvincia.get(clave, {})),
+                    "municipios": {self.nombres[m]: dict(c) for (p, m), c in self.porMunicipio.items() if p == clave}}
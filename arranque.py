@@ -0,0 +1,175 @@
+""" Comprobaciones de arranque de RespiraBot.
+Antes de conectarse a Telegram, main() comprueba a la vez los argumentos, las claves de respirabot.ini,
+las carpetas y los credenciales de Google y de Telegram, y si algo falla sale con la lista completa de
+errores en lugar de encontrarlos uno a uno con el primer voluntario. Las comprobaciones locales tardan
+milisegundos; las que van por la red se dejan de esperar en cuanto otra ya ha fallado.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger("respirabot.arranque")
+
+# Segundos que se siguen esperando al resto de comprobaciones cuando una ya ha fallado
+GRACIA = 0.2
+
+# Campos del JSON de una cuenta de servicio de Google que necesita oauth2client
+CAMPOS_CUENTA = ("type", "client_email", "private_key", "token_uri")
+
+_TIPOS = {str: "texto", int: "un número entero", float: "un número", bool: "true o false"}
+
+
+class StartupError(Exception):
+    """ Errores de arranque, uno por línea en el mensaje
+        - errores: lista de (comprobación, texto)
+    """
+
+    def __init__(self, errores):
+        self.errores = errores
+        super().__init__("\n".join("%s: %s" % error for error in errores))
+
+
+class StartupCheck:
+    """ Comprobaciones que se ejecutan a la vez en hilos daemon
+        - add(nombre, funcion): funcion() devuelve la lista de errores encontrados; una excepción cuenta como error
+        - run(timeout): espera a todas y lanza StartupError con todos los errores. Si una falla, solo se
+          espera GRACIA segundos más al resto, así que una configuración mal escrita no espera a la red
+        - tiempos: segundos que ha tardado cada comprobación terminada
+    """
+
+    def __init__(self, gracia=GRACIA):
+        self.gracia = gracia
+        self.comprobaciones = []
+        self.tiempos = {}
+
+    def add(self, nombre, funcion):
+        self.comprobaciones.append((nombre, funcion))
+
+    def run(self, timeout=30):
+        resultados = queue.SimpleQueue()
+
+        def ejecutar(nombre, funcion):
+            t0 = time.perf_counter()
+            try:
+                errores = list(funcion() or ())
+            except Exception as e:
+                errores = ["%s: %s" % (type(e).__name__, e)]
+            resultados.put((nombre, errores, time.perf_counter() - t0))
+
+        for nombre, funcion in self.comprobaciones:
+            threading.Thread(target=ejecutar, args=(nombre, funcion), name="arranque-" + nombre, daemon=True).start()
+
+        errores = []
+        pendientes = {nombre for nombre, _ in self.comprobaciones}
+        limite = time.monotonic() + timeout
+        while pendientes:
+            espera = limite - time.monotonic()
+            if espera <= 0:
+                break
+            try:
+                nombre, encontrados, duracion = resultados.get(timeout=espera)
+            except queue.Empty:
+                break
+            pendientes.discard(nombre)
+            self.tiempos[nombre] = duracion
+            errores.extend((nombre, error) for error in encontrados)
+            if encontrados:
+                limite = min(limite, time.monotonic() + self.gracia)
+
+        if errores:
+            errores.extend((nombre, "sin terminar, no se ha esperado") for nombre in sorted(pendientes))
+        else:
+            errores.extend((nombre, "no ha terminado en %s s" % timeout) for nombre in sorted(pendientes))
+        if errores:
+            raise StartupError(errores)
+        return self.tiempos
+
+
+def checkArguments(argumentos, validos):
+    """ Argumentos de la línea de comandos que no se conocen (ej. produccion mal escrito) """
+    return ["argumento desconocido '%s', se admiten: %s" % (argumento, ", ".join(sorted(validos)))
+            for argumento in argumentos if argumento not in validos]
+
+
+def checkOptions(config, opciones):
+    """ Claves de la configuración que faltan o no tienen el tipo esperado
+        - opciones: (sección, clave, tipo, obligatoria[, defecto]). Las no obligatorias solo se comprueban si están
+    """
+    errores = []
+    for seccion, clave, tipo, obligatoria, *_ in opciones:
+        if not config.has_option(seccion, clave) or not config.get(seccion, clave).strip():
+            if obligatoria:
+                errores.append("falta [%s] %s" % (seccion, clave))
+            continue
+        try:
+            if tipo is int:
+                config.getint(seccion, clave)
+            elif tipo is float:
+                config.getfloat(seccion, clave)
+            elif tipo is bool:
+                config.getboolean(seccion, clave)
+        except ValueError:
+            errores.append("[%s] %s = %r debería ser %s" % (seccion, clave, config.get(seccion, clave), _TIPOS[tipo]))
+    return errores
+
+
+def checkDirectory(path):
+    """ Crea la carpeta si no existe y comprueba que se puede escribir en ella """
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError as e:
+        return ["no se puede crear %s: %s" % (path, e)]
+    if not os.access(path, os.W_OK):
+        return ["no se puede escribir en %s" % path]
+    return []
+
+
+def checkFile(path, descripcion):
+    if not os.path.isfile(path):
+        return ["no existe %s (%s)" % (path, descripcion)]
+    if not os.access(path, os.R_OK):
+        return ["no se puede leer %s (%s)" % (path, descripcion)]
+    return []
+
+
+def checkServiceAccount(path):
+    """ El fichero de credenciales de Google existe y es el JSON de una cuenta de servicio """
+    errores = checkFile(path, "credenciales de Google")
+    if errores:
+        return errores
+    try:
+        with open(path, encoding="utf8") as f:
+            cuenta = json.load(f)
+    except (OSError, ValueError) as e:
+        return ["%s no es un JSON válido: %s" % (path, e)]
+    if not isinstance(cuenta, dict):
+        return ["%s no es el JSON de una cuenta de servicio" % path]
+    faltan = [campo for campo in CAMPOS_CUENTA if not cuenta.get(campo)]
+    if faltan:
+        return ["a %s le faltan los campos %s" % (path, ", ".join(faltan))]
+    if cuenta["type"] != "service_account":
+        return ["%s es de tipo '%s' y debe ser 'service_account'" % (path, cuenta["type"])]
+    return []
+
+
+def checkTelegram(token, timeout=10):
+    """ El token es de un bot de Telegram que existe. Si Telegram no contesta solo se avisa:
+        el Updater ya reintenta la conexión
+    """
+    from telegram import Bot
+    from telegram.error import InvalidToken, NetworkError, Unauthorized
+
+    try:
+        bot = Bot(token)
+        me = bot.get_me(timeout=timeout)
+    except (InvalidToken, Unauthorized) as e:
+        return ["Telegram no acepta el token: %s" % e]
+    except NetworkError as e:
+        logger.warning("No se ha podido comprobar el token con Telegram: %s", e)
+        return []
+    logger.info("  - Bot de Telegram: @%s", me.username)
+    return []
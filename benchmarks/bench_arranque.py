@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+""" Tiempo de arranque de RespiraBot.
+Cada medida es un proceso nuevo, como un reinicio durante un despliegue:
+    - import: lo que tarda `import respirabot` y qué dependencias pesadas se han cargado ya
+    - errores: lo que tarda en salir con error una configuración mal hecha (argumento mal escrito,
+      falta el token, falta client_secret.json...) desde que se arranca el proceso
+
+Todo se ejecuta en una carpeta temporal con una copia de respirabot.ini.rename y sin conexión:
+las comprobaciones que van por la red (Google y Telegram) fallan o se dejan de esperar.
+
+Uso:
+    python3 benchmarks/bench_arranque.py [repeticiones]
+"""
+
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ownPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Módulos que no hacen falta hasta que se autoriza la sesión de Google Sheets
+PESADOS = ("gspread", "oauth2client", "webhook", "persistencia")
+
+PROGRAMA = """
+import sys, time, json
+t0 = time.perf_counter()
+sys.argv = [sys.argv[1] + "/respirabot.py"] + sys.argv[2:]
+sys.path.insert(0, %r)
+import respirabot
+resultado = {"import": time.perf_counter() - t0, "cargados": [m for m in %r if m in sys.modules]}
+if "--main" in sys.argv:
+    sys.argv.remove("--main")
+    t1 = time.perf_counter()
+    try:
+        respirabot.main()
+    except SystemExit as e:
+        resultado["salida"] = e.code
+    resultado["main"] = time.perf_counter() - t1
+print(json.dumps(resultado), file=sys.__stdout__)
+""" % (ownPath, PESADOS)
+
+# Configuraciones rotas: (nombre, argumentos, cambio en la carpeta)
+ERRORES = (
+    ("argumento mal escrito", ["produccin"], None),
+    ("falta el token", ["produccion"], lambda carpeta: _quitarClave(carpeta, "token_produccion")),
+    ("timeout no numérico", [], lambda carpeta: _cambiarClave(carpeta, "timeout=300", "timeout=5min")),
+    ("sin client_secret.json", [], None),
+    ("client_secret.json incompleto", [], lambda carpeta: _escribir(carpeta, "client_secret.json",
+            json.dumps({"type": "service_account", "client_email": "bot@ejemplo.iam.gserviceaccount.com"}))),
+)
+
+
+def _escribir(carpeta, nombre, texto):
+    with open(os.path.join(carpeta, nombre), "w", encoding="utf8") as f:
+        f.write(texto)
+
+
+def _leerIni(carpeta):
+    with open(os.path.join(carpeta, "respirabot.ini"), encoding="utf8") as f:
+        return f.read()
+
+
+def _quitarClave(carpeta, clave):
+    lineas = [linea for linea in _leerIni(carpeta).splitlines() if not linea.startswith(clave)]
+    _escribir(carpeta, "respirabot.ini", "\n".join(lineas))
+
+
+def _cambiarClave(carpeta, antes, despues):
+    _escribir(carpeta, "respirabot.ini", _leerIni(carpeta).replace(antes, despues))
+
+
+def preparar(cambio=None):
+    carpeta = tempfile.mkdtemp(prefix="respirabot-arranque-")
+    shutil.copy(os.path.join(ownPath, "respirabot.ini.rename"), os.path.join(carpeta, "respirabot.ini"))
+    # Sin consola: solo interesa el tiempo
+    _cambiarClave(carpeta, "console = true", "console = false")
+    if cambio is not None:
+        cambio(carpeta)
+    return carpeta
+
+
+def ejecutar(carpeta, argumentos):
+    t0 = time.perf_counter()
+    proceso = subprocess.run([sys.executable, "-c", PROGRAMA, carpeta] + argumentos,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    total = time.perf_counter() - t0
+    resultado = json.loads(proceso.stdout.strip().splitlines()[-1])
+    resultado["total"] = total
+    return resultado
+
+
+def mediana(valores):
+    return statistics.median(valores) * 1000
+
+
+def main():
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    carpeta = preparar()
+    medidas = [ejecutar(carpeta, []) for _ in range(repeticiones)]
+    shutil.rmtree(carpeta)
+    print("import respirabot: %.0f ms (proceso completo %.0f ms), mediana de %s" % (
+            mediana([m["import"] for m in medidas]), mediana([m["total"] for m in medidas]), repeticiones))
+    print("  dependencias pesadas cargadas al importar: %s" % (", ".join(medidas[-1]["cargados"]) or "ninguna"))
+
+    print("%-32s %10s %10s %8s" % ("configuración con errores", "main ms", "total ms", "salida"))
+    for nombre, argumentos, cambio in ERRORES:
+        carpeta = preparar(cambio)
+        medidas = [ejecutar(carpeta, argumentos + ["--main"]) for _ in range(repeticiones)]
+        shutil.rmtree(carpeta)
+        print("%-32s %10.1f %10.0f %8s" % (nombre, mediana([m["main"] for m in medidas]),
+                mediana([m["total"] for m in medidas]), medidas[-1].get("salida")))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+""" Caducidad de conversaciones: ConversationHandler con un job por mensaje frente a la rueda de caducidad.
+Compara ConversationHandler de python-telegram-bot (conversation_timeout programa y cancela un job en
+la JobQueue con cada mensaje) con caducidad.ExpiringConversationHandler en una conversación mínima:
+    - coste: CPU por mensaje con muchas conversaciones a medias y jobs que quedan en la JobQueue
+    - precisión: retraso con el que salta TIMEOUT respecto a última actividad + timeout
+
+Uso:
+    python3 benchmarks/bench_caducidad.py [conversaciones] [mensajes]
+"""
+
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+
+ownPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ownPath)
+
+from telegram.ext import CommandHandler, ConversationHandler, Dispatcher, Filters, JobQueue, MessageHandler
+
+from caducidad import ExpiringConversationHandler
+from loadtest import FakeBot, crearUpdate
+
+HABLANDO = 0
+
+
+class Prueba:
+    """ Dispatcher con una conversación que solo repite el estado y apunta cuándo caduca cada una """
+
+    def __init__(self, clase, timeout):
+        self.bot = FakeBot()
+        self.jobQueue = JobQueue()
+        self.dispatcher = Dispatcher(self.bot, queue.Queue(), workers=1, job_queue=self.jobQueue, use_context=True)
+        self.jobQueue.set_dispatcher(self.dispatcher)
+        self.caducadas = {}
+        self._lock = threading.Lock()
+        self.handler = clase(
+            entry_points=[CommandHandler("start", lambda update, context: HABLANDO)],
+            states={HABLANDO: [MessageHandler(Filters.text, lambda update, context: HABLANDO)],
+                    ConversationHandler.TIMEOUT: [MessageHandler(Filters.all, self._caducada)]},
+            fallbacks=[], conversation_timeout=timeout, name="prueba")
+        self.dispatcher.add_handler(self.handler)
+        self.updateId = 0
+
+    def _caducada(self, update, context):
+        with self._lock:
+            self.caducadas[update.effective_user.id] = time.monotonic()
+
+    def mensaje(self, userId, texto):
+        self.updateId += 1
+        self.dispatcher.process_update(crearUpdate(self.bot, self.updateId, userId, texto))
+
+
+def coste(clase, conversaciones, mensajes):
+    """ CPU por mensaje con todas las conversaciones a medias (timeout largo, no caduca ninguna) """
+    prueba = Prueba(clase, 300)
+    prueba.jobQueue.start()
+    t0, cpu0 = time.perf_counter(), time.process_time()
+    for userId in range(conversaciones):
+        prueba.mensaje(userId, "/start")
+    for _ in range(mensajes - 1):
+        for userId in range(conversaciones):
+            prueba.mensaje(userId, "sigo")
+    duracion, cpu = time.perf_counter() - t0, time.process_time() - cpu0
+    jobs = len(prueba.jobQueue.jobs())
+    prueba.jobQueue.stop()
+    total = conversaciones * mensajes
+    return {"us_por_mensaje": duracion / total * 1e6, "cpu_us_por_mensaje": cpu / total * 1e6, "jobs": jobs}
+
+
+def precision(clase, conversaciones, timeout=2.0):
+    """ Retraso de TIMEOUT respecto a la última actividad + timeout, con las conversaciones repartidas
+        a lo largo de un segundo
+    """
+    prueba = Prueba(clase, timeout)
+    prueba.jobQueue.start()
+    ultima = {}
+    inicio = time.monotonic()
+    for userId in range(conversaciones):
+        objetivo = inicio + userId / conversaciones
+        espera = objetivo - time.monotonic()
+        if espera > 0:
+            time.sleep(espera)
+        prueba.mensaje(userId, "/start")
+        ultima[userId] = time.monotonic()
+    cpu0 = time.process_time()
+    time.sleep(timeout + 2.5)
+    cpu = time.process_time() - cpu0
+    prueba.jobQueue.stop()
+    retrasos = sorted((prueba.caducadas[userId] - ultima[userId] - timeout) * 1000
+                      for userId in prueba.caducadas)
+    n = len(retrasos)
+    return {"caducadas": n, "de": conversaciones, "cpu_espera_ms": cpu * 1000,
+            "p50": retrasos[n // 2] if n else None, "p99": retrasos[min(n - 1, int(n * 0.99))] if n else None,
+            "max": retrasos[-1] if n else None, "min": retrasos[0] if n else None}
+
+
+def main():
+    conversaciones = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    mensajes = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    clases = (("ConversationHandler (job por mensaje)", ConversationHandler),
+              ("ExpiringConversationHandler (rueda)", ExpiringConversationHandler))
+
+    print("Coste: %s conversaciones x %s mensajes" % (conversaciones, mensajes))
+    print("%-40s %12s %12s %8s" % ("", "us/mensaje", "CPU us", "jobs"))
+    for nombre, clase in clases:
+        r = coste(clase, conversaciones, mensajes)
+        print("%-40s %12.1f %12.1f %8s" % (nombre, r["us_por_mensaje"], r["cpu_us_por_mensaje"], r["jobs"]))
+
+    print("\nPrecisión: %s conversaciones con timeout de 2 s (retraso en ms)" % min(conversaciones, 2000))
+    print("%-40s %10s %8s %8s %8s %8s %14s" % ("", "caducadas", "min", "p50", "p99", "max", "CPU espera ms"))
+    for nombre, clase in clases:
+        r = precision(clase, min(conversaciones, 2000))
+        print("%-40s %10s %8.1f %8.1f %8.1f %8.1f %14.1f" % (nombre, "%s/%s" % (r["caducadas"], r["de"]),
+                r["min"], r["p50"], r["p99"], r["max"], r["cpu_espera_ms"]))
+
+
+if __name__ == '__main__':
+    main()
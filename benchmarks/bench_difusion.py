@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+""" Difusión a muchos voluntarios con difusion.Broadcaster sobre la cola de salida de envios.py.
+Con un Bot falso con latencia, usuarios que han bloqueado el bot y fallos de red de vez en cuando:
+    - ritmo: mensajes/s de la difusión y máximo en un segundo frente al rate configurado, y retraso de
+      las respuestas de conversación que se envían a la vez
+    - reanudar: se para el bot a mitad, se vuelve a arrancar con la misma base de datos y se cuentan
+      los voluntarios que no reciben el mensaje o lo reciben dos veces
+    - bloqueados: una segunda difusión ya no escribe a quien bloqueó el bot en la primera
+
+Uso:
+    python3 benchmarks/bench_difusion.py [voluntarios] [rate]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+ownPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ownPath)
+
+from telegram.error import TimedOut, Unauthorized
+
+from difusion import BLOQUEADO, ENVIADO, FALLIDO, PENDIENTE, TERMINADA, Broadcaster, BroadcastStore
+from envios import OutboundScheduler
+
+CONVERSACION = 10 ** 9      # chat_id de las respuestas de conversación
+
+
+class BotDifusion:
+    """ Bot falso: latencia por envío, un voluntario de cada 20 ha bloqueado el bot y uno de cada 50 da
+        un TimedOut en su primer envío
+    """
+
+    def __init__(self, latencia=0.01):
+        self.latencia = latencia
+        self.recibidos = Counter()
+        self.momentos = []
+        self.conversacion = []
+        self._fallados = set()
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        time.sleep(self.latencia)
+        ahora = time.monotonic()
+        if chat_id >= CONVERSACION:
+            with self._lock:
+                self.conversacion.append(ahora - float(text))
+            return
+        if chat_id % 20 == 0:
+            raise Unauthorized("Forbidden: bot was blocked by the user")
+        with self._lock:
+            if chat_id % 50 == 1 and chat_id not in self._fallados:
+                self._fallados.add(chat_id)
+                raise TimedOut()
+            self.recibidos[chat_id] += 1
+            self.momentos.append(ahora)
+
+
+def arrancar(path, bot, rate, ventana=50):
+    outbox = OutboundScheduler(bot, globalRate=rate * 1.5, globalBurst=int(rate), chatRate=1, chatBurst=3, senders=8)
+    outbox.start()
+    terminada = threading.Event()
+    difusor = Broadcaster(BroadcastStore(path), outbox, rate=rate, ventana=ventana,
+                          onFinish=lambda difusion: terminada.set())
+    difusor.start()
+    return outbox, difusor, terminada
+
+
+def parar(outbox, difusor):
+    difusor.stop()
+    outbox.stop()
+    difusor.store.close()
+
+
+def maximoPorSegundo(momentos):
+    momentos = sorted(momentos)
+    maximo, j = 0, 0
+    for i, t in enumerate(momentos):
+        while momentos[j] < t - 1.0:
+            j += 1
+        maximo = max(maximo, i - j + 1)
+    return maximo
+
+
+def ritmo(path, voluntarios, rate):
+    bot = BotDifusion()
+    outbox, difusor, terminada = arrancar(path, bot, rate)
+    difusionId = difusor.store.create("Nuevo horario", "todos", None, range(1, voluntarios + 1))
+    t0 = time.monotonic()
+    difusor.send(difusionId)
+    # Respuestas de conversación a 10 por segundo mientras tanto, cada una a su chat
+    n = 0
+    while not terminada.wait(0.1):
+        n += 1
+        outbox.send(CONVERSACION + n, repr(time.monotonic()))
+    duracion = time.monotonic() - t0
+    difusion = difusor.store.get(difusionId)
+    parar(outbox, difusor)
+    retrasos = sorted(bot.conversacion)
+    return {"duracion": duracion, "destinatarios": difusion["destinatarios"], "recibidos": sum(bot.recibidos.values()),
+            "ritmo": difusion["destinatarios"][ENVIADO] / duracion, "max_1s": maximoPorSegundo(bot.momentos),
+            "conversacion_p50_ms": retrasos[len(retrasos) // 2] * 1000 if retrasos else 0,
+            "conversacion_max_ms": retrasos[-1] * 1000 if retrasos else 0}
+
+
+def reanudar(path, voluntarios, rate, ventana=50):
+    bot = BotDifusion()
+    outbox, difusor, terminada = arrancar(path, bot, rate, ventana)
+    difusionId = difusor.store.create("Cambio en el protocolo de desinfección", "todos", None, range(1, voluntarios + 1))
+    difusor.send(difusionId)
+    while sum(bot.recibidos.values()) < voluntarios // 2:
+        time.sleep(0.05)
+    parar(outbox, difusor)
+    aMitad = sum(bot.recibidos.values())
+
+    outbox, difusor, terminada = arrancar(path, bot, rate, ventana)
+    terminada.wait(voluntarios / rate * 3 + 10)
+    difusion = difusor.store.get(difusionId)
+    bloqueadosAntes = len(difusor.store.bloqueados)
+    # Segunda difusión a los mismos voluntarios: los bloqueados ya no se intentan
+    segunda = difusor.store.create("Recordatorio", "todos", None, range(1, voluntarios + 1))
+    intentosSegunda = difusor.store.get(segunda)["destinatarios"]
+    parar(outbox, difusor)
+
+    esperados = {userId for userId in range(1, voluntarios + 1) if userId % 20}
+    return {"a_mitad": aMitad, "estado": difusion["estado"], "destinatarios": difusion["destinatarios"],
+            "sin_mensaje": len(esperados - set(bot.recibidos)),
+            "duplicados": sum(1 for veces in bot.recibidos.values() if veces > 1),
+            "bloqueados": bloqueadosAntes, "segunda": intentosSegunda}
+
+
+def main():
+    voluntarios = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 200.0
+
+    with tempfile.TemporaryDirectory() as directorio:
+        r = ritmo(os.path.join(directorio, "ritmo.db"), voluntarios, rate)
+        d = r["destinatarios"]
+        print("Ritmo: %s voluntarios a %s mensajes/s" % (voluntarios, rate))
+        print("  %.1f s, %.1f mensajes/s, máximo %s en un segundo" % (r["duracion"], r["ritmo"], r["max_1s"]))
+        print("  %s enviados, %s bloqueados, %s fallidos, %s pendientes" % (d[ENVIADO], d[BLOQUEADO], d[FALLIDO],
+                d[PENDIENTE]))
+        print("  respuestas de conversación durante la difusión: p50 %.0f ms, máximo %.0f ms" % (
+                r["conversacion_p50_ms"], r["conversacion_max_ms"]))
+
+        r = reanudar(os.path.join(directorio, "reanudar.db"), voluntarios, rate)
+        d = r["destinatarios"]
+        print("\nReanudar: parada con %s de %s enviados" % (r["a_mitad"], voluntarios))
+        print("  %s: %s enviados, %s bloqueados, %s fallidos, %s pendientes" % (r["estado"], d[ENVIADO], d[BLOQUEADO],
+                d[FALLIDO], d[PENDIENTE]))
+        print("  sin mensaje: %s, con el mensaje repetido: %s" % (r["sin_mensaje"], r["duplicados"]))
+        print("  segunda difusión: %s pendientes, %s marcados como bloqueados de antemano (%s bloqueados apuntados)" % (
+                r["segunda"][PENDIENTE], r["segunda"][BLOQUEADO], r["bloqueados"]))
+        assert r["estado"] == TERMINADA and r["sin_mensaje"] == 0
+
+
+if __name__ == '__main__':
+    main()
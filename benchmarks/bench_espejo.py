@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+""" Lecturas de la hoja principal: leer las pestañas enteras frente a la copia local incremental (espejo.py).
+Con una hoja falsa de N filas por pestaña que cuenta las celdas que devuelve la API:
+    - arranque: celdas leídas para reconstruir los índices con get_all_values y con la copia local ya
+      creada, después de que se hayan añadido nuevas filas
+    - consultas: filas de un municipio o de un día filtrando en Python lo leído de la hoja, frente a la
+      consulta con índice en SQLite
+    - filas borradas en la hoja: la copia lo detecta y vuelve a copiar la pestaña
+
+Uso:
+    python3 benchmarks/bench_espejo.py [filas por pestaña] [filas nuevas]
+"""
+
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+ownPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ownPath)
+
+from espejo import SheetMirror
+from esquema import CONFIRMADAS, PROGRAMADAS
+from flujo import normalizar
+
+MUNICIPIOS = ("Getxo", "Bilbao", "Barakaldo", "Leioa", "Vitoria-Gasteiz", "Donostia", "Irun", "Eibar")
+PROVINCIAS = ("Álava", "Bizkaia", "Gipuzkoa")
+
+
+class FakeSheet:
+    """ Pestañas en memoria con la forma de respuesta de la API: celdas vacías del final recortadas """
+
+    def __init__(self):
+        self.pestanas = {CONFIRMADAS.nombre: [list(CONFIRMADAS.headers)], PROGRAMADAS.nombre: [list(PROGRAMADAS.headers)]}
+        self.celdas = 0
+        self.llamadas = 0
+        self.anadidas = 0
+
+    def anadir(self, schema, n):
+        filas = self.pestanas[schema.nombre]
+        for _ in range(n):
+            self.anadidas += 1
+            i = self.anadidas
+            row = [""] * len(schema.headers)
+            row[schema.position("user_id")] = str(100000 + i)
+            row[schema.position("provincia")] = PROVINCIAS[i % 3]
+            row[schema.position("Fecha fin")] = "%02d/04/2020 12:00:00" % (1 + i % 28)
+            if schema is PROGRAMADAS:
+                row[schema.position("municipio")] = MUNICIPIOS[i % len(MUNICIPIOS)]
+                row[schema.position("direccion")] = "Kale Nagusia %s" % i
+            filas.append(row)
+
+    def _devolver(self, filas):
+        self.llamadas += 1
+        self.celdas += sum(len(row) for row in filas)
+        return [list(row) for row in filas]
+
+    def getAllValues(self, schema):
+        return self._devolver(self.pestanas[schema.nombre])
+
+    def get(self, schema, rango):
+        desde = int(re.match(r"A(\d+):", rango).group(1))
+        return self._devolver(self.pestanas[schema.nombre][desde - 1:])
+
+
+def main():
+    filas = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    nuevas = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    hoja = FakeSheet()
+    for schema in (CONFIRMADAS, PROGRAMADAS):
+        hoja.anadir(schema, filas)
+
+    with tempfile.TemporaryDirectory() as directorio:
+        mirror = SheetMirror(os.path.join(directorio, "espejo.db"))
+        t0 = time.perf_counter()
+        mirror.sync(hoja.get)
+        print("Primera copia: %s filas por pestaña en %.2f s, %s celdas" % (filas, time.perf_counter() - t0, hoja.celdas))
+
+        for schema in (CONFIRMADAS, PROGRAMADAS):
+            hoja.anadir(schema, nuevas)
+        print("\nArranque con %s filas nuevas por pestaña" % nuevas)
+        print("%-36s %10s %10s %10s" % ("", "llamadas", "celdas", "ms"))
+        hoja.celdas = hoja.llamadas = 0
+        t0 = time.perf_counter()
+        completo = {schema.nombre: hoja.getAllValues(schema)[1:] for schema in (CONFIRMADAS, PROGRAMADAS)}
+        print("%-36s %10s %10s %10.1f" % ("get_all_values (antes)", hoja.llamadas, hoja.celdas,
+                (time.perf_counter() - t0) * 1000))
+        hoja.celdas = hoja.llamadas = 0
+        t0 = time.perf_counter()
+        mirror.sync(hoja.get)
+        locales = [row for schema in (CONFIRMADAS, PROGRAMADAS) for row in mirror.rows(schema)]
+        print("%-36s %10s %10s %10.1f" % ("copia local + filas nuevas", hoja.llamadas, hoja.celdas,
+                (time.perf_counter() - t0) * 1000))
+        assert len(locales) == sum(len(v) for v in completo.values())
+
+        print("\nConsultas (ms, sin contar la lectura de la hoja)")
+        programadas = completo[PROGRAMADAS.nombre]
+        posMunicipio, posFecha = PROGRAMADAS.position("municipio"), PROGRAMADAS.position("Fecha fin")
+        consultas = (
+            ("municipio Getxo", lambda: [r for r in programadas if normalizar(r[posMunicipio]) == "getxo"],
+                    lambda: mirror.query(PROGRAMADAS, municipio="Getxo")),
+            ("día 2020-04-05", lambda: [r for r in programadas if r[posFecha].startswith("05/04/2020")],
+                    lambda: mirror.query(PROGRAMADAS, dia="2020-04-05")),
+            ("filas por provincia", lambda: len({normalizar(r[PROGRAMADAS.position("provincia")]) for r in programadas}),
+                    lambda: mirror.count(PROGRAMADAS, "provincia")),
+        )
+        print("%-36s %10s %10s" % ("", "Python", "SQLite"))
+        for nombre, python, sqlite in consultas:
+            tiempos = []
+            for funcion in (python, sqlite):
+                t0 = time.perf_counter()
+                for _ in range(5):
+                    funcion()
+                tiempos.append((time.perf_counter() - t0) / 5 * 1000)
+            print("%-36s %10.1f %10.1f" % (nombre, tiempos[0], tiempos[1]))
+
+        # Alguien borra una fila a mano en la hoja
+        del hoja.pestanas[PROGRAMADAS.nombre][random.randint(1, filas)]
+        hoja.anadir(PROGRAMADAS, 1)
+        hoja.celdas = hoja.llamadas = 0
+        mirror.sync(hoja.get)
+        iguales = mirror.rows(PROGRAMADAS) == hoja.pestanas[PROGRAMADAS.nombre][1:]
+        print("\nFila borrada en la hoja: %s copias enteras, %s llamadas, %s celdas, copia igual a la hoja: %s" % (
+                mirror.stats()["resyncs"], hoja.llamadas, hoja.celdas, iguales))
+        mirror.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+""" Micro-benchmark de la construcción de las filas de resultados.
+Compara las ramas if/else de appendToSheet anteriores con los esquemas compilados de esquema.py
+y comprueba que las dos formas dan la misma fila (salvo la fecha de fin).
+
+Uso:
+    python3 benchmarks/bench_esquema.py [iteraciones]
+"""
+
+import os
+import sys
+import timeit
+from datetime import datetime
+
+ownPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ownPath)
+
+from esquema import schemaFor
+
+CONFIRMADA = {"fecha_inicio": "04/05/2020 10:00:00", "nombre": "Ane", "apellido": "Etxeberria", "user_id": 1234,
+              "user_name": "ane", "provincia": "Bizkaia", "confirmar_programar": "Confirmar recogida",
+              "entregado_osakidetza": "Sí", "cantidad_osakidetza": "12", "modelo_anterior": "3",
+              "recepcion_pla": "Sí", "diametro": "1.75mm", "cantidad_pla_recibido": "2",
+              "bobinas_entregadas": "No"}
+PROGRAMADA = {"fecha_inicio": "04/05/2020 10:00:00", "nombre": "Jon", "apellido": None, "user_id": 5678,
+              "user_name": None, "provincia": "Gipuzkoa", "confirmar_programar": "Programar recogida",
+              "cantidad_osakidetza_preparada": "20", "cantidad_anterior_preparada": "5", "municipio": "Donostia",
+              "direccion": "Kale Nagusia 1", "horario": "Tarde", "telefono": "679123456"}
+
+
+def filaAntes(user_data):
+    managedData = list()
+
+    if "fecha_inicio" in user_data: managedData.append(user_data["fecha_inicio"])
+    else: managedData.append("NA")
+    managedData.append(datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
+
+    if "nombre" in user_data: managedData.append(user_data["nombre"])
+    else: managedData.append("NA")
+    if "apellido" in user_data: managedData.append(user_data["apellido"])
+    else: managedData.append("NA")
+    if "user_id" in user_data: managedData.append(user_data["user_id"])
+    else: managedData.append("NA")
+    if "user_name" in user_data:
+        if user_data["user_name"]:
+            formula = "=HYPERLINK(\"https://t.me/" + user_data["user_name"]+"\", \""+ user_data["user_name"]+"\")"
+            managedData.append(formula)
+        else: managedData.append("NA")
+    else: managedData.append("NA")
+    if "provincia" in user_data: managedData.append(user_data["provincia"])
+    else: managedData.append("NA")
+
+    if "Confirmar" in user_data["confirmar_programar"]:
+        for key in ("entregado_osakidetza", "cantidad_osakidetza", "modelo_anterior", "recepcion_pla", "diametro",
+                    "cantidad_pla_recibido", "bobinas_entregadas", "cantidad_bobinas_entregadas"):
+            if key in user_data: managedData.append(user_data[key])
+            else: managedData.append("NA")
+    elif "Programar" in user_data["confirmar_programar"]:
+        for key in ("cantidad_osakidetza_preparada", "cantidad_anterior_preparada", "municipio", "direccion",
+                    "horario", "telefono"):
+            if key in user_data: managedData.append(user_data[key])
+            else: managedData.append("NA")
+    return managedData
+
+
+def filaDespues(user_data):
+    return schemaFor(user_data).row(user_data)
+
+
+def main():
+    iteraciones = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    print("%-12s %14s %14s %10s" % ("fila", "antes (us)", "después (us)", "mejora"))
+    for nombre, datos in (("confirmada", CONFIRMADA), ("programada", PROGRAMADA)):
+        antes, despues = filaAntes(datos), filaDespues(datos)
+        del antes[1], despues[1]
+        assert antes == despues, (antes, despues)
+
+        tAntes = timeit.timeit(lambda: filaAntes(datos), number=iteraciones) / iteraciones * 1e6
+        tDespues = timeit.timeit(lambda: filaDespues(datos), number=iteraciones) / iteraciones * 1e6
+        print("%-12s %14.2f %14.2f %9.1fx" % (nombre, tAntes, tDespues, tAntes / tDespues))
+
+    lote = [CONFIRMADA] * 100
+    schema = schemaFor(CONFIRMADA)
+    tLote = timeit.timeit(lambda: schema.rows(lote), number=iteraciones // 100) / (iteraciones // 100) * 1e6
+    print("Lote de 100 filas con rows(): %.1f us" % tLote)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+""" Micro-benchmark del coste por mensaje de preparar textos y teclados.
+Compara la forma anterior (emoji.emojize, teclado nuevo y config.get en cada mensaje)
+con el catálogo de mensajes.MessageCatalog, preparado una sola vez al arrancar.
+
+Uso:
+    python3 benchmarks/bench_mensajes.py [iteraciones]
+"""
+
+import os
+import random
+import sys
+import timeit
+from configparser import ConfigParser
+
+ownPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ownPath)
+
+import emoji
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+from mensajes import MessageCatalog
+
+config = ConfigParser()
+if not config.read(os.path.join(ownPath, "respirabot.ini"), "utf8"):
+    config.read(os.path.join(ownPath, "respirabot.ini.rename"), "utf8")
+
+NOMBRE = "Ane"
+
+
+def bienvenidaAntes():
+    reply_keyboard = [["Álava", "Bizkaia", "Gipuzkoa"]]
+    return (emoji.emojize("Hola, " + NOMBRE +
+            " soy RespiraBot 💨 y estoy aquí para ayudarte a ser más eficiente con los envíos y el material que estamos recogiendo para combatir el 🦠" +
+            "\n Dime en qué provincia estás, por favor."),
+            ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
+
+
+def noEntendiAntes():
+    primeraParte = [config.get("mensajes", "no_entendi_1_1"),
+                    config.get("mensajes", "no_entendi_1_2"),
+                    config.get("mensajes", "no_entendi_1_3")]
+    segundaParte = [config.get("mensajes", "no_entendi_2_1"),
+                    config.get("mensajes", "no_entendi_2_2"),
+                    config.get("mensajes", "no_entendi_2_3")]
+    random.shuffle(primeraParte)
+    respuesta = primeraParte[random.randrange(2)] + NOMBRE
+    random.shuffle(segundaParte)
+    respuesta = respuesta + segundaParte[random.randrange(2)]
+    return emoji.emojize(respuesta), ReplyKeyboardMarkup([['Sí', 'No']], one_time_keyboard=True)
+
+
+def telefonoAntes():
+    return [(emoji.emojize("\n 👌 Genial, en la próxima recogida pasarán por tu dirección en el horario indicado. Gracias."), ReplyKeyboardRemove()),
+            (emoji.emojize(config.get("mensajes", "prep_recogida")), ReplyKeyboardRemove())]
+
+
+def horarioAntes():
+    contact_keyboard = KeyboardButton(text="Enviar Contacto", request_contact=True)
+    return emoji.emojize("Muy bien, por último, dime tu teléfono"), ReplyKeyboardMarkup([[contact_keyboard]])
+
+
+def main():
+    iteraciones = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    t0 = timeit.default_timer()
+    mensajes = MessageCatalog(config)
+    arranque = timeit.default_timer() - t0
+
+    casos = [
+        ("start", bienvenidaAntes,
+            lambda: (mensajes.texto("bienvenida", NOMBRE), mensajes.teclado("provincias"))),
+        ("noEntendi", noEntendiAntes,
+            lambda: (mensajes.noEntendi(NOMBRE), mensajes.teclado("si_no"))),
+        ("telefono", telefonoAntes,
+            lambda: [(mensajes.texto("recogida_programada"), mensajes.teclado("quitar")),
+                     (mensajes.texto("prep_recogida"), mensajes.teclado("quitar"))]),
+        ("horario", horarioAntes,
+            lambda: (mensajes.texto("pedir_telefono"), mensajes.teclado("contacto"))),
+    ]
+
+    print("Catálogo preparado en %.2f ms" % (arranque * 1000))
+    print("%-12s %14s %14s %10s" % ("mensaje", "antes (us)", "después (us)", "mejora"))
+    for nombre, antes, despues in casos:
+        tAntes = timeit.timeit(antes, number=iteraciones) / iteraciones * 1e6
+        tDespues = timeit.timeit(despues, number=iteraciones) / iteraciones * 1e6
+        print("%-12s %14.2f %14.2f %9.1fx" % (nombre, tAntes, tDespues, tAntes / tDespues))
+
+
+if __name__ == '__main__':
+    main()
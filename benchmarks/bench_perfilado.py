@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+""" Coste del perfilado de handlers (perfilado.py) en la conversación real.
+Recorre la conversación con voluntarios sintéticos, como loadtest.py, con el perfilador apagado y
+encendido con distintas fracciones de muestreo, y compara el tiempo por update. Mide también lo que
+cuesta a cada handler el perfilador apagado y muestra el principio del resumen del último perfilado.
+
+Uso:
+    python3 benchmarks/bench_perfilado.py [voluntarios]
+"""
+
+import gc
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ownPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ownPath)
+
+from loadtest import CONFIRMAR, PROGRAMAR, FakeBot, FakeSheetsClient, crearDispatcher, crearUpdate, importarBot
+
+RONDAS = 5
+MUESTREOS = (0, 0.01, 0.05, 1.0)
+
+
+def recorrer(dispatcher, bot, voluntarios, primero):
+    """ Cada voluntario recorre una rama entera. Devuelve (updates, segundos) """
+    updates = 0
+    t0 = time.perf_counter()
+    for userId in range(primero, primero + voluntarios):
+        for texto in (CONFIRMAR if userId % 2 else PROGRAMAR):
+            updates += 1
+            dispatcher.process_update(crearUpdate(bot, updates, userId, texto))
+    return updates, time.perf_counter() - t0
+
+
+def esperarColas(respirabot):
+    """ Deja que los hilos de envío y de las hojas terminen lo de la vuelta anterior antes de medir """
+    while respirabot.outbox.pending() or respirabot.sheetWriter.pending():
+        time.sleep(0.05)
+    gc.collect()
+
+
+def main():
+    voluntarios = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    random.seed(1)
+    directorio = tempfile.mkdtemp(prefix="respirabot-perfil-")
+    respirabot = importarBot(directorio)
+    from envios import OutboundScheduler
+    from perfilado import HandlerProfiler
+
+    respirabot.sheetSession.client = FakeSheetsClient()
+    respirabot.sheetWriter.start()
+    bot = FakeBot()
+    respirabot.outbox = OutboundScheduler(globalRate=1e9, globalBurst=1e9, chatRate=1e9, chatBurst=1e9)
+    respirabot.outbox.start(bot)
+    respirabot.perfilador = perfilador = HandlerProfiler(os.path.join(directorio, "logs"))
+    dispatcher, handler = crearDispatcher(respirabot, bot, 300)
+
+    # Calentamiento: municipios, emoji y teclados ya cargados
+    recorrer(dispatcher, bot, voluntarios, 1)
+    logging.getLogger("respirabot.perfilado").setLevel(logging.ERROR)
+    primero = 100000
+    # Se alternan las fracciones en cada vuelta y se queda la mejor de cada una, para que el ruido de la
+    # máquina y lo que crecen el diario y los totales no tapen el coste del perfilado
+    mejores = dict.fromkeys(MUESTREOS)
+    for vuelta in range(RONDAS):
+        for muestreo in MUESTREOS:
+            esperarColas(respirabot)
+            if muestreo:
+                perfilador.start(muestreo)
+            updates, segundos = recorrer(dispatcher, bot, voluntarios, primero)
+            primero += voluntarios
+            if muestreo:
+                resultados = perfilador.stop()
+            mejores[muestreo] = min(mejores[muestreo] or segundos / updates, segundos / updates)
+    print("%-22s %12s %12s" % ("perfilado", "µs/update", "coste"))
+    for muestreo, mejor in mejores.items():
+        nombre = "muestreo %s" % muestreo if muestreo else "apagado"
+        print("%-22s %12.1f %11.1f%%" % (nombre, mejor * 1e6, (mejor / mejores[0] - 1) * 100))
+
+    # Lo que añade medido() a cada handler, y de eso lo que es del perfilado: mirar si está encendido
+    import timeit
+    vacio = lambda update, context: None
+    medido = respirabot.medido("bench_perfilado", vacio)
+    llamadas = 200000
+    sinMedir = min(timeit.repeat(lambda: vacio(None, None), number=llamadas, repeat=5)) / llamadas
+    apagado = min(timeit.repeat(lambda: medido(None, None), number=llamadas, repeat=5)) / llamadas
+    comprobar = min(timeit.repeat("perfilador.activo", globals={"perfilador": perfilador}, number=llamadas,
+            repeat=5)) / llamadas
+    print("\nmedido() con el perfilado apagado: %.0f ns por handler, de ellos %.0f ns para mirar si está encendido" % (
+            (apagado - sinMedir) * 1e9, comprobar * 1e9))
+
+    respirabot.outbox.stop()
+    respirabot.journalReplayer.stop()
+    respirabot.sheetWriter.stop()
+
+    print("\nResultados del último perfilado en %s:" % resultados)
+    with open(resultados, encoding="utf8") as f:
+        print("".join(f.readlines()[:20]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+""" Memoria de los datos de conversación (context.user_data) con muchos voluntarios.
+Compara el user_data de siempre (un dict por usuario en un defaultdict que no se vacía nunca) con
+usuarios.UserDataStore y ConversationData, para N usuarios a mitad de Programar recogida:
+    - dict: un dict por usuario, como hasta ahora
+    - registro: un ConversationData por usuario, sin límite
+    - registro con límite: UserDataStore con max_usuarios (LRU)
+    - terminadas: las N conversaciones han terminado y se han liberado
+Los bytes por usuario se cuentan sobre los usuarios que siguen en memoria (residentes). También mide
+el coste de cada acceso a user_data[user_id] desde el Dispatcher y el de leer y escribir una clave.
+
+Uso:
+    python3 benchmarks/bench_usuarios.py [usuarios] [max_usuarios]
+"""
+
+import gc
+import os
+import sys
+import timeit
+import tracemalloc
+from collections import defaultdict
+
+ownPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ownPath)
+
+from usuarios import UserDataStore
+
+
+def rellenar(datos, userId):
+    """ Lo que hay en user_data al llegar al teléfono en Programar recogida. Los textos son nuevos en
+        cada usuario, como los que llegan de Telegram
+    """
+    datos["fecha_inicio"] = "04/05/2020 %02d:%02d:%02d" % (userId % 24, userId % 60, userId % 59)
+    datos["nombre"] = "Voluntario%s" % userId
+    datos["apellido"] = "Apellido%s" % userId
+    datos["user_id"] = 100000000 + userId
+    datos["user_name"] = "voluntario%s" % userId
+    datos["provincia"] = "Bizkaia"
+    datos["confirmar_programar"] = "Programar"
+    datos["cantidad_osakidetza_preparada"] = str(10 + userId % 40)
+    datos["cantidad_anterior_preparada"] = str(userId % 7)
+    datos["municipio"] = "Getxo"
+    datos["direccion"] = "Kale Nagusia %s" % (userId % 200)
+    datos["horario"] = "Tarde"
+
+
+def medir(crear, usuarios, terminar=False):
+    """ Bytes retenidos por user_data con usuarios rellenos. Con terminar, además se vacían y liberan """
+    gc.collect()
+    tracemalloc.start()
+    inicio = tracemalloc.get_traced_memory()[0]
+    userData = crear()
+    for userId in range(usuarios):
+        rellenar(userData[userId], userId)
+    if terminar:
+        for userId in range(usuarios):
+            userData[userId].clear()
+            userData.release(userId)
+        userData.sweep()
+    gc.collect()
+    actual = tracemalloc.get_traced_memory()[0] - inicio
+    tracemalloc.stop()
+    return actual, len(userData)
+
+
+def main():
+    usuarios = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    maximo = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+    casos = (
+        ("dict (antes)", lambda: defaultdict(dict), False),
+        ("registro", lambda: UserDataStore(maxSize=0), False),
+        ("registro con límite %s" % maximo, lambda: UserDataStore(maxSize=maximo), False),
+        ("registro, conversaciones terminadas", lambda: UserDataStore(maxSize=0), True),
+    )
+    print("%s usuarios a mitad de Programar recogida" % usuarios)
+    print("%-40s %12s %12s %14s" % ("", "MB", "residentes", "bytes/residente"))
+    for nombre, crear, terminar in casos:
+        memoria, residentes = medir(crear, usuarios, terminar)
+        print("%-40s %12.1f %12s %14.0f" % (nombre, memoria / 1024.0 / 1024.0, residentes,
+                memoria / residentes if residentes else 0))
+
+    print("\nAcceso desde el Dispatcher y a una clave (us)%s" % (" " * 12) +
+            "%14s %14s %14s" % ("user_data[id]", "get(clave)", "[clave] = v"))
+    n = 200000
+    for nombre, userData in (("dict", defaultdict(dict)), ("registro", UserDataStore(maxSize=0))):
+        for userId in range(1000):
+            rellenar(userData[userId], userId)
+        datos = userData[0]
+        acceso = min(timeit.repeat("userData[i % 1000]; i += 1", setup="i = 0",
+                globals={"userData": userData}, number=n, repeat=3))
+        lectura = min(timeit.repeat("datos.get('provincia')", globals={"datos": datos}, number=n, repeat=3))
+        escritura = min(timeit.repeat("datos['horario'] = 'Tarde'", globals={"datos": datos}, number=n, repeat=3))
+        print("%-56s %14.3f %14.3f %14.3f" % (nombre, acceso / n * 1e6, lectura / n * 1e6, escritura / n * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+""" Prueba de carga sin conexión de RespiraBot.
+Simula miles de voluntarios recorriendo la conversación real (el ConversationHandler de
+respirabot.buildConversationHandler) con Updates sintéticos. Telegram se sustituye por un Bot falso que
+solo apunta los mensajes enviados y Google Sheets por un cliente local con latencia y errores configurables.
+
+Mide el rendimiento (updates/s), la latencia p50/p95/p99 de cada paso de la conversación, la latencia
+de las escrituras en las hojas y la memoria máxima, y guarda el resultado en JSON para comparar ejecuciones.
+
+Con --procesos se reparten las conversaciones entre procesos trabajadores como con [procesos] trabajadores
+(reparto.py): este proceso hace de principal y escribe las hojas, y cada trabajador ejecuta
+respirabot.trabajador con el Bot falso. Con varios valores se mide cómo escala con los núcleos.
+
+Uso:
+    python3 benchmarks/loadtest.py --voluntarios 2000 --invalidas 0.1 --latencia 150 --errores 0.02 --salida carga.json
+    python3 benchmarks/loadtest.py --voluntarios 5000 --procesos 1,2,4,8
+"""
+
+import argparse
+import configparser
+import json
+import os
+import queue
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+ownPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ownPath)
+
+from telegram import Bot, Chat, Message, MessageEntity, Update, User
+from telegram.ext import Dispatcher, JobQueue
+from telegram.utils.request import Request
+
+# Respuestas de cada rama. Las respuestas no válidas hacen pasar por noEntendi o por el mensaje de error
+CONFIRMAR = ["/start", "Bizkaia", "Confirmar recogida", "Sí", "12", "3", "Sí", "2", "Sí", "1.75mm"]
+PROGRAMAR = ["/start", "Gipuzkoa", "Programar recogida", "20", "5", "Donostia", "Kale Nagusia 1", "Tarde", "679123456"]
+INVALIDAS = ["quizás", "muchas", "¿qué?", "👍"]
+
+
+def importarBot(directorio, opciones=None):
+    """ Importa respirabot usando directorio como carpeta del bot, para no tocar logs/ ni el diario reales
+        - opciones: {(sección, clave): valor} que se cambian en la copia de respirabot.ini
+    """
+    os.makedirs(os.path.join(directorio, "logs"), exist_ok=True)
+    ini = os.path.join(ownPath, "respirabot.ini")
+    if not os.path.exists(ini):
+        ini = os.path.join(ownPath, "respirabot.ini.rename")
+    if opciones:
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(ini, "utf8")
+        for (seccion, clave), valor in opciones.items():
+            config.set(seccion, clave, str(valor))
+        with open(os.path.join(directorio, "respirabot.ini"), "w", encoding="utf8") as f:
+            config.write(f)
+    else:
+        shutil.copy(ini, os.path.join(directorio, "respirabot.ini"))
+    sys.argv = [os.path.join(directorio, "respirabot.py")]
+
+    import logging
+    import respirabot
+    respirabot.prepararPrincipal()
+    # Los logs por mensaje distorsionan la medida; solo se dejan avisos y errores
+    logging.getLogger("respirabot").setLevel(logging.WARNING)
+    return respirabot
+
+
+class FakeBot(Bot):
+    """ Bot que no se conecta a Telegram: apunta los mensajes enviados """
+
+    def __init__(self):
+        # Updater pide workers + 4 conexiones aunque este Bot no las use
+        super().__init__("123456:RespiraBotLoadTest", request=Request(con_pool_size=8))
+        self.enviados = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        with self._lock:
+            self.enviados += 1
+
+    def get_me(self, *args, **kwargs):
+        return User(123456, "RespiraBot", True, username="respirabot")
+
+    @property
+    def username(self):
+        return "respirabot"
+
+
+class FakeSheetsClient:
+    """ Sustituto local de gspread.Client con latencia y errores inyectados
+        - latencia: segundos por llamada a append_rows
+        - errores: probabilidad de que una llamada falle
+    """
+
+    def __init__(self, latencia=0.0, errores=0.0):
+        self.latencia = latencia
+        self.errores = errores
+        self.auth = type("Auth", (), {"expiry": datetime.utcnow() + timedelta(days=1)})()
+        self.filas = 0
+        self.tiempos = []
+        self._lock = threading.Lock()
+
+    def login(self):
+        pass
+
+    def open(self, spreadsheet):
+        client = self
+
+        class Spreadsheet:
+            def worksheet(self, sheetName):
+                return FakeWorksheet(client)
+        return Spreadsheet()
+
+
+class FakeWorksheet:
+    def __init__(self, client):
+        self.client = client
+
+    def append_rows(self, rows, value_input_option=None):
+        t0 = time.perf_counter()
+        time.sleep(self.client.latencia)
+        if random.random() < self.client.errores:
+            raise RuntimeError("Error inyectado por la prueba de carga")
+        with self.client._lock:
+            self.client.filas += len(rows)
+            self.client.tiempos.append(time.perf_counter() - t0)
+
+    def append_row(self, row, value_input_option=None):
+        self.append_rows([row], value_input_option)
+
+
+def crearDispatcher(respirabot, bot, timeout):
+    """ Dispatcher con el ConversationHandler y el user_data reales del bot, sin persistencia """
+    jobQueue = JobQueue()
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=1, job_queue=jobQueue, use_context=True)
+    jobQueue.set_dispatcher(dispatcher)
+    respirabot.acotarUserData(dispatcher, timeout)
+    handler = respirabot.buildConversationHandler(timeout)
+    dispatcher.add_handler(handler)
+    return dispatcher, handler
+
+
+def guion(rama, invalidas):
+    """ Mensajes de un voluntario: la rama elegida con respuestas no válidas intercaladas """
+    mensajes = []
+    for i, texto in enumerate(rama):
+        if i > 1 and random.random() < invalidas:
+            mensajes.append(random.choice(INVALIDAS))
+        mensajes.append(texto)
+    return mensajes
+
+
+def crearUpdate(bot, updateId, userId, texto):
+    user = User(userId, "Voluntario%s" % userId, False, last_name="Prueba", username="voluntario%s" % userId)
+    entities = None
+    if texto.startswith("/"):
+        entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(texto.split()[0]))]
+    message = Message(updateId, datetime.now(), Chat(userId, Chat.PRIVATE), from_user=user,
+                      text=texto, entities=entities, bot=bot)
+    return Update(updateId, message=message)
+
+
+def percentiles(valores):
+    """ p50/p95/p99/max en milisegundos """
+    if not valores:
+        return {"n": 0}
+    valores = sorted(valores)
+    n = len(valores)
+
+    def p(q):
+        return round(valores[min(n - 1, int(q * n))] * 1000, 4)
+    return {"n": n, "p50": p(0.50), "p95": p(0.95), "p99": p(0.99), "max": round(valores[-1] * 1000, 4)}
+
+
+def ejecutar(args):
+    random.seed(args.semilla)
+    directorio = tempfile.mkdtemp(prefix="respirabot-carga-")
+    respirabot = importarBot(directorio)
+    from flujo import FLUJO
+
+    # Google Sheets local
+    sheets = FakeSheetsClient(args.latencia / 1000.0, args.errores)
+    respirabot.sheetSession.client = sheets
+    respirabot.sheetWriter.start()
+
+    bot = FakeBot()
+    dispatcher, handler = crearDispatcher(respirabot, bot, args.timeout)
+    dispatcher.job_queue.start()
+
+    # Cola de salida: con --limites se usan los de [envios]; si no, sin límites para medir solo el bot
+    if not args.limites:
+        from envios import OutboundScheduler
+        respirabot.outbox = OutboundScheduler(globalRate=1e9, globalBurst=1e9, chatRate=1e9, chatBurst=1e9)
+    respirabot.outbox.start(bot)
+
+    # Cada voluntario sigue su guion; los mensajes de todos se intercalan como llegarían a la vez
+    guiones = {}
+    for i in range(args.voluntarios):
+        rama = CONFIRMAR if random.random() < args.confirmar else PROGRAMAR
+        guiones[100000 + i] = guion(rama, args.invalidas)
+    pendientes = list(guiones)
+    posiciones = dict.fromkeys(guiones, 0)
+
+    nombres = {estado: paso.nombre for estado, paso in FLUJO.items()}
+    latencias = {}
+    updateId = 0
+    t0 = time.perf_counter()
+    while pendientes:
+        siguientes = []
+        random.shuffle(pendientes)
+        for userId in pendientes:
+            texto = guiones[userId][posiciones[userId]]
+            posiciones[userId] += 1
+            updateId += 1
+            update = crearUpdate(bot, updateId, userId, texto)
+
+            estado = handler.conversations.get((userId, userId))
+            paso = nombres.get(estado, "inicio")
+            t = time.perf_counter()
+            dispatcher.process_update(update)
+            latencias.setdefault(paso, []).append(time.perf_counter() - t)
+
+            if posiciones[userId] < len(guiones[userId]):
+                siguientes.append(userId)
+        pendientes = siguientes
+    duracion = time.perf_counter() - t0
+
+    # Espera a que se envíe y se escriba todo lo encolado para medir también las hojas
+    t = time.perf_counter()
+    respirabot.outbox.stop()
+    respirabot.journalReplayer.stop()
+    respirabot.sheetWriter.stop()
+    vaciado = time.perf_counter() - t
+    dispatcher.job_queue.stop()
+
+    todas = [v for valores in latencias.values() for v in valores]
+    resultado = {
+        "fecha": datetime.now().isoformat(),
+        "parametros": vars(args),
+        "updates": updateId,
+        "conversaciones": args.voluntarios,
+        "duracion_s": round(duracion, 3),
+        "updates_por_segundo": round(updateId / duracion, 1),
+        "conversaciones_por_segundo": round(args.voluntarios / duracion, 1),
+        "mensajes_enviados": bot.enviados,
+        "envios": respirabot.outbox.stats(),
+        "latencia_handler_ms": percentiles(todas),
+        "latencia_por_paso_ms": {paso: percentiles(valores) for paso, valores in sorted(latencias.items())},
+        "latencia_hojas_ms": percentiles(sheets.tiempos),
+        "filas_escritas": sheets.filas,
+        "vaciado_cola_s": round(vaciado, 3),
+        "escritura": respirabot.sheetWriter.stats(),
+        "duplicados_descartados": respirabot.submittedIndex.duplicates,
+        "memoria_max_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+    }
+    shutil.rmtree(directorio, ignore_errors=True)
+    return resultado
+
+
+def ejecutarRepartido(args, procesos):
+    """ Las mismas conversaciones repartidas entre procesos trabajadores. Se mide desde el primer update
+        hasta que todos los trabajadores han atendido lo suyo; arrancarlos no cuenta
+    """
+    random.seed(args.semilla)
+    directorio = tempfile.mkdtemp(prefix="respirabot-carga-")
+    opciones = {("logging", "level"): "WARNING", ("logging", "console"): "false"}
+    if not args.limites:
+        opciones.update({("envios", clave): 10 ** 9 for clave in ("global_rate", "global_burst", "chat_rate", "chat_burst")})
+    respirabot = importarBot(directorio, opciones)
+    from reparto import ShardPool
+
+    sheets = FakeSheetsClient(args.latencia / 1000.0, args.errores)
+    respirabot.sheetSession.client = sheets
+    respirabot.sheetWriter.start()
+
+    pool = ShardPool(procesos, respirabot.trabajador, ("", args.timeout, procesos, FakeBot),
+            onMessage=respirabot.filaDeTrabajador, queueSize=0)
+    pool.start()
+
+    bot = FakeBot()
+    guiones = {}
+    for i in range(args.voluntarios):
+        rama = CONFIRMAR if random.random() < args.confirmar else PROGRAMAR
+        guiones[100000 + i] = guion(rama, args.invalidas)
+    # Mismo orden intercalado que ejecutar(); los updates se crean antes para medir solo el reparto
+    updates = []
+    pendientes = list(guiones)
+    posiciones = dict.fromkeys(guiones, 0)
+    while pendientes:
+        siguientes = []
+        random.shuffle(pendientes)
+        for userId in pendientes:
+            updates.append(crearUpdate(bot, len(updates) + 1, userId, guiones[userId][posiciones[userId]]))
+            posiciones[userId] += 1
+            if posiciones[userId] < len(guiones[userId]):
+                siguientes.append(userId)
+        pendientes = siguientes
+
+    t0 = time.perf_counter()
+    for update in updates:
+        pool.route(update)
+    enrutado = time.perf_counter() - t0
+    trabajadores = pool.stop(timeout=600)
+    duracion = time.perf_counter() - t0
+
+    t = time.perf_counter()
+    respirabot.journalReplayer.stop()
+    respirabot.sheetWriter.stop()
+    vaciado = time.perf_counter() - t
+
+    envios = {}
+    for datos in trabajadores.values():
+        for clave, valor in datos["envios"].items():
+            envios[clave] = envios.get(clave, 0) + valor
+    resultado = {
+        "fecha": datetime.now().isoformat(),
+        "parametros": dict(vars(args), procesos=procesos),
+        "procesos": procesos,
+        "updates": len(updates),
+        "conversaciones": args.voluntarios,
+        "duracion_s": round(duracion, 3),
+        "enrutado_s": round(enrutado, 3),
+        "updates_por_segundo": round(len(updates) / duracion, 1),
+        "conversaciones_por_segundo": round(args.voluntarios / duracion, 1),
+        "mensajes_enviados": envios.get("sent", 0),
+        "envios": envios,
+        "trabajadores": {indice: {"updates": datos["updates"], "ocupado_s": datos["ocupado_s"]}
+                         for indice, datos in sorted(trabajadores.items())},
+        "latencia_por_paso_ms": {},
+        "latencia_hojas_ms": percentiles(sheets.tiempos),
+        "filas_escritas": sheets.filas,
+        "vaciado_cola_s": round(vaciado, 3),
+        "escritura": respirabot.sheetWriter.stats(),
+        "memoria_max_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+        "memoria_max_trabajador_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0, 1),
+    }
+    shutil.rmtree(directorio, ignore_errors=True)
+    return resultado
+
+
+def ejecutarEscalado(args):
+    """ Una ejecución en un proceso nuevo por cada número de procesos de --procesos: cada una necesita
+        su propio respirabot importado
+    """
+    resultados = []
+    for procesos in [int(n) for n in args.procesos.split(",")]:
+        salida = tempfile.mktemp(suffix=".json")
+        argumentos = []
+        for clave, valor in dict(vars(args), procesos=procesos, salida=salida).items():
+            if valor is True:
+                argumentos.append("--" + clave)
+            elif valor is not False:
+                argumentos += ["--" + clave, str(valor)]
+        subprocess.run([sys.executable, os.path.abspath(__file__)] + argumentos, check=True, stdout=subprocess.DEVNULL)
+        with open(salida, encoding="utf8") as f:
+            resultados.append(json.load(f))
+        os.remove(salida)
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--voluntarios", type=int, default=1000, help="conversaciones simuladas")
+    parser.add_argument("--confirmar", type=float, default=0.5, help="fracción que va por la rama Confirmar")
+    parser.add_argument("--invalidas", type=float, default=0.1, help="probabilidad de una respuesta no válida en cada paso")
+    parser.add_argument("--latencia", type=float, default=100.0, help="latencia de Google Sheets en ms")
+    parser.add_argument("--errores", type=float, default=0.0, help="probabilidad de error de Google Sheets")
+    parser.add_argument("--timeout", type=int, default=300, help="conversation_timeout en segundos")
+    parser.add_argument("--limites", action="store_true", help="envía con los límites de [envios] del .ini")
+    parser.add_argument("--procesos", default="0",
+            help="procesos trabajadores (0 = todo en este proceso). Varios separados por comas miden el escalado")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--salida", default="carga.json", help="fichero JSON con el resultado")
+    args = parser.parse_args()
+
+    if "," in args.procesos:
+        resultados = ejecutarEscalado(args)
+        with open(args.salida, "w", encoding="utf8") as f:
+            json.dump(resultados, f, indent=2, ensure_ascii=False)
+        base = resultados[0]["updates_por_segundo"]
+        print("%s núcleos disponibles" % os.cpu_count())
+        print("%10s %12s %10s %16s %12s" % ("procesos", "updates/s", "escalado", "ocupado máx s", "filas hoja"))
+        for resultado in resultados:
+            ocupado = max(datos["ocupado_s"] for datos in resultado["trabajadores"].values())
+            print("%10s %12.0f %9.2fx %16.2f %12s" % (resultado["procesos"], resultado["updates_por_segundo"],
+                    resultado["updates_por_segundo"] / base, ocupado, resultado["filas_escritas"]))
+        print("Resultado guardado en %s" % args.salida)
+        return
+
+    procesos = int(args.procesos)
+    resultado = ejecutarRepartido(args, procesos) if procesos else ejecutar(args)
+    with open(args.salida, "w", encoding="utf8") as f:
+        json.dump(resultado, f, indent=2, ensure_ascii=False)
+
+    print("%s updates de %s voluntarios en %.2f s: %.0f updates/s" % (resultado["updates"], resultado["conversaciones"],
+            resultado["duracion_s"], resultado["updates_por_segundo"]))
+    print("%-32s %8s %10s %10s %10s" % ("paso", "n", "p50 ms", "p95 ms", "p99 ms"))
+    for paso, p in resultado["latencia_por_paso_ms"].items():
+        print("%-32s %8s %10s %10s %10s" % (paso, p["n"], p["p50"], p["p95"], p["p99"]))
+    h = resultado["latencia_hojas_ms"]
+    print("Google Sheets: %s filas, %s llamadas, p50 %s ms, p99 %s ms" % (resultado["filas_escritas"], h["n"], h.get("p50"), h.get("p99")))
+    e = resultado["envios"]
+    print("Envíos: %s mensajes, %s textos juntados, %s retrasados por chat, %s esperas globales" % (e["sent"],
+            e["coalesced"], e["delayed"], e["global_throttles"]))
+    print("Memoria máxima: %s MB. Resultado guardado en %s" % (resultado["memoria_max_mb"], args.salida))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+""" Caducidad de las conversaciones de RespiraBot.
+ConversationHandler programa un job en la JobQueue con cada mensaje y cancela el anterior, así que con
+miles de voluntarios a medias la JobQueue (APScheduler) no para de crear y borrar jobs bajo su lock.
+Aquí cada mensaje solo apunta la última actividad de la conversación en una rueda de temporizadores
+(hashed timer wheel) y un único job repetido caduca en lote las que llevan conversation_timeout
+segundos sin mensajes, con los handlers de TIMEOUT y el último update, igual que ConversationHandler.
+Las conversaciones a medias que se cargan de la persistencia al arrancar entran en la rueda con la hora
+de su último cambio; si caducan sin que el voluntario vuelva a escribir no hay update con el que
+ejecutar los handlers de TIMEOUT y solo se terminan.
+"""
+
+import logging
+import math
+import threading
+import time
+
+from telegram.ext import ConversationHandler, DispatcherHandlerStop
+
+logger = logging.getLogger("respirabot.caducidad")
+
+# Segundos de cada ranura de la rueda y entre dos expire(): una conversación caduca como mucho TICK segundos tarde
+TICK = 0.5
+
+
+class TimerWheel:
+    """ Rueda de temporizadores para plazos que casi siempre se cancelan antes de cumplirse
+        - schedule(clave, plazo, valor): O(1). Sustituye el plazo anterior de la clave
+        - cancel(clave): O(1)
+        - advance(ahora): [(clave, valor)] de los plazos cumplidos hasta ahora
+        Cada ranura cubre tick segundos. Cambiar o cancelar un plazo no lo busca en su ranura: la entrada
+        vieja se descarta cuando la rueda pasa por ella (borrado perezoso). Los plazos más lejanos que
+        una vuelta se quedan en su ranura hasta la vuelta que les toca. La ranura en curso también se
+        mira, así un plazo sale en el primer advance posterior y no al terminar su ranura
+    """
+
+    def __init__(self, tick=TICK, slots=512, now=None):
+        self.tick = tick
+        self._ranuras = [[] for _ in range(slots)]
+        self._plazos = {}       # clave -> (plazo, valor, generación)
+        self._generacion = 0
+        self._actual = int((time.monotonic() if now is None else now) / tick)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._plazos)
+
+    def schedule(self, clave, plazo, valor=None):
+        with self._lock:
+            self._generacion += 1
+            self._plazos[clave] = (plazo, valor, self._generacion)
+            # Nunca en una ranura que ya ha pasado: lo vencido sale en el próximo advance
+            ranura = max(math.ceil(plazo / self.tick), self._actual + 1)
+            self._ranuras[ranura % len(self._ranuras)].append((clave, self._generacion))
+
+    def cancel(self, clave):
+        with self._lock:
+            return self._plazos.pop(clave, None) is not None
+
+    def scheduled(self, clave):
+        return clave in self._plazos
+
+    def advance(self, now):
+        vencidos = []
+        with self._lock:
+            hasta = int(now / self.tick)
+            # Más de una vuelta sin avanzar: basta con recorrer cada ranura una vez
+            desde = max(self._actual + 1, hasta - len(self._ranuras) + 1)
+            for numero in range(desde, hasta + 2):
+                indice = numero % len(self._ranuras)
+                quedan = []
+                for clave, generacion in self._ranuras[indice]:
+                    entrada = self._plazos.get(clave)
+                    if entrada is None or entrada[2] != generacion:
+                        continue
+                    if entrada[0] <= now:
+                        del self._plazos[clave]
+                        vencidos.append((clave, entrada[1]))
+                    else:
+                        quedan.append((clave, generacion))
+                self._ranuras[indice] = quedan
+            self._actual = max(self._actual, hasta)
+        return vencidos
+
+
+class ExpiringConversationHandler(ConversationHandler):
+    """ ConversationHandler con conversation_timeout llevado por una TimerWheel
+        - Cada update solo cambia la última actividad de su conversación en la rueda
+        - Un único job repetido de la JobQueue del dispatcher llama a expire() cada tick segundos;
+          se programa con start(dispatcher) o con el primer update
+        - Las conversaciones que asigna la persistencia (Dispatcher.add_handler) entran en la rueda; si la
+          persistencia tiene stored() (persistencia.py) con la hora de su último cambio
+        - expire(ahora): termina las conversaciones caducadas, ejecutando antes los handlers de TIMEOUT
+          si tienen update
+        - onRestoredTimeout(conversationKey): se llama por cada restaurada que caduca sin update, en lugar
+          de los handlers de TIMEOUT, para contarla igual que las demás
+    """
+
+    def __init__(self, *args, conversation_timeout=None, tick=TICK, clock=time.monotonic, onRestoredTimeout=None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = conversation_timeout
+        self.clock = clock
+        self.onRestoredTimeout = onRestoredTimeout
+        self.wheel = TimerWheel(tick, slots=max(8, int(math.ceil((conversation_timeout or 0) / tick)) + 2),
+                                now=clock())
+        self.caducadas = 0
+        self.restauradas = 0
+        self._job = None
+        self._jobLock = threading.Lock()
+
+    @property
+    def conversations(self):
+        return self._conversations
+
+    @conversations.setter
+    def conversations(self, value):
+        self._conversations = value
+        if self.timeout:
+            self._restaurar(value)
+
+    def _restaurar(self, conversations):
+        """ Programa la caducidad de las conversaciones a medias cargadas de la persistencia """
+        ahora = self.clock()
+        if hasattr(conversations, "stored"):
+            # Lo que queda del plazo desde el último cambio guardado, en el reloj de la rueda
+            pared = time.time()
+            plazos = [(key, ahora + self.timeout - (pared - updated)) for key, updated in conversations.stored()]
+        else:
+            plazos = [(key, ahora + self.timeout) for key, state in list(conversations.items()) if state is not None]
+        for key, plazo in plazos:
+            self.wheel.schedule(key, plazo, (None, None, None))
+        self.restauradas += len(plazos)
+        if plazos:
+            logger.info("%s conversaciones de %s restauradas de la persistencia", len(plazos), self.name)
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        if self.timeout and self._job is None:
+            self.start(dispatcher)
+        conversationKey = check_result[0]
+        try:
+            return super().handle_update(update, dispatcher, check_result, context)
+        finally:
+            if self.timeout:
+                if self.conversations.get(conversationKey) is None:
+                    self.wheel.cancel(conversationKey)
+                else:
+                    self.wheel.schedule(conversationKey, self.clock() + self.timeout, (update, dispatcher, context))
+
+    def start(self, dispatcher):
+        """ Programa el job de expire() en la JobQueue de dispatcher, si no lo estaba ya """
+        if not self.timeout:
+            return
+        with self._jobLock:
+            if self._job is not None:
+                return
+            if dispatcher.job_queue is None:
+                logger.warning("El dispatcher no tiene JobQueue: las conversaciones de %s no caducan", self.name)
+                self._job = False
+                return
+            self._job = dispatcher.job_queue.run_repeating(lambda context: self.expire(), self.wheel.tick,
+                    name="caducidad-%s" % self.name)
+
+    def expire(self, now=None):
+        """ Termina las conversaciones sin actividad en los últimos timeout segundos. Devuelve cuántas """
+        caducadas = 0
+        for conversationKey, (update, dispatcher, context) in self.wheel.advance(self.clock() if now is None else now):
+            # Puede haber llegado un mensaje mientras tanto
+            if self.wheel.scheduled(conversationKey) or conversationKey not in self.conversations:
+                continue
+            # Restaurada de la persistencia y sin mensajes desde el arranque: no hay update para TIMEOUT
+            handlers = self.states.get(self.TIMEOUT, []) if update is not None else []
+            if update is None:
+                logger.info("Conversación %s restaurada de la persistencia caducada sin mensajes", conversationKey)
+                if self.onRestoredTimeout is not None:
+                    try:
+                        self.onRestoredTimeout(conversationKey)
+                    except Exception:
+                        logger.exception("Error en onRestoredTimeout de la conversación %s", conversationKey)
+            for handler in handlers:
+                check = handler.check_update(update)
+                if check is not None and check is not False:
+                    try:
+                        handler.handle_update(update, dispatcher, check, context)
+                    except DispatcherHandlerStop:
+                        logger.warning("DispatcherHandlerStop en el estado TIMEOUT no tiene efecto")
+                    except Exception:
+                        logger.exception("Error en el handler de TIMEOUT de la conversación %s", conversationKey)
+            self._update_state(self.END, conversationKey)
+            caducadas += 1
+        self.caducadas += caducadas
+        return caducadas
@@ -0,0 +1,205 @@
+""" Configuración de RespiraBot (respirabot.ini) como una foto inmutable que se puede recargar en caliente.
+Settings convierte una sola vez cada clave de la tabla de opciones a su tipo, así el resto del bot lee
+atributos (ajustes.telegram.timeout) en lugar de buscar textos en un ConfigParser con cada mensaje.
+
+ConfigWatcher mira cada pocos segundos la fecha de modificación y el tamaño del fichero (la biblioteca
+estándar no tiene inotify). Si han cambiado lo vuelve a leer y a validar con arranque.checkOptions, y
+solo si es válido sustituye la foto entera de una vez. Una recarga con errores se descarta y se apuntan
+los errores en el log: el bot sigue con la foto anterior.
+"""
+
+import configparser
+import logging
+import os
+import threading
+from collections import namedtuple
+
+from arranque import checkOptions
+
+logger = logging.getLogger("respirabot.configuracion")
+
+_CONVERTIR = {int: "getint", float: "getfloat", bool: "getboolean"}
+
+# Tipo de cada sección, por (sección, claves), para no crear un namedtuple en cada recarga
+_SECCIONES = {}
+
+
+class ConfigError(Exception):
+    """ La configuración no es válida. errores: lista de textos """
+
+    def __init__(self, errores):
+        super().__init__("; ".join(errores))
+        self.errores = errores
+
+
+def leer(path):
+    """ ConfigParser con el contenido de path, vacío si no existe. Lanza configparser.Error si está mal escrito """
+    parser = configparser.ConfigParser()
+    parser.read(path, "utf8")
+    return parser
+
+
+def _valor(parser, seccion, clave, tipo, defecto):
+    if not parser.has_option(seccion, clave) or not parser.get(seccion, clave).strip():
+        return defecto
+    try:
+        if tipo in _CONVERTIR:
+            return getattr(parser, _CONVERTIR[tipo])(seccion, clave)
+        return parser.get(seccion, clave)
+    except ValueError:
+        return defecto
+
+
+class Settings:
+    """ Foto inmutable de la configuración
+        - settings.seccion.clave: valor ya convertido a su tipo, o el defecto si falta o no es válido
+        - get(seccion, clave, fallback): lo mismo con la forma de ConfigParser.get (ej. para MessageCatalog)
+        - diff(otra): [(sección, clave)] con valor distinto en otra
+        - opciones: tabla de (sección, clave, tipo, obligatoria, defecto). Solo se guardan esas claves
+    """
+    __slots__ = ("_secciones",)
+
+    def __init__(self, parser, opciones):
+        valores = {}
+        for seccion, clave, tipo, obligatoria, defecto in opciones:
+            valores.setdefault(seccion, {})[clave] = _valor(parser, seccion, clave, tipo, defecto)
+        secciones = {}
+        for seccion, claves in valores.items():
+            firma = (seccion, tuple(claves))
+            tipo = _SECCIONES.get(firma)
+            if tipo is None:
+                tipo = _SECCIONES[firma] = namedtuple(seccion.capitalize(), tuple(claves))
+            secciones[seccion] = tipo(**claves)
+        object.__setattr__(self, "_secciones", secciones)
+
+    def __getattr__(self, seccion):
+        try:
+            return self._secciones[seccion]
+        except KeyError:
+            raise AttributeError(seccion) from None
+
+    def __setattr__(self, nombre, valor):
+        raise AttributeError("La configuración no se puede modificar")
+
+    def get(self, seccion, clave, fallback=None):
+        valor = getattr(self._secciones.get(seccion), clave, None)
+        return fallback if valor is None else valor
+
+    def diff(self, otra):
+        cambios = []
+        for seccion, valores in self._secciones.items():
+            anteriores = otra._secciones.get(seccion)
+            for clave, valor in valores._asdict().items():
+                if anteriores is None or getattr(anteriores, clave, None) != valor:
+                    cambios.append((seccion, clave))
+        return cambios
+
+
+class ConfigWatcher:
+    """ Mantiene la foto de la configuración y la recarga cuando cambia el fichero
+        - opciones: tabla de (sección, clave, tipo, obligatoria, defecto) que se valida y se convierte
+        - validar(parser): lista de errores además de los de checkOptions (ej. admins que no son números)
+        - onChange(anterior, nueva): tras cada recarga válida con cambios, desde el hilo del watcher
+        - current: foto en uso. Se sustituye entera, así quien la lee ve la anterior o la nueva, nunca una mezcla
+        - check(): recarga si el fichero ha cambiado. start(interval) lo llama cada interval segundos
+        La primera foto se hace sin validar: los errores de arranque los comprueba main() y los da todos juntos
+    """
+
+    def __init__(self, path, opciones, validar=None, onChange=None):
+        self.path = path
+        self.opciones = tuple(opciones)
+        self.validar = validar
+        self.onChange = onChange
+        self._firma = self._leerFirma()
+        try:
+            parser = leer(path)
+        except configparser.Error:
+            parser = configparser.ConfigParser()
+        self.current = Settings(parser, self.opciones)
+        self._stopEvent = threading.Event()
+        self._thread = None
+
+        self.reloads = 0
+        self.rejected = 0
+
+    def _leerFirma(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def errors(self, parser=None):
+        """ Errores de la configuración del fichero, o de parser si se da """
+        if parser is None:
+            try:
+                parser = leer(self.path)
+            except configparser.Error as e:
+                return [str(e)]
+        return checkOptions(parser, self.opciones) + (self.validar(parser) if self.validar is not None else [])
+
+    def load(self):
+        """ Lee y valida el fichero. Devuelve la foto nueva sin ponerla en uso; lanza ConfigError """
+        try:
+            parser = leer(self.path)
+        except configparser.Error as e:
+            raise ConfigError([str(e)]) from None
+        errores = self.errors(parser)
+        if errores:
+            raise ConfigError(errores)
+        return Settings(parser, self.opciones)
+
+    def check(self):
+        """ Recarga si el fichero ha cambiado desde la última vez. Devuelve True si se ha puesto en uso una foto nueva """
+        firma = self._leerFirma()
+        if firma == self._firma:
+            return False
+        if firma is None:
+            self._firma = firma
+            logger.error("%s ya no existe, se sigue con la configuración anterior", self.path)
+            return False
+        try:
+            nueva = self.load()
+        except ConfigError as e:
+            # Si el fichero se estaba escribiendo se vuelve a mirar en la siguiente comprobación
+            if self._leerFirma() == firma:
+                self._firma = firma
+                self.rejected += 1
+                for error in e.errores:
+                    logger.error("%s no es válido, se sigue con la configuración anterior: %s", self.path, error)
+            return False
+        if self._leerFirma() != firma:
+            return False
+        self._firma = firma
+
+        anterior, self.current = self.current, nueva
+        cambios = nueva.diff(anterior)
+        self.reloads += 1
+        logger.info("Configuración recargada: %s", ", ".join("[%s] %s" % cambio for cambio in cambios) or "sin cambios")
+        if cambios and self.onChange is not None:
+            try:
+                self.onChange(anterior, nueva)
+            except Exception:
+                logger.exception("Error aplicando la configuración recargada")
+        return True
+
+    def start(self, interval=5.0):
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="Configuracion", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopEvent.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stopEvent.wait(interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Error comprobando %s", self.path)
+
+    def stats(self):
+        return {"reloads": self.reloads, "rejected": self.rejected}
@@ -0,0 +1,408 @@
+""" Difusión de mensajes de los coordinadores a los voluntarios de RespiraBot.
+Los destinatarios salen de lo que ya se ha guardado (la hoja y el diario local): cada user_id una sola
+vez, con las provincias y municipios desde los que ha enviado algo para poder filtrar. Cada difusión y
+el estado de cada destinatario se guardan en SQLite (logs/difusion.db), así que si el bot se para a
+mitad sigue por donde iba al volver a arrancar.
+
+Los mensajes salen por la cola de salida (envios.py) con PRIORIDAD_MASIVO, detrás de las respuestas de
+las conversaciones, a un ritmo propio por debajo del límite global y con un máximo de mensajes en la
+cola a la vez. Quien ha bloqueado el bot se apunta y no se le vuelve a escribir hasta que hable con él.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter as Contador
+from datetime import datetime
+
+from telegram.error import BadRequest, NetworkError, Unauthorized
+
+from envios import PRIORIDAD_MASIVO, TokenBucket
+from esquema import PROGRAMADAS
+from flujo import normalizar
+from metricas import Counter
+
+logger = logging.getLogger("respirabot.difusion")
+
+# Estado de cada destinatario
+PENDIENTE = "pendiente"
+ENVIADO = "enviado"
+BLOQUEADO = "bloqueado"
+FALLIDO = "fallido"
+
+# Estado de cada difusión
+BORRADOR = "borrador"
+EN_CURSO = "en_curso"
+PAUSADA = "pausada"
+TERMINADA = "terminada"
+
+# Envíos a un destinatario que fallan por la red antes de darlo por fallido
+INTENTOS = 3
+# Destinatarios que se leen de la base de datos de cada vez
+LOTE = 200
+
+DIFUSION = Counter("respirabot_difusion_total", "Mensajes de difusión por resultado", ["resultado"])
+
+
+def userIdDe(valor):
+    """ user_id como número, tanto si viene del bot como de la hoja (texto). None si no es un user_id """
+    try:
+        return int(str(valor).strip())
+    except ValueError:
+        return None
+
+
+class VolunteerDirectory:
+    """ Voluntarios que han enviado alguna conversación, sin repetir
+        - add(schema, row): apunta el user_id con su provincia y, en las programadas, su municipio
+        - select(provincia, municipio): user_id de quien ha enviado algo desde ahí, en orden de llegada
+        Provincias y municipios se comparan normalizados (flujo.normalizar)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._lugares = {}      # user_id -> {(provincia, municipio)}
+
+    def add(self, schema, row):
+        userId = userIdDe(row[schema.position("user_id")])
+        if userId is None:
+            return
+        provincia = normalizar(str(row[schema.position("provincia")] or ""))
+        municipio = normalizar(str(row[schema.position("municipio")] or "")) if schema is PROGRAMADAS else ""
+        with self._lock:
+            lugares = self._lugares.get(userId)
+            if lugares is None:
+                lugares = self._lugares[userId] = set()
+            lugares.add((provincia, municipio))
+
+    def rebuild(self, filas):
+        """ Vuelve a calcular todo a partir de (schema, row) """
+        self.clear()
+        for schema, row in filas:
+            self.add(schema, row)
+        return len(self)
+
+    def select(self, provincia=None, municipio=None):
+        provincia = normalizar(provincia) if provincia else None
+        municipio = normalizar(municipio) if municipio else None
+        with self._lock:
+            return [userId for userId, lugares in self._lugares.items()
+                    if any((provincia is None or p == provincia) and (municipio is None or m == municipio)
+                           for p, m in lugares)]
+
+    def __len__(self):
+        return len(self._lugares)
+
+
+class BroadcastStore:
+    """ Difusiones en SQLite (modo WAL)
+        - difusiones: texto, filtro, chat del coordinador, estado y segundos enviando
+        - destinatarios: estado de cada user_id en cada difusión; lo que sigue PENDIENTE es lo que falta
+        - bloqueados: user_id que han bloqueado el bot. Se guardan también en memoria para unblock()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS difusiones (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                texto TEXT NOT NULL,
+                filtro TEXT NOT NULL,
+                chat_id INTEGER,
+                estado TEXT NOT NULL,
+                creada TEXT NOT NULL,
+                segundos REAL NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS destinatarios (
+                difusion_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                estado TEXT NOT NULL,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (difusion_id, user_id)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS bloqueados (
+                user_id INTEGER PRIMARY KEY,
+                desde TEXT NOT NULL);
+        """)
+        self.bloqueados = {userId for userId, in self._db.execute("SELECT user_id FROM bloqueados")}
+
+    def create(self, texto, filtro, chatId, userIds):
+        """ Nueva difusión en BORRADOR. Los bloqueados entran ya como BLOQUEADO. Devuelve su id """
+        with self._lock:
+            self._db.execute("BEGIN")
+            difusionId = self._db.execute("INSERT INTO difusiones (texto, filtro, chat_id, estado, creada) "
+                    "VALUES (?, ?, ?, ?, ?)", (texto, filtro, chatId, BORRADOR, datetime.now().isoformat())).lastrowid
+            self._db.executemany("INSERT OR IGNORE INTO destinatarios (difusion_id, user_id, estado) VALUES (?, ?, ?)",
+                    [(difusionId, userId, BLOQUEADO if userId in self.bloqueados else PENDIENTE) for userId in userIds])
+            self._db.execute("COMMIT")
+        return difusionId
+
+    def get(self, difusionId):
+        """ dict con los datos de la difusión y sus destinatarios por estado, o None si no existe """
+        with self._lock:
+            fila = self._db.execute("SELECT id, texto, filtro, chat_id, estado, creada, segundos FROM difusiones "
+                    "WHERE id = ?", (difusionId,)).fetchone()
+            if fila is None:
+                return None
+            estados = Contador(dict(self._db.execute("SELECT estado, COUNT(*) FROM destinatarios "
+                    "WHERE difusion_id = ? GROUP BY estado", (difusionId,)).fetchall()))
+        difusion = dict(zip(("id", "texto", "filtro", "chat_id", "estado", "creada", "segundos"), fila))
+        difusion["destinatarios"] = estados
+        return difusion
+
+    def recent(self, limit=5):
+        with self._lock:
+            ids = [difusionId for difusionId, in self._db.execute(
+                    "SELECT id FROM difusiones ORDER BY id DESC LIMIT ?", (limit,))]
+        return [self.get(difusionId) for difusionId in ids]
+
+    def withState(self, estado):
+        """ ids de las difusiones en estado, de la más antigua a la más nueva """
+        with self._lock:
+            return [difusionId for difusionId, in self._db.execute(
+                    "SELECT id FROM difusiones WHERE estado = ? ORDER BY id", (estado,))]
+
+    def setState(self, difusionId, estado, segundos=0.0):
+        """ Cambia el estado y suma segundos al tiempo enviando """
+        with self._lock:
+            return self._db.execute("UPDATE difusiones SET estado = ?, segundos = segundos + ? WHERE id = ?",
+                    (estado, segundos, difusionId)).rowcount > 0
+
+    def pending(self, difusionId, after=None, limit=LOTE):
+        """ user_id PENDIENTE de la difusión mayores que after, ordenados """
+        with self._lock:
+            return [userId for userId, in self._db.execute(
+                    "SELECT user_id FROM destinatarios WHERE difusion_id = ? AND estado = ? AND user_id > ? "
+                    "ORDER BY user_id LIMIT ?", (difusionId, PENDIENTE, -1 if after is None else after, limit))]
+
+    def mark(self, difusionId, userId, estado):
+        with self._lock:
+            self._db.execute("UPDATE destinatarios SET estado = ?, intentos = intentos + 1 "
+                    "WHERE difusion_id = ? AND user_id = ?", (estado, difusionId, userId))
+            if estado == BLOQUEADO and userId not in self.bloqueados:
+                self.bloqueados.add(userId)
+                self._db.execute("INSERT OR IGNORE INTO bloqueados VALUES (?, ?)",
+                        (userId, datetime.now().isoformat()))
+
+    def retry(self, difusionId, userId):
+        """ Un fallo de red: sigue PENDIENTE hasta INTENTOS envíos y después queda FALLIDO. Devuelve el estado """
+        with self._lock:
+            self._db.execute("UPDATE destinatarios SET intentos = intentos + 1, "
+                    "estado = CASE WHEN intentos + 1 >= ? THEN ? ELSE estado END "
+                    "WHERE difusion_id = ? AND user_id = ?", (INTENTOS, FALLIDO, difusionId, userId))
+            return self._db.execute("SELECT estado FROM destinatarios WHERE difusion_id = ? AND user_id = ?",
+                    (difusionId, userId)).fetchone()[0]
+
+    def unblock(self, userId):
+        """ El usuario ha vuelto a hablar con el bot. Barato si no estaba bloqueado """
+        if userId not in self.bloqueados:
+            return False
+        with self._lock:
+            self.bloqueados.discard(userId)
+            self._db.execute("DELETE FROM bloqueados WHERE user_id = ?", (userId,))
+        return True
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Broadcaster:
+    """ Envía las difusiones EN_CURSO, de una en una y en orden de user_id, por la cola de salida
+        - outbox: envios.OutboundScheduler; los mensajes van con PRIORIDAD_MASIVO
+        - rate: mensajes por segundo de la difusión. Por debajo del límite global de outbox, para que
+          las conversaciones no esperen detrás de ella
+        - ventana: mensajes en la cola sin resultado todavía. Es lo más que se puede repetir si el bot se cae
+        - onFinish(difusion): al terminar una difusión, con el resultado de store.get()
+        Al arrancar sigue las difusiones que estuviesen EN_CURSO. Los fallos de red se reintentan al
+        acabar la pasada, hasta INTENTOS veces
+    """
+
+    def __init__(self, store, outbox, rate=20.0, ventana=50, onFinish=None, clock=time.monotonic):
+        self.store = store
+        self.outbox = outbox
+        self.ventana = max(1, ventana)
+        self.onFinish = onFinish
+        self.clock = clock
+        self.bucket = TokenBucket(rate, 1, clock())
+        self._enVuelo = set()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._actual = None
+        self._parar = set()
+        self._inicio = None
+        self._enviadosPasada = 0
+        self._thread = None
+
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+
+    def start(self):
+        self._stopping = False
+        for difusionId in self.store.withState(EN_CURSO):
+            logger.info("Difusión %s a medias, se sigue enviando", difusionId)
+        self._thread = threading.Thread(target=self._run, name="Difusion", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Deja de encolar mensajes. Lo que ya está en la cola de salida lo envía outbox.stop() """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def configure(self, rate, ventana):
+        """ Cambia el ritmo y la ventana en marcha """
+        with self._cond:
+            self.bucket.rate = rate
+            self.ventana = max(1, ventana)
+            self._cond.notify_all()
+
+    def send(self, difusionId):
+        """ Empieza o sigue una difusión en BORRADOR o PAUSADA. Devuelve False si no se puede """
+        difusion = self.store.get(difusionId)
+        if difusion is None or difusion["estado"] not in (BORRADOR, PAUSADA):
+            return False
+        self.store.setState(difusionId, EN_CURSO)
+        with self._cond:
+            self._parar.discard(difusionId)
+            self._cond.notify_all()
+        return True
+
+    def pause(self, difusionId):
+        """ Para una difusión EN_CURSO; send() la sigue donde se quedó """
+        difusion = self.store.get(difusionId)
+        if difusion is None or difusion["estado"] != EN_CURSO:
+            return False
+        with self._cond:
+            if self._actual == difusionId:
+                self._parar.add(difusionId)
+                self._cond.notify_all()
+                return True
+        return self.store.setState(difusionId, PAUSADA)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+            enCurso = self.store.withState(EN_CURSO)
+            if not enCurso:
+                with self._cond:
+                    if not self._stopping:
+                        self._cond.wait(1.0)
+                continue
+            try:
+                self._difundir(enCurso[0])
+            except Exception:
+                logger.exception("Error enviando la difusión %s", enCurso[0])
+                self.store.setState(enCurso[0], PAUSADA)
+
+    def _parada(self, difusionId):
+        return self._stopping or difusionId in self._parar
+
+    def _difundir(self, difusionId):
+        difusion = self.store.get(difusionId)
+        texto = difusion["texto"]
+        with self._cond:
+            self._actual = difusionId
+            self._inicio = self.clock()
+            self._enviadosPasada = 0
+        logger.info("Enviando la difusión %s: %s pendientes", difusionId, difusion["destinatarios"][PENDIENTE])
+
+        cursor = None
+        parada = False
+        while not parada:
+            userIds = self.store.pending(difusionId, cursor)
+            if not userIds:
+                # Fin de la pasada: los reintentos de red vuelven a PENDIENTE cuando llega su resultado
+                with self._cond:
+                    while self._enVuelo and not self._parada(difusionId):
+                        self._cond.wait()
+                if self._parada(difusionId) or not self.store.pending(difusionId, limit=1):
+                    break
+                cursor = None
+                continue
+            for userId in userIds:
+                with self._cond:
+                    while not self._parada(difusionId):
+                        espera = self.bucket.wait(self.clock())
+                        if len(self._enVuelo) < self.ventana and espera == 0:
+                            break
+                        self._cond.wait(espera or None)
+                    if self._parada(difusionId):
+                        parada = True
+                        break
+                    self.bucket.take()
+                    self._enVuelo.add(userId)
+                self.outbox.send(userId, texto, prioridad=PRIORIDAD_MASIVO,
+                        onResult=lambda ok, error, userId=userId: self._resultado(difusionId, userId, ok, error))
+                cursor = userId
+
+        with self._cond:
+            segundos = self.clock() - self._inicio
+            self._actual = None
+            pausada = difusionId in self._parar
+            self._parar.discard(difusionId)
+        if self._stopping and not pausada:
+            # Sigue EN_CURSO para continuar al arrancar
+            self.store.setState(difusionId, EN_CURSO, segundos)
+            return
+        self.store.setState(difusionId, PAUSADA if pausada else TERMINADA, segundos)
+        difusion = self.store.get(difusionId)
+        logger.info("Difusión %s %s: %s", difusionId, "pausada" if pausada else "terminada",
+                dict(difusion["destinatarios"]), extra={"duracion_ms": round(difusion["segundos"] * 1000)})
+        if not pausada and self.onFinish is not None:
+            try:
+                self.onFinish(difusion)
+            except Exception:
+                logger.exception("Error avisando del fin de la difusión %s", difusionId)
+
+    def _resultado(self, difusionId, userId, ok, error):
+        """ onResult de outbox para cada mensaje """
+        if ok:
+            estado = ENVIADO
+            self.store.mark(difusionId, userId, estado)
+            self.sent += 1
+        elif isinstance(error, Unauthorized) or (isinstance(error, BadRequest) and "chat not found" in str(error).lower()):
+            # Ha bloqueado el bot, ha borrado su cuenta o nunca ha hablado con él
+            estado = BLOQUEADO
+            self.store.mark(difusionId, userId, estado)
+            self.blocked += 1
+        elif isinstance(error, NetworkError) and not isinstance(error, BadRequest):
+            estado = self.store.retry(difusionId, userId)
+            if estado == FALLIDO:
+                self.failed += 1
+        else:
+            estado = FALLIDO
+            self.store.mark(difusionId, userId, estado)
+            self.failed += 1
+        DIFUSION.labels(estado).inc()
+        with self._cond:
+            self._enVuelo.discard(userId)
+            if ok:
+                self._enviadosPasada += 1
+            self._cond.notify_all()
+
+    def throughput(self):
+        """ Mensajes por segundo entregados en la difusión en curso, o None """
+        with self._cond:
+            if self._actual is None:
+                return None
+            segundos = self.clock() - self._inicio
+            return self._enviadosPasada / segundos if segundos > 0 else 0.0
+
+    def stats(self):
+        with self._cond:
+            return {"actual": self._actual, "en_vuelo": len(self._enVuelo), "sent": self.sent,
+                    "blocked": self.blocked, "failed": self.failed, "throughput": self.throughput()}
@@ -0,0 +1,330 @@
+""" Envío de mensajes de RespiraBot respetando los límites de Telegram.
+Los handlers no llaman a Telegram: dejan el mensaje en OutboundScheduler y siguen. Unos pocos hilos lo
+envían cuando lo permiten dos cubos de tokens, uno global (unos 30 mensajes por segundo para todo el
+bot) y otro por chat (alrededor de un mensaje por segundo), así no se llega a los errores de flood de
+Telegram ni a las esperas de sus reintentos.
+- Los textos seguidos a un mismo chat que aún no han salido se juntan en un solo mensaje
+- Las respuestas de la conversación salen antes que los envíos masivos (PRIORIDAD_MASIVO)
+- Si Telegram responde RetryAfter se deja de enviar el tiempo que indique y el mensaje se reintenta
+
+El reloj y la espera se pueden sustituir, así que se puede probar con un Bot falso llamando a step():
+    scheduler = OutboundScheduler(botFalso, clock=lambda: reloj[0])
+    scheduler.send(1, "hola"); scheduler.step()
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram.error import RetryAfter
+
+from metricas import Counter
+
+logger = logging.getLogger("respirabot.envios")
+
+PRIORIDAD_CONVERSACION = 0
+PRIORIDAD_MASIVO = 1
+PRIORIDADES = (PRIORIDAD_CONVERSACION, PRIORIDAD_MASIVO)
+
+# Longitud máxima de un mensaje de Telegram; por encima no se juntan textos
+MAX_TEXTO = 4096
+SEPARADOR = "\n\n"
+
+ENVIOS = Counter("respirabot_envios_total", "Mensajes enviados a Telegram por resultado", ["resultado"])
+AGRUPADOS = Counter("respirabot_envios_agrupados_total", "Textos juntados con el anterior del mismo chat")
+LIMITADOS = Counter("respirabot_envios_limitados_total", "Mensajes retrasados por los límites de envío", ["motivo"])
+
+
+class TokenBucket:
+    """ Cubo de tokens: rate tokens por segundo hasta un máximo de burst """
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.blockedUntil = 0.0
+
+    def wait(self, now):
+        """ Segundos hasta que haya un token disponible """
+        if now < self.blockedUntil:
+            return self.blockedUntil - now
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, until):
+        """ No da tokens hasta until """
+        self.blockedUntil = max(self.blockedUntil, until)
+
+    def full(self, now):
+        return self.wait(now) == 0.0 and self.tokens >= self.burst
+
+
+class _Mensaje:
+    __slots__ = ("chatId", "texto", "replyMarkup", "kwargs", "prioridad", "callbacks", "limitado")
+
+    def __init__(self, chatId, texto, replyMarkup, kwargs, prioridad, onResult):
+        self.chatId = chatId
+        self.texto = texto
+        self.replyMarkup = replyMarkup
+        self.kwargs = kwargs
+        self.prioridad = prioridad
+        self.callbacks = [onResult] if onResult is not None else []
+        self.limitado = False
+
+    def merge(self, otro):
+        """ Junta otro al final si caben en un mensaje. El teclado que queda es el del último que lo lleve,
+            que es el que Telegram dejaría a la vista si se enviasen por separado
+        """
+        if self.kwargs != otro.kwargs or len(self.texto) + len(SEPARADOR) + len(otro.texto) > MAX_TEXTO:
+            return False
+        self.texto = self.texto + SEPARADOR + otro.texto
+        if otro.replyMarkup is not None:
+            self.replyMarkup = otro.replyMarkup
+        self.callbacks.extend(otro.callbacks)
+        return True
+
+
+class _Chat:
+    __slots__ = ("bucket", "colas", "enCola", "enviando")
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.colas = {prioridad: deque() for prioridad in PRIORIDADES}
+        self.enCola = dict.fromkeys(PRIORIDADES, False)
+        self.enviando = False
+
+    def vacio(self):
+        return not self.enviando and not any(self.colas.values())
+
+
+class OutboundScheduler:
+    """ Cola de salida hacia Telegram con límites global y por chat
+        - bot: telegram.Bot con el que se envía (se puede dar en start())
+        - globalRate / globalBurst: mensajes por segundo y ráfaga máxima para todo el bot
+        - chatRate / chatBurst: mensajes por segundo y ráfaga máxima para cada chat
+        - senders: hilos que envían a la vez (nunca dos a un mismo chat, para no desordenarlos)
+        - clock: reloj en segundos, time.monotonic por defecto
+    """
+
+    def __init__(self, bot=None, globalRate=30.0, globalBurst=30, chatRate=1.0, chatBurst=3, senders=4,
+                 clock=time.monotonic):
+        self.bot = bot
+        self.chatRate = chatRate
+        self.chatBurst = chatBurst
+        self.numSenders = max(1, senders)
+        self.clock = clock
+        self.globalBucket = TokenBucket(globalRate, globalBurst, clock())
+        self._chats = {}
+        self._listos = {prioridad: deque() for prioridad in PRIORIDADES}
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._pruneAt = 1024
+        self._limiteGlobal = False
+
+        self.sent = 0
+        self.coalesced = 0
+        self.delayed = 0
+        self.globalThrottles = 0
+        self.retryAfters = 0
+        self.errors = 0
+
+    def setLimits(self, globalRate, globalBurst, chatRate, chatBurst):
+        """ Cambia los límites en marcha. El de cada chat se aplica a los chats que no tienen mensajes recientes """
+        with self._cond:
+            self.globalBucket.rate = globalRate
+            self.globalBucket.burst = globalBurst
+            self.chatRate = chatRate
+            self.chatBurst = chatBurst
+            self._cond.notify_all()
+
+    def send(self, chatId, texto, replyMarkup=None, prioridad=PRIORIDAD_CONVERSACION, onResult=None, **kwargs):
+        """ Encola un mensaje para chatId
+            - onResult(ok, error): se llama después de enviarlo (o de fallar). Los mensajes juntados
+              llaman a los onResult de todos sus textos
+            - kwargs: resto de argumentos de bot.send_message (parse_mode...)
+        """
+        mensaje = _Mensaje(chatId, texto, replyMarkup, kwargs, prioridad, onResult)
+        with self._cond:
+            chat = self._chats.get(chatId)
+            if chat is None:
+                chat = self._chats[chatId] = _Chat(TokenBucket(self.chatRate, self.chatBurst, self.clock()))
+            cola = chat.colas[prioridad]
+            if cola and cola[-1].merge(mensaje):
+                self.coalesced += 1
+                AGRUPADOS.inc()
+                return
+            cola.append(mensaje)
+            if not chat.enCola[prioridad]:
+                chat.enCola[prioridad] = True
+                self._listos[prioridad].append(chatId)
+            self._cond.notify()
+
+    def _next(self, now):
+        """ Siguiente mensaje que se puede enviar ya, o (None, segundos hasta que se pueda enviar alguno)
+            Devuelve (None, None) si no hay nada pendiente. Se llama con el lock cogido
+        """
+        if not any(self._listos.values()):
+            return None, None
+        esperaGlobal = self.globalBucket.wait(now)
+        if esperaGlobal > 0:
+            # Con el límite global agotado no hace falta mirar los chats uno a uno
+            if not self._limiteGlobal:
+                self._limiteGlobal = True
+                self.globalThrottles += 1
+                LIMITADOS.labels("global").inc()
+            return None, esperaGlobal
+
+        espera = None
+        for prioridad in PRIORIDADES:
+            listos = self._listos[prioridad]
+            for _ in range(len(listos)):
+                chatId = listos.popleft()
+                chat = self._chats[chatId]
+                if chat.enviando:
+                    listos.append(chatId)
+                    continue
+                esperaChat = chat.bucket.wait(now)
+                if esperaChat > 0:
+                    listos.append(chatId)
+                    mensaje = chat.colas[prioridad][0]
+                    if not mensaje.limitado:
+                        mensaje.limitado = True
+                        self.delayed += 1
+                        LIMITADOS.labels("chat").inc()
+                    espera = esperaChat if espera is None else min(espera, esperaChat)
+                    continue
+
+                mensaje = chat.colas[prioridad].popleft()
+                if chat.colas[prioridad]:
+                    listos.append(chatId)
+                else:
+                    chat.enCola[prioridad] = False
+                chat.bucket.take()
+                self.globalBucket.take()
+                self._limiteGlobal = False
+                chat.enviando = True
+                return mensaje, 0.0
+        return None, espera
+
+    def _deliver(self, mensaje):
+        """ Envía un mensaje fuera del lock y devuelve el chat a la cola """
+        error = None
+        try:
+            self.bot.send_message(mensaje.chatId, mensaje.texto, reply_markup=mensaje.replyMarkup, **mensaje.kwargs)
+        except Exception as e:
+            error = e
+
+        with self._cond:
+            chat = self._chats[mensaje.chatId]
+            chat.enviando = False
+            if isinstance(error, RetryAfter):
+                # Telegram pide parar: se vuelve a intentar el mismo mensaje el primero de su chat
+                self.retryAfters += 1
+                self.globalBucket.block(self.clock() + error.retry_after)
+                chat.colas[mensaje.prioridad].appendleft(mensaje)
+                if not chat.enCola[mensaje.prioridad]:
+                    chat.enCola[mensaje.prioridad] = True
+                    self._listos[mensaje.prioridad].appendleft(mensaje.chatId)
+            elif error is not None:
+                self.errors += 1
+            else:
+                self.sent += 1
+            if len(self._chats) > self._pruneAt:
+                self._prune()
+            self._cond.notify_all()
+
+        if isinstance(error, RetryAfter):
+            LIMITADOS.labels("retry_after").inc()
+            logger.warning("Telegram pide esperar %s segundos antes de seguir enviando", error.retry_after)
+            return
+        ENVIOS.labels("error" if error else "enviado").inc()
+        if error is not None:
+            logger.warning("No se ha podido enviar un mensaje a %s: %r", mensaje.chatId, error)
+        for callback in mensaje.callbacks:
+            try:
+                callback(error is None, error)
+            except Exception:
+                logger.exception("Error en onResult de un envío a %s", mensaje.chatId)
+
+    def _prune(self):
+        """ Olvida los chats sin mensajes pendientes y con el cubo lleno """
+        now = self.clock()
+        for chatId in [chatId for chatId, chat in self._chats.items() if chat.vacio() and chat.bucket.full(now)]:
+            del self._chats[chatId]
+        self._pruneAt = max(1024, 2 * len(self._chats))
+
+    def step(self):
+        """ Envía en este hilo todo lo que se puede enviar ahora. Devuelve los segundos hasta que se pueda
+            enviar el siguiente, o None si no queda nada. Para pruebas con un reloj simulado
+        """
+        while True:
+            with self._cond:
+                mensaje, espera = self._next(self.clock())
+            if mensaje is None:
+                return espera
+            self._deliver(mensaje)
+
+    def start(self, bot=None):
+        if bot is not None:
+            self.bot = bot
+        self._stopping = False
+        for i in range(self.numSenders):
+            t = threading.Thread(target=self._run, name="Envios-%s" % i, daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info("Envíos iniciados: %s hilos, %s mensajes/s en total y %s por chat",
+                    self.numSenders, self.globalBucket.rate, self.chatRate)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    mensaje, espera = self._next(self.clock())
+                    if mensaje is not None:
+                        break
+                    if self._stopping and espera is None and not any(c.enviando for c in self._chats.values()):
+                        return
+                    self._cond.wait(espera)
+            self._deliver(mensaje)
+
+    def stop(self, timeout=None):
+        """ Envía lo que quede pendiente respetando los límites y para los hilos """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+        stats = self.stats()
+        logger.info("Envíos detenidos. %s enviados, %s juntados, %s retrasados, %s errores, %s pendientes",
+                    stats["sent"], stats["coalesced"], stats["delayed"], stats["errors"], stats["pending"])
+
+    def pending(self):
+        """ Mensajes esperando en la cola, de todas las prioridades """
+        with self._cond:
+            return sum(len(cola) for chat in self._chats.values() for cola in chat.colas.values())
+
+    def stats(self):
+        with self._cond:
+            pendientes = {prioridad: sum(len(chat.colas[prioridad]) for chat in self._chats.values())
+                          for prioridad in PRIORIDADES}
+            return {"pending": sum(pendientes.values()),
+                    "pending_conversacion": pendientes[PRIORIDAD_CONVERSACION],
+                    "pending_masivo": pendientes[PRIORIDAD_MASIVO],
+                    "sent": self.sent,
+                    "coalesced": self.coalesced,
+                    "delayed": self.delayed,
+                    "global_throttles": self.globalThrottles,
+                    "retry_after": self.retryAfters,
+                    "errors": self.errors,
+                    "chats": len(self._chats)}
@@ -0,0 +1,298 @@
+""" Copia local de las pestañas de la hoja principal de RespiraBot (userDataSheet).
+Cada pestaña de esquema.py se guarda en una tabla SQLite con una columna por columna de la hoja, y
+día, provincia y municipio normalizados aparte y con índice, así las consultas por día o por lugar no
+recorren toda la tabla. Sincronizar solo pide a Google las filas a partir de la última que ya se tiene:
+esa última vuelve con la respuesta y, si ya no coincide (se han borrado o movido filas en la hoja), la
+pestaña se vuelve a copiar entera.
+
+El bot sincroniza cada [espejo] intervalo segundos y reconstruye sus índices desde la copia al arrancar.
+Las consultas y exportaciones funcionan sin conexión, sin gastar cuota de la API de Google:
+    python3 espejo.py logs/espejo.db resumen
+    python3 espejo.py logs/espejo.db filas programadas --municipio Getxo --dia 2020-04-05
+    python3 espejo.py logs/espejo.db contar confirmadas --por provincia
+    python3 espejo.py logs/espejo.db exportar programadas getxo.json --municipio Getxo
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from esquema import CONFIRMADAS, PROGRAMADAS, NA
+from flujo import normalizar
+from journal import Journal, soloLectura
+
+logger = logging.getLogger("respirabot.espejo")
+
+# Agrupaciones de contar: columna de la tabla y columna del esquema con el texto que se muestra
+AGRUPAR = {"dia": ("dia", None), "provincia": ("provincia", "provincia"), "municipio": ("municipio", "municipio")}
+
+
+def columnaA1(numero):
+    """ Letra de la columna número (1 = A, 27 = AA) """
+    letras = ""
+    while numero:
+        numero, resto = divmod(numero - 1, 26)
+        letras = chr(ord("A") + resto) + letras
+    return letras
+
+
+def diaDe(fecha):
+    """ Día en ISO (2020-04-05) a partir de la fecha de fin dd/mm/YYYY HH:MM:SS, o "" """
+    try:
+        return datetime.strptime(str(fecha)[:10], "%d/%m/%Y").date().isoformat()
+    except ValueError:
+        return ""
+
+
+class SheetMirror:
+    """ Copia incremental de las pestañas en SQLite
+        - sync(fetch): trae lo nuevo de cada pestaña. fetch(schema, rango) devuelve las filas de la hoja en
+          ese rango A1 (ej. ws.get("A5:Z")), con las celdas vacías del final recortadas como hace Google
+        - rows(schema): todas las filas, con el ancho del esquema
+        - query(schema, ...) / count(schema, por, ...): filas o número de filas por día, provincia o municipio
+        Las filas se guardan con su número de fila en la hoja; las vacías se cuentan pero no se guardan
+        - readOnly: solo para consultar una copia que ya existe, sin escribir en ella (línea de comandos)
+    """
+
+    def __init__(self, path, schemas=(CONFIRMADAS, PROGRAMADAS), readOnly=False):
+        self.path = path
+        self.schemas = {schema.nombre: schema for schema in schemas}
+        self._lock = threading.Lock()
+        self.syncs = 0
+        self.fetched = 0
+        self.resyncs = 0
+        if readOnly:
+            self._db = sqlite3.connect(soloLectura(path), uri=True, check_same_thread=False, isolation_level=None)
+            return
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS pestanas (
+                nombre TEXT PRIMARY KEY,
+                cabeceras TEXT NOT NULL,
+                filas INTEGER NOT NULL,
+                ultima TEXT,
+                sincronizada TEXT)""")
+        for schema in schemas:
+            self._crear(schema)
+
+    @staticmethod
+    def _tabla(schema):
+        return "espejo_" + schema.nombre
+
+    def _crear(self, schema):
+        """ Tabla de la pestaña. Si las columnas del esquema han cambiado se vacía para copiarla de nuevo """
+        tabla = self._tabla(schema)
+        cabeceras = json.dumps(schema.headers, ensure_ascii=False)
+        fila = self._db.execute("SELECT cabeceras FROM pestanas WHERE nombre = ?", (schema.nombre,)).fetchone()
+        if fila is not None and fila[0] != cabeceras:
+            logger.warning("Las columnas de %s han cambiado, se vuelve a copiar la pestaña entera", schema.nombre)
+            self._db.execute("DROP TABLE IF EXISTS %s" % tabla)
+            fila = None
+        columnas = ", ".join("c%s TEXT" % i for i in range(len(schema.headers)))
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS {t} (fila INTEGER PRIMARY KEY, dia TEXT, provincia TEXT, municipio TEXT, {c});
+            CREATE INDEX IF NOT EXISTS {t}_dia ON {t} (dia);
+            CREATE INDEX IF NOT EXISTS {t}_lugar ON {t} (provincia, municipio);
+            CREATE INDEX IF NOT EXISTS {t}_municipio ON {t} (municipio);
+        """.format(t=tabla, c=columnas))
+        if fila is None:
+            self._db.execute("INSERT OR REPLACE INTO pestanas (nombre, cabeceras, filas) VALUES (?, ?, 0)",
+                    (schema.nombre, cabeceras))
+
+    def _ancho(self, schema, row):
+        ancho = len(schema.headers)
+        return [str(valor) for valor in row[:ancho]] + [""] * (ancho - len(row))
+
+    def sync(self, fetch):
+        """ Trae las filas nuevas de todas las pestañas. Devuelve {nombre: filas nuevas} """
+        nuevas = {}
+        for schema in self.schemas.values():
+            nuevas[schema.nombre] = self.syncSchema(schema, fetch)
+        self.syncs += 1
+        return nuevas
+
+    def syncSchema(self, schema, fetch):
+        with self._lock:
+            filas, ultima = self._db.execute("SELECT filas, ultima FROM pestanas WHERE nombre = ?",
+                    (schema.nombre,)).fetchone()
+        ultimaColumna = columnaA1(len(schema.headers))
+        # La fila 1 es la cabecera: la fila de datos n es la n + 1 de la hoja
+        if filas:
+            valores = fetch(schema, "A%s:%s" % (filas + 1, ultimaColumna))
+            if not valores or self._ancho(schema, valores[0]) != json.loads(ultima):
+                logger.warning("La fila %s de %s ya no es la que se copió, se vuelve a copiar la pestaña entera",
+                        filas + 1, schema.nombre)
+                self.resyncs += 1
+                filas = 0
+                valores = fetch(schema, "A2:%s" % ultimaColumna)
+            else:
+                valores = valores[1:]
+        else:
+            valores = fetch(schema, "A2:%s" % ultimaColumna)
+
+        tabla = self._tabla(schema)
+        posiciones = (schema.position("Fecha fin"), schema.position("provincia"),
+                      schema.position("municipio") if schema is PROGRAMADAS else None)
+        registros = []
+        for numero, row in enumerate(valores, start=filas + 2):
+            row = self._ancho(schema, row)
+            if not any(row):
+                continue
+            fecha, provincia, municipio = (row[p] if p is not None else "" for p in posiciones)
+            registros.append([numero, diaDe(fecha), normalizar(provincia), normalizar(municipio)] + row)
+        with self._lock:
+            self._db.execute("BEGIN")
+            if not filas:
+                self._db.execute("DELETE FROM %s" % tabla)
+            self._db.executemany("INSERT OR REPLACE INTO %s VALUES (%s)" % (tabla, ",".join("?" * (4 + len(schema.headers)))),
+                    registros)
+            total = filas + len(valores)
+            ultima = json.dumps(self._ancho(schema, valores[-1]), ensure_ascii=False) if valores else ultima
+            self._db.execute("UPDATE pestanas SET filas = ?, ultima = ?, sincronizada = ? WHERE nombre = ?",
+                    (total, ultima if total else None, datetime.now().isoformat(), schema.nombre))
+            self._db.execute("COMMIT")
+        self.fetched += len(registros)
+        if registros:
+            logger.info("Copia local de %s: %s filas nuevas, %s en total", schema.nombre, len(registros), total)
+        return len(registros)
+
+    def _filtro(self, dia=None, desde=None, hasta=None, provincia=None, municipio=None):
+        condiciones, parametros = [], []
+        for columna, operador, valor in (("dia", "=", dia), ("dia", ">=", desde), ("dia", "<=", hasta),
+                                         ("provincia", "=", provincia and normalizar(provincia)),
+                                         ("municipio", "=", municipio and normalizar(municipio))):
+            if valor:
+                condiciones.append("%s %s ?" % (columna, operador))
+                parametros.append(valor)
+        return (" WHERE " + " AND ".join(condiciones)) if condiciones else "", parametros
+
+    def query(self, schema, limit=None, **filtros):
+        """ Filas que cumplen los filtros (dia, desde, hasta, provincia, municipio), en el orden de la hoja """
+        donde, parametros = self._filtro(**filtros)
+        columnas = ", ".join("c%s" % i for i in range(len(schema.headers)))
+        sql = "SELECT %s FROM %s%s ORDER BY fila" % (columnas, self._tabla(schema), donde)
+        if limit:
+            sql += " LIMIT %d" % limit
+        with self._lock:
+            return [list(row) for row in self._db.execute(sql, parametros)]
+
+    def rows(self, schema):
+        return self.query(schema)
+
+    def count(self, schema, por, **filtros):
+        """ [(grupo, filas)] agrupando por dia, provincia o municipio, con el texto tal como está en la hoja """
+        columna, original = AGRUPAR[por]
+        if columna == "municipio" and schema is not PROGRAMADAS:
+            raise ValueError("%s no tiene municipio" % schema.nombre)
+        texto = "MIN(c%s)" % schema.position(original) if original else columna
+        donde, parametros = self._filtro(**filtros)
+        with self._lock:
+            return [(grupo or NA, n) for grupo, n in self._db.execute(
+                    "SELECT %s, COUNT(*) FROM %s%s GROUP BY %s ORDER BY %s" % (texto, self._tabla(schema), donde,
+                    columna, columna), parametros)]
+
+    def stats(self):
+        with self._lock:
+            pestanas = {nombre: {"filas": filas, "sincronizada": sincronizada} for nombre, filas, sincronizada in
+                        self._db.execute("SELECT nombre, filas, sincronizada FROM pestanas")}
+        return {"pestanas": pestanas, "syncs": self.syncs, "fetched": self.fetched, "resyncs": self.resyncs}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def ajustesBot(ini):
+    """ (hoja principal, {pestaña: schema}) de respirabot.ini, para las herramientas de línea de comandos """
+    import configparser
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(ini, "utf8")
+    hoja = config.get("google", "userDataSheet", fallback=None)
+    return hoja, {config.get("google", "sheet_confirmadas", fallback="Confirmadas"): CONFIRMADAS,
+                  config.get("google", "sheet_programadas", fallback="Programadas"): PROGRAMADAS}
+
+
+def guardadas(path, journalPath=None, hoja=None, pestanas=None):
+    """ (schema, row) de todo lo guardado, sin conexión: la copia local de la hoja principal más las filas
+        del diario que aún no han llegado a ella, como hace el bot al arrancar. El diario no sirve solo porque
+        se compacta y borra lo que ya está en las hojas. Las dos bases de datos se abren solo para leer
+        - hoja: userDataSheet, el destino del diario del que sale la copia local
+        - pestanas: {pestaña: schema}, los nombres con que se guardan las filas en el diario
+    """
+    mirror = SheetMirror(path, readOnly=True)
+    try:
+        filas = [(schema, row) for schema in mirror.schemas.values() for row in mirror.rows(schema)]
+    finally:
+        mirror.close()
+    if journalPath and hoja and os.path.exists(journalPath):
+        journal = Journal(journalPath, [], readOnly=True)
+        try:
+            filas.extend((pestanas[sheet], row) for _, sheet, row in journal.pending(hoja, limit=-1) if sheet in pestanas)
+        finally:
+            journal.close()
+    return filas
+
+
+def main():
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Consultas y exportaciones de la copia local de la hoja, sin conexión")
+    parser.add_argument("espejo", help="ruta de logs/espejo.db")
+    acciones = parser.add_subparsers(dest="accion", required=True)
+    acciones.add_parser("resumen", help="filas y última sincronización de cada pestaña")
+    for nombre, ayuda in (("filas", "muestra las filas"), ("contar", "filas por día, provincia o municipio"),
+                          ("exportar", "guarda las filas en CSV o JSON")):
+        accion = acciones.add_parser(nombre, help=ayuda)
+        accion.add_argument("pestana", choices=[schema.nombre for schema in (CONFIRMADAS, PROGRAMADAS)])
+        if nombre == "exportar":
+            accion.add_argument("salida", help="fichero .csv o .json")
+            accion.add_argument("--formato", choices=("csv", "json"), help="por defecto, la extensión de salida")
+        if nombre == "contar":
+            accion.add_argument("--por", choices=sorted(AGRUPAR), default="dia")
+        if nombre == "filas":
+            accion.add_argument("--limite", type=int, default=50)
+        accion.add_argument("--dia", help="AAAA-MM-DD")
+        accion.add_argument("--desde", help="AAAA-MM-DD")
+        accion.add_argument("--hasta", help="AAAA-MM-DD")
+        accion.add_argument("--provincia")
+        accion.add_argument("--municipio")
+    args = parser.parse_args()
+
+    mirror = SheetMirror(args.espejo, readOnly=True)
+    if args.accion == "resumen":
+        for nombre, datos in sorted(mirror.stats()["pestanas"].items()):
+            print("%s: %s filas, sincronizada %s" % (nombre, datos["filas"], datos["sincronizada"] or "nunca"))
+        mirror.close()
+        return
+
+    schema = mirror.schemas[args.pestana]
+    filtros = {clave: getattr(args, clave) for clave in ("dia", "desde", "hasta", "provincia", "municipio")}
+    if args.accion == "filas":
+        for row in mirror.query(schema, limit=args.limite, **filtros):
+            print("\t".join(row))
+    elif args.accion == "contar":
+        try:
+            for grupo, n in mirror.count(schema, args.por, **filtros):
+                print("%s\t%s" % (grupo, n))
+        except ValueError as e:
+            sys.exit(str(e))
+    else:
+        filas = mirror.query(schema, **filtros)
+        formato = args.formato or ("json" if args.salida.lower().endswith(".json") else "csv")
+        if formato == "csv":
+            schema.exportCsv(args.salida, filas)
+        else:
+            with open(args.salida, "w", encoding="utf8") as f:
+                json.dump([dict(zip(schema.headers, row)) for row in filas], f, ensure_ascii=False, indent=1)
+        print("%s filas de %s en %s" % (len(filas), schema.nombre, args.salida))
+    mirror.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+""" Columnas de las hojas de resultados de RespiraBot.
+CONFIRMADAS y PROGRAMADAS declaran en orden las columnas de cada pestaña: la cabecera, la clave de
+context.user_data de la que sale el valor, el valor por defecto y, si hace falta, cómo se formatea.
+Cada RowSchema se compila una vez al importarse y de la misma declaración salen las filas que se
+envían a Google Sheets, las exportaciones a CSV y la comprobación de las cabeceras de la hoja.
+
+Exporta a CSV las filas guardadas de una pestaña (la copia local de la hoja más lo que aún está en el diario):
+    python3 esquema.py logs/espejo.db confirmadas confirmadas.csv
+"""
+
+import csv
+import logging
+import time
+from datetime import datetime
+
+logger = logging.getLogger("respirabot.esquema")
+
+# Valor de las columnas sin dato
+NA = "NA"
+
+
+# (segundo, texto) de la última fecha formateada: strftime es lo más caro de construir una fila
+_ahora = (None, None)
+
+
+def ahora(data):
+    global _ahora
+    segundo = int(time.time())
+    if _ahora[0] != segundo:
+        _ahora = (segundo, datetime.fromtimestamp(segundo).strftime("%d/%m/%Y %H:%M:%S"))
+    return _ahora[1]
+
+
+def enlaceUsuario(userName):
+    """ Fórmula con el enlace al usuario de Telegram, o NA si no tiene nombre de usuario """
+    if not userName:
+        return NA
+    return "=HYPERLINK(\"https://t.me/" + userName + "\", \"" + userName + "\")"
+
+
+class Column:
+    """ Columna de una hoja
+        - cabecera: texto de la primera fila de la hoja
+        - clave: clave de user_data. Si falta se escribe defecto
+        - formato: función que transforma el valor guardado (se le pasa None si falta)
+        - calculo: función que recibe user_data entero, para columnas que no salen de una clave
+    """
+
+    def __init__(self, cabecera, clave=None, defecto=NA, formato=None, calculo=None):
+        self.cabecera = cabecera
+        self.clave = clave
+        self.defecto = defecto
+        self.formato = formato
+        self.calculo = calculo
+
+
+class RowSchema:
+    """ Columnas de una pestaña compiladas en una tupla de (clave, defecto, formato, calculo)
+        - row(data): fila para un user_data
+        - rows(datas): filas para varios user_data, para escribirlas con un solo append_rows
+        - checkHeaders(cabeceras): diferencias con la primera fila de la hoja
+        - position(nombre): índice de la columna con esa clave o esa cabecera, para leer filas ya serializadas
+    """
+
+    def __init__(self, nombre, columnas):
+        self.nombre = nombre
+        self.columnas = tuple(columnas)
+        self.headers = [c.cabecera for c in self.columnas]
+        self._compiled = tuple((c.clave, c.defecto, c.formato, c.calculo) for c in self.columnas)
+        self._positions = {}
+        for i, c in enumerate(self.columnas):
+            self._positions.setdefault(c.cabecera, i)
+            if c.clave:
+                self._positions.setdefault(c.clave, i)
+
+    def position(self, nombre):
+        return self._positions[nombre]
+
+    def row(self, data):
+        fila = []
+        append = fila.append
+        for clave, defecto, formato, calculo in self._compiled:
+            if calculo is not None:
+                append(calculo(data))
+            elif formato is not None:
+                append(formato(data.get(clave)))
+            elif clave in data:
+                append(data[clave])
+            else:
+                append(defecto)
+        return fila
+
+    def rows(self, datas):
+        return [self.row(data) for data in datas]
+
+    def checkHeaders(self, cabeceras):
+        """ Lista de (columna, esperada, encontrada) en las que la hoja no coincide con el esquema """
+        diferencias = []
+        for i, esperada in enumerate(self.headers):
+            encontrada = cabeceras[i] if i < len(cabeceras) else None
+            if (encontrada or "").strip() != esperada:
+                diferencias.append((i + 1, esperada, encontrada))
+        return diferencias
+
+    def exportCsv(self, path, filas):
+        """ Escribe las filas ya serializadas en un CSV con la cabecera del esquema """
+        with open(path, "w", newline="", encoding="utf8") as f:
+            writer = csv.writer(f)
+            writer.writerow(self.headers)
+            writer.writerows(filas)
+        return len(filas)
+
+
+# Columnas comunes al principio de las dos pestañas
+_COMUNES = (
+    Column("Fecha inicio", "fecha_inicio"),
+    Column("Fecha fin", calculo=ahora),
+    Column("Nombre", "nombre"),
+    Column("Apellido", "apellido"),
+    Column("User ID", "user_id"),
+    Column("Usuario", "user_name", formato=enlaceUsuario),
+    Column("Provincia", "provincia"),
+)
+
+CONFIRMADAS = RowSchema("confirmadas", _COMUNES + (
+    Column("Entregado Osakidetza", "entregado_osakidetza"),
+    Column("Cantidad Osakidetza", "cantidad_osakidetza"),
+    Column("Modelo anterior", "modelo_anterior"),
+    Column("Recepción PLA", "recepcion_pla"),
+    Column("Diámetro", "diametro"),
+    Column("Cantidad PLA recibido", "cantidad_pla_recibido"),
+    Column("Bobinas entregadas", "bobinas_entregadas"),
+    Column("Cantidad bobinas entregadas", "cantidad_bobinas_entregadas"),
+))
+
+PROGRAMADAS = RowSchema("programadas", _COMUNES + (
+    Column("Osakidetza preparadas", "cantidad_osakidetza_preparada"),
+    Column("Anterior preparadas", "cantidad_anterior_preparada"),
+    Column("Municipio", "municipio"),
+    Column("Dirección", "direccion"),
+    Column("Horario", "horario"),
+    Column("Teléfono", "telefono"),
+))
+
+
+def schemaFor(user_data):
+    """ Esquema según la respuesta a Confirmar/Programar recogida, o None si no la hay """
+    opcion = user_data.get("confirmar_programar") or ""
+    if "Confirmar" in opcion:
+        return CONFIRMADAS
+    if "Programar" in opcion:
+        return PROGRAMADAS
+    return None
+
+
+def main():
+    import argparse
+    import os
+    from espejo import ajustesBot, guardadas
+
+    carpeta = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Exporta a CSV las filas guardadas de una pestaña, sin conexión")
+    parser.add_argument("espejo", help="ruta de logs/espejo.db, la copia local de la hoja principal")
+    parser.add_argument("esquema", choices=["confirmadas", "programadas"])
+    parser.add_argument("salida", help="fichero CSV")
+    parser.add_argument("--diario", default=os.path.join(carpeta, "logs", "journal.db"),
+                        help="diario con las filas que aún no han llegado a la hoja (logs/journal.db)")
+    parser.add_argument("--ini", default=os.path.join(carpeta, "respirabot.ini"),
+                        help="configuración del bot, de la que salen la hoja principal y los nombres de las pestañas")
+    args = parser.parse_args()
+
+    hoja, pestanas = ajustesBot(args.ini)
+    filas = [row for schema, row in guardadas(args.espejo, args.diario, hoja, pestanas) if schema.nombre == args.esquema]
+    schema = CONFIRMADAS if args.esquema == "confirmadas" else PROGRAMADAS
+    print("%s filas exportadas a %s" % (schema.exportCsv(args.salida, filas), args.salida))
+
+
+if __name__ == '__main__':
+    main()
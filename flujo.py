@@ -0,0 +1,351 @@
+""" Definición declarativa de la conversación de RespiraBot.
+Cada paso de la conversación se describe en FLUJO con lo que se guarda, las respuestas que se esperan,
+cómo se valida la respuesta, qué se contesta y a qué paso se pasa. ConversationEngine compila la tabla
+al arrancar en diccionarios por paso sobre el texto normalizado (sin mayúsculas ni acentos), así que
+reconocer una respuesta es una búsqueda en un dict y añadir una pregunta es añadir una entrada a FLUJO.
+"""
+
+import logging
+import unicodedata
+
+from registro import porMensaje
+
+logger = logging.getLogger("respirabot.flujo")
+
+# Pasos de la conversación: Cada uno de estos pasos va enumerado para la posterior identificacion de la etapa en la que se encuentre la conversación.
+(CONFIRMACION_ENTREGA, CONFIRMAR_PROGRAMAR, CANTIDAD_OSAKIDETZA,
+    MODELO_ANTERIOR, RECEPCION_PLA, BOBINAS_ENTREGADAS,
+    CANTIDAD_BOBINAS_ENTREGADAS, NO_ENTREGADO, PROVINCIA, DIAMETRO_PLA,
+    CANTIDAD_OSAKIDETZA_PREPARADA, CANTIDAD_ANTERIOR_PREPARADA, MUNICIPIO,
+    DIRECCION, HORARIO, TELEFONO) = range(16)
+
+# Destinos especiales: terminar guardando los datos o terminar sin guardarlos
+FIN = "FIN"
+FIN_SIN_SALVAR = "FIN_SIN_SALVAR"
+
+# Tipos de respuesta
+OPCIONES = "opciones"      # Una de las opciones del paso (botones o sus sinónimos)
+NUMERO = "numero"          # Número entero
+TEXTO = "texto"            # Cualquier texto
+TELEFONO_O_CONTACTO = "telefono"    # Contacto compartido o teléfono de al menos 9 caracteres
+NOMBRE_MUNICIPIO = "municipio"      # Municipio de la provincia elegida, reconocido con municipios.Gazetteer
+
+# Clave de user_data con lo que se ha preguntado en el paso de municipio mientras no se resuelve
+MUNICIPIO_PENDIENTE = "municipio_pendiente"
+
+# Sinónimos en castellano y euskera de las respuestas más comunes
+SI = ("Sí", "Si", "Bai")
+NO = ("No", "Ez")
+
+
+def normalizar(texto):
+    """ Minúsculas, sin acentos, sin signos de puntuación alrededor y con un solo espacio entre palabras """
+    texto = unicodedata.normalize("NFKD", texto.casefold())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return " ".join(texto.strip(" \t\n!¡?¿.,;:").split())
+
+
+_SI = frozenset(normalizar(si) for si in SI)
+
+
+def esSi(valor):
+    """ Si valor es un sí de SI escrito de cualquier forma ("Sí", "si", "BAI"...). Las filas guardadas
+        antes de flujo.FLUJO tienen el texto tal cual lo escribió el voluntario
+    """
+    return normalizar(str(valor or "")) in _SI
+
+
+class Opcion:
+    """ Respuesta reconocida en un paso de tipo OPCIONES
+        - valor: lo que se guarda en user_data
+        - sinonimos: textos que se aceptan para esta opción
+        - mensajes: lista de (clave de texto, clave de teclado) que se envían
+        - siguiente: paso siguiente, FIN o FIN_SIN_SALVAR
+    """
+
+    def __init__(self, valor, sinonimos, mensajes, siguiente):
+        self.valor = valor
+        self.sinonimos = sinonimos
+        self.mensajes = mensajes
+        self.siguiente = siguiente
+
+
+class Paso:
+    """ Un paso de la conversación
+        - nombre: nombre del paso para los logs
+        - clave: clave de user_data donde se guarda la respuesta (o None)
+        - tipo: OPCIONES, NUMERO, TEXTO o TELEFONO_O_CONTACTO
+        - opciones: para OPCIONES, lista de Opcion
+        - mensajes / siguiente: para el resto de tipos, qué se contesta y a dónde se va
+        - error: (texto, teclado) si la respuesta no es válida. En OPCIONES, si no se indica,
+          se usa noEntendi con el teclado tecladoNoEntendi
+        - valorNoEntendido: lo que se guarda en clave cuando la respuesta no es válida
+    """
+
+    def __init__(self, nombre, clave, tipo, opciones=(), mensajes=(), siguiente=None,
+                 error=None, tecladoNoEntendi=None, valorNoEntendido=None):
+        self.nombre = nombre
+        self.clave = clave
+        self.tipo = tipo
+        self.opciones = opciones
+        self.mensajes = mensajes
+        self.siguiente = siguiente
+        self.error = error
+        self.tecladoNoEntendi = tecladoNoEntendi
+        self.valorNoEntendido = valorNoEntendido
+
+
+FLUJO = {
+    PROVINCIA: Paso("provincia", "provincia", TEXTO,
+            mensajes=[("en_que_ayudo", "confirmar_programar")], siguiente=CONFIRMAR_PROGRAMAR),
+
+    CONFIRMAR_PROGRAMAR: Paso("confirmar_programar", "confirmar_programar", OPCIONES, tecladoNoEntendi="confirmar_programar",
+            opciones=[Opcion("Programar", ("Programar", "Programar recogida"),
+                             [("programar_osakidetza", "quitar")], CANTIDAD_OSAKIDETZA_PREPARADA),
+                      Opcion("Confirmar", ("Confirmar", "Confirmar recogida", "Confirmar entrega"),
+                             [("confirmar_entrega", "si_no")], CONFIRMACION_ENTREGA)]),
+
+    # Rama de confirmar la recogida
+    CONFIRMACION_ENTREGA: Paso("confirmacion_entrega", "entregado_osakidetza", OPCIONES, tecladoNoEntendi="si_no",
+            opciones=[Opcion("Sí", SI, [("entregado_osakidetza", "quitar")], CANTIDAD_OSAKIDETZA),
+                      Opcion("No", NO, [("no_entregado", "si_no")], NO_ENTREGADO)]),
+
+    # "¿Prefieres esperar un rato?": si espera no se guarda nada, si no se guarda como recogida fallida
+    NO_ENTREGADO: Paso("no_entregado", None, OPCIONES, tecladoNoEntendi="si_no",
+            opciones=[Opcion("Sí", SI, [("esperar", "quitar")], FIN_SIN_SALVAR),
+                      Opcion("No", NO, [("recogida_fallida", "quitar")], FIN)]),
+
+    CANTIDAD_OSAKIDETZA: Paso("cantidad_osakidetza", "cantidad_osakidetza", NUMERO,
+            mensajes=[("entregado_anterior", "quitar")], siguiente=MODELO_ANTERIOR,
+            error=("entregado_osakidetza_error", "quitar")),
+
+    MODELO_ANTERIOR: Paso("modelo_anterior", "modelo_anterior", NUMERO,
+            mensajes=[("bobinas_entregadas", "si_no")], siguiente=BOBINAS_ENTREGADAS,
+            error=("entregado_anterior_error", "quitar")),
+
+    BOBINAS_ENTREGADAS: Paso("bobinas_entregadas", "bobinas_entregadas", OPCIONES, tecladoNoEntendi="si_no",
+            opciones=[Opcion("Sí", SI, [("cuantas_bobinas", "quitar")], CANTIDAD_BOBINAS_ENTREGADAS),
+                      Opcion("No", NO, [("necesitas_pla", "si_no")], RECEPCION_PLA)]),
+
+    CANTIDAD_BOBINAS_ENTREGADAS: Paso("cantidad_bobinas_entregadas", "cantidad_bobinas_entregadas", NUMERO,
+            mensajes=[("necesitas_pla", "si_no")], siguiente=RECEPCION_PLA,
+            error=("cantidad_bobinas_error", "quitar")),
+
+    RECEPCION_PLA: Paso("recepcion_pla", "recepcion_pla", OPCIONES, tecladoNoEntendi="si_no",
+            opciones=[Opcion("Sí", SI, [("diametro_pla", "diametro")], DIAMETRO_PLA),
+                      Opcion("No", NO, [], FIN)]),
+
+    DIAMETRO_PLA: Paso("diametro_pla", "diametro", OPCIONES, tecladoNoEntendi="diametro", valorNoEntendido="Err",
+            opciones=[Opcion("1.75", ("1.75mm", "1.75 mm", "1.75", "1,75", "1,75mm", "1,75 mm", "175", "1"),
+                             [("diametro_175", "quitar")], FIN),
+                      Opcion("3", ("3mm", "3 mm", "3", "3.00", "2.85", "2.85mm"),
+                             [("diametro_3", "quitar")], FIN)]),
+
+    # Rama de programar una recogida
+    CANTIDAD_OSAKIDETZA_PREPARADA: Paso("cantidad_osakidetza_preparada", "cantidad_osakidetza_preparada", NUMERO,
+            mensajes=[("preparada_anterior", "quitar")], siguiente=CANTIDAD_ANTERIOR_PREPARADA,
+            error=("preparada_osakidetza_error", "quitar")),
+
+    CANTIDAD_ANTERIOR_PREPARADA: Paso("cantidad_anterior_preparada", "cantidad_anterior_preparada", NUMERO,
+            mensajes=[("pedir_municipio", "quitar")], siguiente=MUNICIPIO,
+            error=("preparada_anterior_error", "quitar")),
+
+    MUNICIPIO: Paso("municipio", "municipio", NOMBRE_MUNICIPIO,
+            mensajes=[("pedir_direccion", "quitar")], siguiente=DIRECCION,
+            error=("municipio_error", "quitar")),
+
+    DIRECCION: Paso("direccion", "direccion", TEXTO,
+            mensajes=[("pedir_horario", "horario")], siguiente=HORARIO),
+
+    HORARIO: Paso("horario", "horario", OPCIONES, error=("horario_error", "horario"),
+            opciones=[Opcion("Mañana", ("Mañana", "Por la mañana", "Goiza", "Goizean"),
+                             [("pedir_telefono", "contacto")], TELEFONO),
+                      Opcion("Tarde", ("Tarde", "Por la tarde", "Arratsaldea", "Arratsaldean"),
+                             [("pedir_telefono", "contacto")], TELEFONO),
+                      Opcion("Todo el día", ("Todo el día", "Todo el dia", "Egun osoa", "Egun osoan"),
+                             [("pedir_telefono", "contacto")], TELEFONO)]),
+
+    TELEFONO: Paso("telefono", "telefono", TELEFONO_O_CONTACTO,
+            mensajes=[("recogida_programada", "quitar"), ("prep_recogida", "quitar")], siguiente=FIN,
+            error=("telefono_error", "contacto")),
+}
+
+
+def responderDirecto(update, texto, teclado=None):
+    """ Contesta al mensaje del update llamando a Telegram en el mismo hilo """
+    update.message.reply_text(texto, reply_markup=teclado)
+
+
+class ConversationEngine:
+    """ Compila FLUJO y genera un handler por paso
+        - mensajes: MessageCatalog con los textos y teclados
+        - finConversacion / finSinSalvar: handlers que terminan la conversación
+        - noEntendi(update, context, teclado): respuesta cuando no se entiende una opción
+        - enviar(update, texto, teclado): cómo se contesta al usuario
+        - municipios: municipios.Gazetteer para los pasos NOMBRE_MUNICIPIO. Sin él se aceptan como TEXTO
+    """
+
+    def __init__(self, mensajes, finConversacion, finSinSalvar, noEntendi, flujo=FLUJO, enviar=responderDirecto,
+                 municipios=None):
+        self.mensajes = mensajes
+        self.noEntendi = noEntendi
+        self.flujo = flujo
+        self.enviar = enviar
+        self.municipios = municipios
+        self._finales = {FIN: finConversacion, FIN_SIN_SALVAR: finSinSalvar}
+        self._respuestas = {}
+
+        for estado, paso in flujo.items():
+            respuestas = {}
+            for opcion in paso.opciones:
+                for sinonimo in (opcion.valor,) + tuple(opcion.sinonimos):
+                    clave = normalizar(sinonimo)
+                    if respuestas.get(clave, opcion) is not opcion:
+                        raise ValueError("Respuesta '%s' repetida en el paso %s" % (sinonimo, paso.nombre))
+                    respuestas[clave] = opcion
+            self._respuestas[estado] = respuestas
+
+            for opcion in paso.opciones:
+                self._comprobarDestino(paso, opcion.siguiente, opcion.mensajes)
+            if paso.tipo != OPCIONES:
+                self._comprobarDestino(paso, paso.siguiente, paso.mensajes)
+
+    def _comprobarDestino(self, paso, siguiente, mensajes):
+        if siguiente not in self.flujo and siguiente not in self._finales:
+            raise ValueError("El paso %s lleva a un paso que no existe: %s" % (paso.nombre, siguiente))
+        for texto, teclado in mensajes:
+            self.mensajes.texto(texto)
+            self.mensajes.teclado(teclado)
+
+    def buscarOpcion(self, estado, texto):
+        """ Opción del paso estado que corresponde a texto, o None
+            Primero busca el texto completo y si no, una sola opción entre sus palabras
+        """
+        respuestas = self._respuestas[estado]
+        normalizado = normalizar(texto)
+        opcion = respuestas.get(normalizado)
+        if opcion is not None:
+            return opcion
+
+        encontradas = {respuestas[palabra] for palabra in normalizado.split() if palabra in respuestas}
+        if len(encontradas) == 1:
+            return encontradas.pop()
+        return None
+
+    def handler(self, estado):
+        """ Handler de python-telegram-bot para el paso estado """
+        paso = self.flujo[estado]
+
+        def responder(update, context):
+            return self.responder(estado, paso, update, context)
+        responder.__name__ = paso.nombre
+        return responder
+
+    def estados(self, crearHandler):
+        """ Diccionario de estados para ConversationHandler
+            - crearHandler(paso, callback): devuelve el handler de telegram para ese paso
+        """
+        return {estado: [crearHandler(paso, self.handler(estado))] for estado, paso in self.flujo.items()}
+
+    def _enviar(self, update, mensajes):
+        for texto, teclado in mensajes:
+            self.enviar(update, self.mensajes.texto(texto), self.mensajes.teclado(teclado))
+
+    def _siguiente(self, siguiente, update, context):
+        final = self._finales.get(siguiente)
+        if final is not None:
+            return final(update, context)
+        return siguiente
+
+    def responder(self, estado, paso, update, context):
+        message = update.message
+        user = message.from_user
+        texto = message.text
+
+        if paso.tipo == OPCIONES:
+            opcion = self.buscarOpcion(estado, texto or "")
+            if opcion is not None:
+                logger.info("%s - %s: %s", user.first_name, paso.nombre, opcion.valor,
+                        extra=porMensaje(paso.nombre, user.id))
+                if paso.clave:
+                    context.user_data[paso.clave] = opcion.valor
+                self._enviar(update, opcion.mensajes)
+                return self._siguiente(opcion.siguiente, update, context)
+
+        elif paso.tipo == NOMBRE_MUNICIPIO and self.municipios is not None:
+            valor = self._municipio(paso, update, context)
+            if valor is None:
+                # Ya se le ha preguntado qué municipio es
+                return estado
+            logger.info("%s - %s: %s", user.first_name, paso.nombre, valor, extra=porMensaje(paso.nombre, user.id))
+            context.user_data[paso.clave] = valor
+            self._enviar(update, paso.mensajes)
+            return self._siguiente(paso.siguiente, update, context)
+
+        else:
+            valor = self._validar(paso, message)
+            if valor is not None:
+                logger.info("%s - %s: %s", user.first_name, paso.nombre, valor, extra=porMensaje(paso.nombre, user.id))
+                if paso.clave:
+                    context.user_data[paso.clave] = valor
+                self._enviar(update, paso.mensajes)
+                return self._siguiente(paso.siguiente, update, context)
+
+        if paso.valorNoEntendido is not None:
+            context.user_data[paso.clave] = paso.valorNoEntendido
+        if paso.error is not None:
+            logger.info("%s - %s: respuesta no válida %s", user.first_name, paso.nombre, texto,
+                    extra=porMensaje(paso.nombre, user.id))
+            self._enviar(update, [paso.error])
+        else:
+            self.noEntendi(update, context, paso.tecladoNoEntendi)
+        return estado
+
+    def _municipio(self, paso, update, context):
+        """ Nombre oficial del municipio escrito, dentro de la provincia elegida antes
+            - Si no está claro, propone los más parecidos en un teclado y devuelve None
+            - Si no se encuentra, pide que lo revise y devuelve None
+            - Si el usuario elige una de las propuestas o repite lo mismo, se acepta
+        """
+        texto = (update.message.text or "").strip()
+        if not texto:
+            self._enviar(update, [paso.error])
+            return None
+        pendiente = context.user_data.pop(MUNICIPIO_PENDIENTE, None)
+        normalizado = normalizar(texto)
+        if pendiente is not None:
+            propuestas = {normalizar(opcion): opcion for opcion in pendiente["opciones"]}
+            if normalizado in propuestas:
+                return propuestas[normalizado]
+            if normalizado == pendiente["texto"]:
+                return texto
+
+        nombre, candidatos = self.municipios.resolve(texto, context.user_data.get("provincia"))
+        if nombre is not None:
+            return nombre
+
+        opciones = [candidato.municipio for candidato in candidatos]
+        context.user_data[MUNICIPIO_PENDIENTE] = {"texto": normalizado, "opciones": opciones}
+        if opciones:
+            self.enviar(update, self.mensajes.texto("municipio_dudas"), self.mensajes.tecladoLista(opciones))
+        else:
+            self._enviar(update, [paso.error])
+        return None
+
+    def _validar(self, paso, message):
+        """ Valor a guardar para los pasos que no son de opciones, o None si no es válido """
+        if paso.tipo == TELEFONO_O_CONTACTO:
+            if hasattr(message.contact, "phone_number"):
+                return message.contact.phone_number
+            if message.text and len(message.text) >= 9:
+                return message.text
+            return None
+
+        if not message.text:
+            return None
+        if paso.tipo == NUMERO:
+            try:
+                int(message.text)
+            except ValueError:
+                return None
+        return message.text
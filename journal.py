@@ -0,0 +1,270 @@
+""" Diario local de envíos de RespiraBot.
+Cada conversación terminada se guarda primero en una base de datos SQLite (modo WAL) bajo logs/
+y después se envía a las hojas de Google. Cada fila se marca como confirmada por destino
+(hoja principal y de backup), de modo que si el bot se cae o Google devuelve un error
+las filas pendientes se vuelven a enviar al arrancar.
+IdempotencyIndex evita que la misma conversación se guarde dos veces.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from urllib.request import pathname2url
+
+from metricas import Counter
+
+logger = logging.getLogger("respirabot.journal")
+
+
+def soloLectura(path):
+    """ URI de SQLite para abrir path sin poder escribir en él """
+    return "file:%s?mode=ro" % pathname2url(os.path.abspath(path))
+
+DUPLICADOS = Counter("respirabot_duplicados_total", "Conversaciones repetidas que no se han vuelto a guardar")
+
+
+class Journal:
+    """ Diario de solo añadir con confirmaciones por destino
+        - entries: filas enviadas por los usuarios, en orden de llegada
+        - acks: filas confirmadas por cada destino por encima de su offset
+        - offsets: para cada destino, todas las filas con id <= last_id están confirmadas
+        - readOnly: abre un diario que ya existe solo para leerlo (herramientas de línea de comandos), sin
+          crear tablas ni tocar el modo del fichero aunque el bot lo esté usando
+    """
+
+    def __init__(self, path, destinations, readOnly=False):
+        self.path = path
+        self.destinations = list(destinations)
+        self._lock = threading.Lock()
+        if readOnly:
+            self._db = sqlite3.connect(soloLectura(path), uri=True, check_same_thread=False, isolation_level=None)
+            return
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sheet TEXT NOT NULL,
+                row TEXT NOT NULL,
+                created TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS acks (
+                destination TEXT NOT NULL,
+                entry_id INTEGER NOT NULL,
+                PRIMARY KEY (destination, entry_id)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS offsets (
+                destination TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL);
+        """)
+        for destination in self.destinations:
+            self._db.execute("INSERT OR IGNORE INTO offsets VALUES (?, 0)", (destination,))
+
+    def append(self, sheet, row):
+        """ Guarda una fila para la pestaña sheet y devuelve su identificador """
+        with self._lock:
+            cur = self._db.execute("INSERT INTO entries (sheet, row, created) VALUES (?, ?, ?)",
+                    (sheet, json.dumps(row, ensure_ascii=False), datetime.now().isoformat()))
+            return cur.lastrowid
+
+    def ack(self, destination, entryIds):
+        """ Marca las filas entryIds como escritas en destination """
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT OR IGNORE INTO acks VALUES (?, ?)",
+                    [(destination, entryId) for entryId in entryIds])
+            self._db.execute("COMMIT")
+
+    def offset(self, destination):
+        """ Último id a partir del cual todo está confirmado en destination """
+        with self._lock:
+            return self._db.execute("SELECT last_id FROM offsets WHERE destination = ?",
+                    (destination,)).fetchone()[0]
+
+    def pending(self, destination, limit=500):
+        """ Filas todavía no confirmadas por destination: lista de (id, sheet, row) """
+        with self._lock:
+            rows = self._db.execute("""
+                SELECT e.id, e.sheet, e.row FROM entries e
+                WHERE e.id > (SELECT last_id FROM offsets WHERE destination = ?)
+                  AND NOT EXISTS (SELECT 1 FROM acks a WHERE a.destination = ? AND a.entry_id = e.id)
+                ORDER BY e.id LIMIT ?""", (destination, destination, limit)).fetchall()
+        return [(entryId, sheet, json.loads(row)) for entryId, sheet, row in rows]
+
+    def entries(self, since=0):
+        """ Todas las filas guardadas con id > since: lista de (id, sheet, row) """
+        with self._lock:
+            rows = self._db.execute("SELECT id, sheet, row FROM entries WHERE id > ? ORDER BY id",
+                    (since,)).fetchall()
+        return [(entryId, sheet, json.loads(row)) for entryId, sheet, row in rows]
+
+    def compact(self):
+        """ Avanza los offsets sobre las filas confirmadas de forma contigua y borra
+            las filas que ya están confirmadas en todos los destinos
+        """
+        with self._lock:
+            self._db.execute("BEGIN")
+            maxId = self._db.execute("SELECT COALESCE(MAX(id), 0) FROM entries").fetchone()[0]
+            for destination in self.destinations:
+                firstPending = self._db.execute("""
+                    SELECT MIN(e.id) FROM entries e
+                    WHERE e.id > (SELECT last_id FROM offsets WHERE destination = ?)
+                      AND NOT EXISTS (SELECT 1 FROM acks a WHERE a.destination = ? AND a.entry_id = e.id)
+                    """, (destination, destination)).fetchone()[0]
+                newOffset = maxId if firstPending is None else firstPending - 1
+                self._db.execute("UPDATE offsets SET last_id = MAX(last_id, ?) WHERE destination = ?",
+                        (newOffset, destination))
+                self._db.execute("DELETE FROM acks WHERE destination = ? AND entry_id <= ?",
+                        (destination, newOffset))
+
+            placeholders = ",".join("?" * len(self.destinations))
+            lowWater = self._db.execute("SELECT COALESCE(MIN(last_id), 0) FROM offsets WHERE destination IN (%s)"
+                    % placeholders, self.destinations).fetchone()[0]
+            deleted = self._db.execute("DELETE FROM entries WHERE id <= ?", (lowWater,)).rowcount
+            self._db.execute("COMMIT")
+
+        if deleted:
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            logger.info("Diario compactado: %s filas eliminadas hasta el id %s", deleted, lowWater)
+        return deleted
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class JournalReplayer:
+    """ Envía a las hojas de Google las filas del diario que no estén confirmadas
+        - Al arrancar reenvía todo lo pendiente desde el último offset confirmado
+        - Cada replayInterval segundos reintenta las filas que hayan fallado
+        - Cada compactInterval segundos compacta el diario
+    """
+
+    def __init__(self, journal, writer, replayInterval=60, compactInterval=3600):
+        self.journal = journal
+        self.writer = writer
+        self.replayInterval = replayInterval
+        self.compactInterval = compactInterval
+        self._inFlight = set()
+        self._lock = threading.Lock()
+        self._stopEvent = threading.Event()
+        self._thread = None
+
+        self.replayed = 0
+        writer.onResult = self.onResult
+
+    def submit(self, sheetName, row):
+        """ Guarda la fila en el diario y la encola para todos los destinos """
+        entryId = self.journal.append(sheetName, row)
+        for destination in self.journal.destinations:
+            self._send(destination, entryId, sheetName, row)
+        return entryId
+
+    def _send(self, destination, entryId, sheetName, row):
+        with self._lock:
+            if (destination, entryId) in self._inFlight:
+                return False
+            self._inFlight.add((destination, entryId))
+        self.writer.submit(destination, sheetName, row, entryId)
+        return True
+
+    def onResult(self, destination, entryIds, ok):
+        """ Resultado de una escritura de SheetWriter. Si no se sabe (ok es None) las filas siguen en vuelo
+            y no se reenvían hasta el siguiente arranque
+        """
+        if ok:
+            self.journal.ack(destination, entryIds)
+        if ok is None:
+            return
+        with self._lock:
+            self._inFlight.difference_update((destination, entryId) for entryId in entryIds)
+
+    def replay(self):
+        """ Encola las filas pendientes que no estén ya en la cola de escritura """
+        count = 0
+        for destination in self.journal.destinations:
+            for entryId, sheetName, row in self.journal.pending(destination):
+                if self._send(destination, entryId, sheetName, row):
+                    count += 1
+        if count:
+            self.replayed += count
+            logger.info("Reenviando %s filas pendientes del diario", count)
+        return count
+
+    def start(self):
+        """ Reenvía lo pendiente y arranca el hilo de reintentos y compactación """
+        for destination in self.journal.destinations:
+            logger.info("Diario: %s confirmado hasta el id %s", destination, self.journal.offset(destination))
+        self.replay()
+        self._thread = threading.Thread(target=self._run, name="JournalReplayer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Detiene el hilo de reintentos. Llamar antes de detener SheetWriter """
+        self._stopEvent.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        sinceCompact = 0
+        while not self._stopEvent.wait(self.replayInterval):
+            try:
+                self.replay()
+                sinceCompact += self.replayInterval
+                if sinceCompact >= self.compactInterval:
+                    self.journal.compact()
+                    sinceCompact = 0
+            except Exception:
+                logger.exception("Error reenviando el diario")
+
+    def stats(self):
+        with self._lock:
+            inFlight = len(self._inFlight)
+        return {"in_flight": inFlight, "replayed": self.replayed}
+
+
+class IdempotencyIndex:
+    """ Índice de envíos ya guardados para descartar duplicados antes de ir a la red
+        Las claves caducan a los ttl segundos y nunca se guardan más de maxSize,
+        así que la memoria usada está acotada.
+        - clock: reloj en segundos, time.monotonic por defecto
+    """
+
+    def __init__(self, ttl=86400, maxSize=100000, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.clock = clock
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.duplicates = 0
+
+    def _evict(self, now):
+        # Las claves se insertan en orden de caducidad, así que las más antiguas están al principio
+        while self._keys:
+            key, expiry = next(iter(self._keys.items()))
+            if expiry > now and len(self._keys) < self.maxSize:
+                break
+            self._keys.popitem(last=False)
+
+    def seen(self, key):
+        """ Devuelve True si key ya se ha registrado y no ha caducado. Si no, la registra y devuelve False """
+        now = self.clock()
+        with self._lock:
+            self._evict(now)
+            if key in self._keys:
+                self.duplicates += 1
+                DUPLICADOS.inc()
+                return True
+            self._keys[key] = now + self.ttl
+            return False
+
+    def __len__(self):
+        return len(self._keys)
+
+    def stats(self):
+        return {"keys": len(self._keys), "duplicates_suppressed": self.duplicates}
@@ -0,0 +1,112 @@
+""" Catálogo de mensajes y teclados de RespiraBot.
+Todos los textos fijos se pasan por emoji.emojize una sola vez al arrancar y los teclados se
+construyen también una sola vez. En cada mensaje solo se añade el nombre del usuario.
+"""
+
+import random
+
+import emoji
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+
+_SI_QUIERES_EMPEZAR = "\n Si quieres empezar de nuevo, dale al botón o escribe /empezar"
+
+# Textos fijos de la conversación. Los que llevan {nombre} se completan con el nombre del usuario
+TEXTOS = {
+    "bienvenida": "Hola, {nombre} soy RespiraBot 💨 y estoy aquí para ayudarte a ser más eficiente con los envíos y el material que estamos recogiendo para combatir el 🦠" +
+            "\n Dime en qué provincia estás, por favor.",
+    "en_que_ayudo": "\n ¿En que te puedo ayudar?",
+    "programar_osakidetza": "\n 👌 Estupendo, me puedes decir cuantas viseras tienes del modelo de Osakidetza?",
+    "confirmar_entrega": "\n ¿Puedes confirmar la entrega de productos? 🚚",
+    "preparada_anterior": "👍 Estupendo, ¿me puedes decir cuantas tienes listas del modelo anterior?",
+    "preparada_osakidetza_error": "👎 Por favor, introduce el número de unidades listas del modelo de Osakidetza.",
+    "pedir_municipio": "Ok, voy a necesitar algo de información para programar esta recogida.\n Dime cual es tu municipio.",
+    "preparada_anterior_error": "👎 Por favor, introduce el número de unidades listas del modelo de Anterior.",
+    "pedir_direccion": "Muy bien, ahora la dirección para esta recogida.",
+    "pedir_horario": "\n ¿En qué horario podemos pasar?",
+    "pedir_telefono": "Muy bien, por último, dime tu teléfono",
+    "horario_error": "\n Perdona, no he entendido eso \n ¿En qué horario podemos pasar?",
+    "municipio_dudas": "🤔 ¿Te refieres a alguno de estos? 👇\n Si no, vuelve a escribir tu municipio tal cual y lo apunto así.",
+    "municipio_error": "🤔 No encuentro ese municipio. Revisa cómo lo has escrito o, si está bien, mándamelo otra vez y lo apunto así.",
+    "telefono_error": "\n Yo creo que ahi me faltan numeros. Dímelo de nuevo sólo con numeros (ej. 679123456) o comparte tu contacto por favor.",
+    "recogida_programada": "\n 👌 Genial, en la próxima recogida pasarán por tu dirección en el horario indicado. Gracias.",
+    "entregado_osakidetza": "👌 Estupendo, ¿me puedes decir cuantos has entregado del modelo de Osakidetza?",
+    "no_entregado": "☹️Lo sentimos, puede que nuestros compañeros de recogida hayan tenido algún problema 🚑. \n" +
+            "Te pedimos que esperes un poco antes de marcar la recogida como fallida. " +
+            "Si ya llevas un rato esperando o son más de las 20:00 marca la recogida como fallida para que lo tengamos en cuenta. \n ¿Prefieres esperar un rato?",
+    "recogida_fallida": "🤷🏻‍♀️‍ Ahora mismo no sé lo que ha podido pasar. Déjame que pase esta información y el equipo tratará de solucionarlo lo antes posible. Sentimos las molestias.",
+    "esperar": "Vale, gracias por tu paciencia!",
+    "entregado_anterior": "👍 Estupendo, ¿me puedes decir cuantos has entregado del modelo anterior?",
+    "entregado_osakidetza_error": "👎 Por favor, introduce el número de unidades del modelo de Osakidetza.",
+    "bobinas_entregadas": "Vale. \n ¿Has entregado ya bobinas vacías para su reutilización?",
+    "entregado_anterior_error": "👎 Por favor, introduce el número de unidades del modelo anterior.",
+    "diametro_pla": "¿De qué diámetro lo necesitas?",
+    "diametro_175": "1.75mm 🧵, entendido. Ya sabes lo que dicen... \n " +
+            "Más vale pequeña y juguetona que grande y torpe 😏",
+    "diametro_3": "3mm 🧶, entendido. ¡Eso! \n " +
+            "🐴 grande ande, o no ande. \n",
+    "cuantas_bobinas": "¿Cuántas?",
+    "necesitas_pla": "Muy bien. ¿Necesitas más PLA🎁?",
+    "cantidad_bobinas_error": "👎 Por favor, introduce el número de bobinas entregadas para su reutilización",
+    "fin_sin_salvar": "Esto es todo por ahora. Muchas gracias, {nombre}" + _SI_QUIERES_EMPEZAR,
+    "fin_conversacion": ":tada: :tada: :tada: Debuti. Esto es todo por ahora. Muchas gracias, {nombre}" + _SI_QUIERES_EMPEZAR,
+    "error": "Perdona, algo ha ido mal mientras hablábamos. \n¿Probamos de nuevo? 👉👈 😅" + _SI_QUIERES_EMPEZAR,
+    "timeout": "Oye, mejor hablamos luego, que ahora te veo liado. 👋" + _SI_QUIERES_EMPEZAR,
+}
+
+# Textos que no pasan por emoji.emojize
+TEXTOS_PLANOS = {
+    "cancelar": "Bueno, pues nada... luego hablamos :(",
+}
+
+# Teclados de respuesta de cada paso
+TECLADOS = {
+    "si_no": [["Sí", "No"]],
+    "provincias": [["Álava", "Bizkaia", "Gipuzkoa"]],
+    "confirmar_programar": [["Confirmar recogida", "Programar recogida"]],
+    "horario": [["Mañana", "Tarde", "Todo el día"]],
+    "diametro": [["1.75mm", "3mm"]],
+    "empezar": [["Empezar"]],
+}
+
+
+class MessageCatalog:
+    """ Textos ya emojizados y teclados ya construidos, listos para reply_text
+        - texto(clave, nombre): texto de TEXTOS, con el nombre del usuario si lo lleva
+        - teclado(clave): ReplyKeyboardMarkup compartido. No se debe modificar
+        - noEntendi(nombre): frase aleatoria de [mensajes] no_entendi_*
+        - tecladoLista(opciones): teclado con una opción por fila, que se construye una vez para cada lista
+    """
+
+    def __init__(self, config):
+        self.textos = {clave: emoji.emojize(texto, use_aliases=True) for clave, texto in TEXTOS.items()}
+        self.textos.update(TEXTOS_PLANOS)
+        self.textos["prep_recogida"] = emoji.emojize(config.get("mensajes", "prep_recogida", fallback=""))
+
+        self.teclados = {clave: ReplyKeyboardMarkup(tuple(tuple(fila) for fila in filas), one_time_keyboard=True)
+                         for clave, filas in TECLADOS.items()}
+        self.teclados["contacto"] = ReplyKeyboardMarkup(((KeyboardButton(text="Enviar Contacto", request_contact=True),),))
+        self.teclados["quitar"] = ReplyKeyboardRemove()
+        self._listas = {}
+
+        self.noEntendiPrimera = tuple(emoji.emojize(config.get("mensajes", "no_entendi_1_%s" % i, fallback="")) for i in (1, 2, 3))
+        self.noEntendiSegunda = tuple(emoji.emojize(config.get("mensajes", "no_entendi_2_%s" % i, fallback="")) for i in (1, 2, 3))
+
+    def texto(self, clave, nombre=None):
+        texto = self.textos[clave]
+        if nombre is not None:
+            return texto.format(nombre=nombre)
+        return texto
+
+    def teclado(self, clave):
+        return self.teclados[clave]
+
+    def tecladoLista(self, opciones):
+        opciones = tuple(opciones)
+        teclado = self._listas.get(opciones)
+        if teclado is None:
+            teclado = self._listas[opciones] = ReplyKeyboardMarkup(tuple((opcion,) for opcion in opciones),
+                    one_time_keyboard=True)
+        return teclado
+
+    def noEntendi(self, nombre):
+        return random.choice(self.noEntendiPrimera) + nombre + random.choice(self.noEntendiSegunda)
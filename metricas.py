@@ -0,0 +1,257 @@
+""" Métricas de RespiraBot en formato de texto de Prometheus.
+Los módulos declaran sus métricas al importarse (contadores, histogramas y gauges calculados) y todas
+quedan en REGISTRY. MetricsServer las sirve en http://<listen>:<port>/metrics.
+Registrar un valor es una suma bajo un lock, del orden de un microsegundo, para poder hacerlo en cada update.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("respirabot.metricas")
+
+# Buckets en segundos para latencias de handlers (de 100us a 10s)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Registry:
+    """ Conjunto de métricas que se exportan juntas """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Todas las métricas en el formato de texto de Prometheus """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """ Métrica hija para esos valores de las etiquetas. Se puede guardar para no buscarla cada vez """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._newChild())
+        return child
+
+    def items(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """ Contador que solo crece """
+    type = "counter"
+
+    def _newChild(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def value(self, *values):
+        return self.labels(*values).value
+
+    def samples(self):
+        return ["%s%s %s" % (self.name, _labels(self.labelnames, values), child.value)
+                for values, child in self.items()]
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """ Context manager que mide lo que tarda el bloque """
+        return _Timer(self)
+
+    def quantile(self, q):
+        """ Estimación del cuantil q a partir de los buckets (límite superior del bucket) """
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return None
+        objetivo = q * total
+        acumulado = 0
+        for i, c in enumerate(counts):
+            acumulado += c
+            if acumulado >= objetivo:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class _Timer:
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Histogram(_Metric):
+    """ Histograma con buckets acumulados al exportar, como en Prometheus """
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def _newChild(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        lines = []
+        for values, child in self.items():
+            with child._lock:
+                counts = list(child.counts)
+                total, suma = child.count, child.sum
+            acumulado = 0
+            for limite, c in zip(self.buckets + (float("inf"),), counts):
+                acumulado += c
+                le = "+Inf" if limite == float("inf") else repr(limite)
+                lines.append("%s_bucket%s %s" % (self.name, _labels(self.labelnames, values, [("le", le)]), acumulado))
+            lines.append("%s_sum%s %s" % (self.name, _labels(self.labelnames, values), suma))
+            lines.append("%s_count%s %s" % (self.name, _labels(self.labelnames, values), total))
+        return lines
+
+
+class Gauge(_Metric):
+    """ Valor que se calcula en el momento de exportar llamando a una función por cada etiqueta """
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self._functions = {}
+
+    def setFunction(self, function, *values):
+        """ function() devuelve el valor del gauge con esas etiquetas """
+        with self._lock:
+            self._functions[values] = function
+
+    def value(self, *values):
+        function = self._functions.get(values)
+        return function() if function is not None else None
+
+    def items(self):
+        with self._lock:
+            return list(self._functions.items())
+
+    def samples(self):
+        lines = []
+        for values, function in self.items():
+            try:
+                lines.append("%s%s %s" % (self.name, _labels(self.labelnames, values), function()))
+            except Exception:
+                logger.exception("Error calculando el gauge %s", self.name)
+        return lines
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """ Servidor HTTP que devuelve REGISTRY.render() en /metrics """
+
+    daemon_threads = True
+
+    def __init__(self, listen, port, registry=REGISTRY):
+        super().__init__((listen, port), _MetricsHandler)
+        self.registry = registry
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="metricas", daemon=True)
+        self._thread.start()
+        host, port = self.server_address[:2]
+        logger.info("Métricas en http://%s:%s/metrics", host, port)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = self.server.registry.render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
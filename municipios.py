@@ -0,0 +1,228 @@
+""" Municipios de Álava, Bizkaia y Gipuzkoa para reconocer lo que escribe el voluntario en el paso municipio.
+MUNICIPIOS tiene el nombre oficial de cada municipio seguido de otras formas habituales de escribirlo
+(castellano, euskera, nombres antiguos). Los nombres oficiales dobles ("Donostia / San Sebastián")
+aceptan también cada una de sus partes.
+
+Gazetteer indexa todos los nombres normalizados al arrancar:
+- un diccionario para las coincidencias exactas
+- un trie de prefijos para lo que se ha escrito a medias ("Donos")
+- un índice de trigramas de caracteres para las erratas ("Donostai", "Bilbo")
+Cada búsqueda se limita a la provincia elegida antes, salvo los nombres exactos de otra provincia, que
+se proponen primero, y tarda bastante menos de un milisegundo.
+"""
+
+from collections import defaultdict
+
+from flujo import normalizar
+
+MUNICIPIOS = {
+    "Álava": (
+        "Alegría-Dulantzi|Alegría|Dulantzi", "Amurrio", "Añana|Gesaltza Añana", "Aramaio|Aramayona",
+        "Armiñón", "Arraia-Maeztu|Maeztu", "Arratzua-Ubarrundia|Ubarrundia", "Artziniega|Arceniega",
+        "Asparrena", "Ayala / Aiara", "Baños de Ebro / Mañueta", "Barrundia", "Berantevilla", "Bernedo",
+        "Campezo / Kanpezu|Santa Cruz de Campezo", "Elburgo / Burgelu", "Elciego|Eltziego", "Elvillar / Bilar",
+        "Harana / Valle de Arana", "Iruña Oka / Iruña de Oca|Nanclares de la Oca", "Iruraiz-Gauna",
+        "Kripan|Cripán", "Kuartango|Cuartango", "Labastida / Bastida", "Lagrán", "Laguardia|Biasteri",
+        "Lanciego / Lantziego", "Lantarón", "Lapuebla de Labarca|Lapuebla", "Laudio / Llodio",
+        "Legutio|Villarreal de Álava", "Leza", "Moreda de Álava / Moreda Araba", "Navaridas", "Okondo|Oquendo",
+        "Oyón-Oion|Oyón|Oion", "Peñacerrada-Urizaharra|Peñacerrada", "Ribera Alta / Erriberagoitia",
+        "Ribera Baja / Erribera Beitia", "Salvatierra / Agurain", "Samaniego", "San Millán / Donemiliaga",
+        "Urkabustaiz", "Valdegovía / Gaubea", "Villabuena de Álava / Eskuernaga|Villabuena",
+        "Vitoria-Gasteiz|Vitoria|Gasteiz", "Yécora / Iekora", "Zalduondo", "Zambrana", "Zigoitia", "Zuia",
+    ),
+    "Bizkaia": (
+        "Abadiño|Abadiano", "Abanto y Ciérvana-Abanto Zierbena|Abanto|Abanto Zierbena", "Ajangiz",
+        "Alonsotegi", "Amorebieta-Etxano|Amorebieta|Etxano|Zornotza", "Amoroto", "Arakaldo", "Arantzazu",
+        "Areatza|Villaro", "Arrankudiaga", "Arratzu", "Arrieta", "Arrigorriaga", "Artea", "Artzentales",
+        "Atxondo", "Aulesti", "Bakio|Baquio", "Balmaseda|Valmaseda", "Barakaldo|Baracaldo", "Barrika",
+        "Basauri", "Bedia", "Berango", "Bermeo", "Berriatua", "Berriz", "Bilbao|Bilbo", "Busturia",
+        "Derio", "Dima", "Durango", "Ea", "Elantxobe", "Elorrio", "Erandio", "Ereño", "Ermua",
+        "Errigoiti", "Etxebarri|Echévarri", "Etxebarria", "Forua", "Fruiz", "Galdakao|Galdácano",
+        "Galdames", "Gamiz-Fika", "Garai", "Gatika", "Gautegiz Arteaga", "Gernika-Lumo|Gernika|Guernica",
+        "Getxo|Guecho|Algorta|Las Arenas|Areeta", "Gizaburuaga", "Gordexola", "Gorliz", "Güeñes", "Ibarrangelu",
+        "Igorre", "Ispaster", "Iurreta", "Izurtza", "Karrantza Harana / Valle de Carranza|Karrantza|Carranza",
+        "Kortezubi", "Lanestosa", "Larrabetzu", "Laukiz", "Leioa|Lejona", "Lekeitio|Lequeitio", "Lemoa",
+        "Lemoiz", "Lezama", "Loiu", "Mallabia", "Mañaria", "Markina-Xemein|Markina|Marquina", "Maruri-Jatabe",
+        "Mendata", "Mendexa", "Meñaka", "Morga", "Mundaka", "Mungia|Munguía", "Munitibar-Arbatzegi Gerrikaitz|Munitibar",
+        "Murueta", "Muskiz|Musques", "Muxika", "Nabarniz", "Ondarroa|Ondárroa", "Orozko", "Ortuella",
+        "Otxandio|Ochandiano", "Plentzia|Plencia", "Portugalete", "Santurtzi|Santurce", "Sestao", "Sondika",
+        "Sopela|Sopelana", "Sopuerta", "Sukarrieta", "Trucios-Turtzioz|Trucios|Turtzioz", "Ubide",
+        "Ugao-Miraballes|Ugao|Miravalles", "Urduliz", "Urduña / Orduña", "Valle de Trápaga-Trapagaran|Trapagaran|Trápaga",
+        "Zaldibar", "Zalla", "Zamudio", "Zaratamo", "Zeanuri", "Zeberio", "Zierbena", "Ziortza-Bolibar|Bolibar",
+    ),
+    "Gipuzkoa": (
+        "Abaltzisketa", "Aduna", "Aia", "Aizarnazabal", "Albiztur", "Alegia", "Alkiza", "Altzaga", "Altzo",
+        "Amezketa", "Andoain|Andoáin", "Anoeta", "Antzuola", "Arama", "Aretxabaleta|Arechavaleta",
+        "Arrasate / Mondragón", "Asteasu", "Astigarraga", "Ataun", "Azkoitia|Azcoitia", "Azpeitia", "Baliarrain",
+        "Beasain|Beasáin", "Beizama", "Belauntza", "Berastegi", "Bergara|Vergara", "Berrobi", "Bidania-Goiatz",
+        "Deba|Deva", "Donostia / San Sebastián|Donosti|Donostia-San Sebastián", "Eibar", "Elduain", "Elgeta",
+        "Elgoibar", "Errenteria|Rentería", "Errezil", "Eskoriatza|Escoriaza", "Ezkio-Itsaso", "Gabiria",
+        "Gaintza", "Gaztelu", "Getaria|Guetaria", "Hernani", "Hernialde", "Hondarribia|Fuenterrabía", "Ibarra",
+        "Idiazabal", "Ikaztegieta", "Irun", "Irura", "Itsasondo", "Larraul", "Lasarte-Oria|Lasarte",
+        "Lazkao|Lazcano", "Leaburu", "Legazpi|Legazpia", "Legorreta", "Leintz-Gatzaga|Salinas de Léniz",
+        "Lezo", "Lizartza", "Mendaro", "Mutiloa", "Mutriku|Motrico", "Oiartzun|Oyarzun", "Olaberria",
+        "Oñati|Oñate", "Ordizia|Villafranca de Ordicia", "Orendain", "Orexa", "Orio", "Ormaiztegi",
+        "Pasaia|Pasajes", "Segura", "Soraluze-Placencia de las Armas|Soraluze|Placencia", "Tolosa", "Urnieta",
+        "Urretxu", "Usurbil", "Villabona", "Zaldibia", "Zarautz|Zarauz", "Zegama|Cegama", "Zerain",
+        "Zestoa|Cestona", "Zizurkil", "Zumaia|Zumaya", "Zumarraga",
+    ),
+}
+
+# Formas de escribir cada provincia
+PROVINCIAS = {
+    "Álava": ("Álava", "Araba", "Araba/Álava", "Alava"),
+    "Bizkaia": ("Bizkaia", "Vizcaya", "Biscay"),
+    "Gipuzkoa": ("Gipuzkoa", "Guipúzcoa", "Guipuzcoa"),
+}
+
+# Puntuaciones de las coincidencias
+EXACTA = 1.0
+PREFIJO_UNICO = 0.9
+PREFIJO = 0.8
+# Similitud mínima de trigramas para proponer un municipio y para darlo por bueno sin preguntar
+MIN_PARECIDO = 0.45
+PARECIDO_SEGURO = 0.75
+# Diferencia mínima con el segundo candidato para no preguntar
+VENTAJA = 0.15
+# Letras mínimas para buscar por prefijo y para dar por bueno un prefijo sin preguntar
+MIN_PREFIJO = 3
+MIN_PREFIJO_SEGURO = 5
+
+
+def trigramas(texto):
+    texto = " %s " % texto
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+
+class Match:
+    """ Municipio candidato: nombre oficial, provincia y puntuación entre 0 y 1 """
+    __slots__ = ("municipio", "provincia", "score")
+
+    def __init__(self, municipio, provincia, score):
+        self.municipio = municipio
+        self.provincia = provincia
+        self.score = score
+
+    def __repr__(self):
+        return "Match(%r, %r, %.2f)" % (self.municipio, self.provincia, self.score)
+
+
+class _Nodo:
+    __slots__ = ("hijos", "municipios")
+
+    def __init__(self):
+        self.hijos = {}
+        self.municipios = set()
+
+
+class Gazetteer:
+    """ Índice de los municipios de MUNICIPIOS
+        - lookup(texto, provincia, limite): candidatos ordenados de mejor a peor
+        - resolve(texto, provincia): (nombre oficial si no hay duda o None, candidatos). Si no hay nada
+          en la provincia, los candidatos son los de las otras provincias, pero nunca se dan por buenos
+        - provincia(texto): nombre de la provincia en MUNICIPIOS o None
+    """
+
+    def __init__(self, municipios=MUNICIPIOS, provincias=PROVINCIAS):
+        self._provincias = {normalizar(forma): nombre for nombre, formas in provincias.items() for forma in formas}
+        self._municipios = []                  # id -> (nombre oficial, provincia)
+        self._exactos = defaultdict(set)       # nombre normalizado -> ids
+        self._raiz = _Nodo()
+        self._trigramas = defaultdict(set)     # trigrama -> ids de variante
+        self._variantes = []                   # id de variante -> (nombre normalizado, trigramas, id de municipio)
+
+        for provincia, lista in municipios.items():
+            for entrada in lista:
+                nombres = entrada.split("|")
+                municipioId = len(self._municipios)
+                self._municipios.append((nombres[0], provincia))
+                formas = set(nombres)
+                for nombre in nombres:
+                    formas.update(parte for parte in nombre.split("/"))
+                for forma in {normalizar(f) for f in formas if f.strip()}:
+                    self._add(forma, municipioId)
+
+    def _add(self, forma, municipioId):
+        self._exactos[forma].add(municipioId)
+
+        nodo = self._raiz
+        for letra in forma:
+            nodo = nodo.hijos.setdefault(letra, _Nodo())
+            nodo.municipios.add(municipioId)
+
+        varianteId = len(self._variantes)
+        grams = trigramas(forma)
+        self._variantes.append((forma, grams, municipioId))
+        for gram in grams:
+            self._trigramas[gram].add(varianteId)
+
+    def provincia(self, texto):
+        return self._provincias.get(normalizar(texto or ""))
+
+    def _enProvincia(self, municipioId, provincia):
+        return provincia is None or self._municipios[municipioId][1] == provincia
+
+    def lookup(self, texto, provincia=None, limite=3):
+        """ Municipios que pueden corresponder a texto, dentro de provincia si se indica """
+        provincia = self.provincia(provincia) if provincia else None
+        forma = normalizar(texto or "")
+        if not forma:
+            return []
+        scores = {}
+
+        for municipioId in self._exactos.get(forma, ()):
+            if self._enProvincia(municipioId, provincia):
+                scores[municipioId] = EXACTA
+
+        if not scores and len(forma) >= MIN_PREFIJO:
+            nodo = self._raiz
+            for letra in forma:
+                nodo = nodo.hijos.get(letra)
+                if nodo is None:
+                    break
+            if nodo is not None:
+                candidatos = [m for m in nodo.municipios if self._enProvincia(m, provincia)]
+                score = PREFIJO_UNICO if len(candidatos) == 1 else PREFIJO
+                for municipioId in candidatos:
+                    scores[municipioId] = score
+
+        if not scores:
+            grams = trigramas(forma)
+            comunes = defaultdict(int)
+            for gram in grams:
+                for varianteId in self._trigramas.get(gram, ()):
+                    comunes[varianteId] += 1
+            for varianteId, n in comunes.items():
+                nombre, gramsVariante, municipioId = self._variantes[varianteId]
+                if not self._enProvincia(municipioId, provincia):
+                    continue
+                # Coeficiente de Dice entre los trigramas de lo escrito y los del nombre
+                parecido = 2.0 * n / (len(grams) + len(gramsVariante))
+                if parecido >= MIN_PARECIDO and parecido > scores.get(municipioId, 0):
+                    scores[municipioId] = parecido
+
+        mejores = sorted(scores.items(), key=lambda item: (-item[1], self._municipios[item[0]][0]))[:limite]
+        return [Match(self._municipios[m][0], self._municipios[m][1], score) for m, score in mejores]
+
+    def resolve(self, texto, provincia=None, limite=3):
+        """ (nombre oficial, candidatos). El nombre es None si no hay ningún candidato claro
+            Un nombre exacto de otra provincia no se acepta sin preguntar, pero se propone el primero,
+            antes que los parecidos de la provincia elegida ("Eibar" con Bizkaia)
+        """
+        candidatos = self.lookup(texto, provincia, limite)
+        if provincia and not (candidatos and candidatos[0].score == EXACTA):
+            otras = [match for match in self.lookup(texto, None, limite) if match.score == EXACTA]
+            if otras:
+                nombres = {match.municipio for match in otras}
+                return None, (otras + [match for match in candidatos if match.municipio not in nombres])[:limite]
+        if not candidatos:
+            return None, self.lookup(texto, None, limite) if provincia else candidatos
+        mejor = candidatos[0]
+        segundo = candidatos[1].score if len(candidatos) > 1 else 0.0
+        if mejor.score == EXACTA and segundo < EXACTA:
+            return mejor.municipio, candidatos
+        if mejor.score >= PREFIJO_UNICO and len(candidatos) == 1 and len(normalizar(texto)) >= MIN_PREFIJO_SEGURO:
+            return mejor.municipio, candidatos
+        if mejor.score >= PARECIDO_SEGURO and mejor.score - segundo >= VENTAJA:
+            return mejor.municipio, candidatos
+        return None, candidatos
@@ -0,0 +1,147 @@
+""" Perfilado bajo demanda de los handlers de la conversación de RespiraBot.
+Cuando sube la latencia de las respuestas, HandlerProfiler dice en qué se va el tiempo (emoji, teclados,
+logs...) sin parar el bot. Apagado, a cada handler solo le cuesta mirar el atributo activo. Encendido,
+una fracción muestreo de los updates se atiende con cProfile y los tiempos se suman por paso; al parar
+(o al acabar la duración) se escriben en logs/ en texto y en formato pstats.
+
+Se enciende con /perfil o con señales, también en los procesos trabajadores:
+    kill -USR1 <pid>     # empieza con [perfil] muestreo y duracion
+    kill -USR2 <pid>     # para y escribe los resultados
+El .prof se puede abrir con python3 -m pstats logs/perfil-....prof o con snakeviz.
+"""
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger("respirabot.perfilado")
+
+# Funciones de cada paso en el resumen de texto
+LINEAS = 25
+
+
+class HandlerProfiler:
+    """ Perfilador de handlers que se enciende y se apaga en marcha
+        - directorio: carpeta donde se escriben los resultados (logs/)
+        - prefijo: nombre de los ficheros, <prefijo>-<fecha>.txt y .prof (ej. perfil-2 en el trabajador 2)
+        - activo: si es False, call() no se usa; medido() lo mira antes de llamar al handler
+        - start(muestreo, segundos): fracción de updates que se perfila y segundos hasta parar (0 = hasta stop())
+        - call(nombre, callback, update, context): atiende el update, perfilado si le toca por muestreo
+        - stop(): apaga y escribe lo acumulado. Devuelve la ruta del .txt, o None si no había muestras
+        Se perfila un update a la vez: cProfile solo sigue al hilo que lo activa y en Python 3.12 no
+        admite dos a la vez. Los que llegan mientras tanto se atienden sin perfilar
+    """
+
+    def __init__(self, directorio, prefijo="perfil", clock=time.monotonic):
+        self.directorio = directorio
+        self.prefijo = prefijo
+        self.clock = clock
+        self.activo = False
+        self.muestreo = 0.0
+        self._lock = threading.Lock()           # cProfile en uso
+        self._estadoLock = threading.Lock()     # start/stop y lo acumulado
+        self._perfiles = {}                     # paso -> cProfile.Profile, que acumula entre llamadas
+        self._muestras = {}                     # paso -> updates perfilados
+        self._desde = None
+        self._temporizador = None
+        self.ocupado = 0
+        self.ficheros = []
+
+    def start(self, muestreo, segundos=0):
+        """ Empieza a perfilar, o cambia el muestreo y la duración si ya estaba encendido """
+        with self._estadoLock:
+            self.muestreo = min(1.0, max(0.0, muestreo))
+            if not self.activo:
+                self._perfiles = {}
+                self._muestras = {}
+                self.ocupado = 0
+                self._desde = self.clock()
+            if self._temporizador is not None:
+                self._temporizador.cancel()
+                self._temporizador = None
+            if segundos:
+                self._temporizador = threading.Timer(segundos, self.stop)
+                self._temporizador.daemon = True
+                self._temporizador.start()
+            self.activo = True
+        logger.warning("Perfilado de handlers encendido: %s%% de los updates%s", round(self.muestreo * 100, 2),
+                " durante %s s" % segundos if segundos else "")
+
+    def call(self, nombre, callback, update, context):
+        if random.random() >= self.muestreo:
+            return callback(update, context)
+        if not self._lock.acquire(blocking=False):
+            self.ocupado += 1
+            return callback(update, context)
+        try:
+            perfil = self._perfiles.get(nombre)
+            if perfil is None:
+                perfil = self._perfiles[nombre] = cProfile.Profile()
+            self._muestras[nombre] = self._muestras.get(nombre, 0) + 1
+            perfil.enable()
+            try:
+                return callback(update, context)
+            finally:
+                perfil.disable()
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        """ Apaga el perfilado y escribe los resultados """
+        with self._estadoLock:
+            if not self.activo:
+                return None
+            self.activo = False
+            if self._temporizador is not None:
+                self._temporizador.cancel()
+                self._temporizador = None
+            segundos = self.clock() - self._desde
+        # Un update que se está perfilando ahora termina antes de leer los perfiles
+        with self._lock:
+            perfiles, muestras = self._perfiles, self._muestras
+            self._perfiles, self._muestras = {}, {}
+        stats = {nombre: pstats.Stats(perfil) for nombre, perfil in perfiles.items()}
+        if not stats:
+            logger.warning("Perfilado de handlers apagado sin ningún update perfilado")
+            return None
+        path = self.write(stats, muestras, segundos)
+        self.ficheros.append(path)
+        logger.warning("Perfilado de handlers apagado: %s updates perfilados, resultados en %s",
+                sum(muestras.values()), path)
+        return path
+
+    def write(self, stats, muestras, segundos):
+        """ Escribe <prefijo>-<fecha>.txt con lo que más tarda en cada paso y en total, y el .prof con todo """
+        base = os.path.join(self.directorio, "%s-%s" % (self.prefijo, datetime.now().strftime("%Y%m%d-%H%M%S")))
+        otro = 1
+        while os.path.exists(base + ".txt"):
+            otro += 1
+            base = base.rsplit("~", 1)[0] + "~%s" % otro
+        salida = io.StringIO()
+        total = pstats.Stats(stream=salida)
+        salida.write("Perfilado de handlers: %.0f s, muestreo %s, %s updates perfilados, %s sin perfilar por "
+                "coincidir con otro\n" % (segundos, self.muestreo, sum(muestras.values()), self.ocupado))
+        for nombre in sorted(stats, key=lambda nombre: -stats[nombre].total_tt):
+            paso = stats[nombre]
+            salida.write("\n=== %s: %s updates, %.3f ms de media ===\n" % (nombre, muestras[nombre],
+                    paso.total_tt * 1000 / muestras[nombre]))
+            paso.stream = salida
+            paso.sort_stats("cumulative").print_stats(LINEAS)
+            total.add(paso)
+        salida.write("\n=== Todos los pasos, por tiempo propio de cada función ===\n")
+        total.sort_stats("tottime").print_stats(LINEAS)
+        total.dump_stats(base + ".prof")
+        with open(base + ".txt", "w", encoding="utf8") as f:
+            f.write(salida.getvalue())
+        return base + ".txt"
+
+    def stats(self):
+        with self._estadoLock:
+            return {"activo": self.activo, "muestreo": self.muestreo, "perfilados": sum(self._muestras.values()),
+                    "sin_perfilar": self.ocupado, "ficheros": list(self.ficheros)}
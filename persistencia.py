@@ -0,0 +1,244 @@
+""" Persistencia de las conversaciones de RespiraBot en SQLite.
+Guarda el paso de cada conversación y los datos de context.user_data para que un reinicio o un
+despliegue no corte a los voluntarios que están a mitad de Confirmar o Programar.
+- Solo se escriben las conversaciones y las claves de user_data que han cambiado en cada update
+- Los usuarios se cargan de la base de datos la primera vez que escriben después de arrancar
+- Lo que lleva más de conversation_timeout segundos sin cambios se considera caducado y se borra
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+from usuarios import UserDataStore
+
+logger = logging.getLogger("respirabot.persistencia")
+
+
+class SQLitePersistence(BasePersistence):
+    """ BasePersistence de python-telegram-bot sobre SQLite con escrituras incrementales
+        Solo guarda user_data y conversaciones; chat_data y bot_data no se usan en el bot.
+        Los valores de user_data tienen que poder pasarse a JSON.
+    """
+
+    def __init__(self, path, timeout):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.path = path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # Último valor escrito de cada clave de user_data, para escribir solo lo que cambia
+        self._written = {}
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (name, key)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS user_data (
+                user_id INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (user_id, key)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated);
+            CREATE INDEX IF NOT EXISTS user_data_updated ON user_data (updated);
+        """)
+
+        self.loads = 0
+        self.rowsWritten = 0
+        self.expire()
+
+    # Los datos del bot son textos y números, así que no hace falta buscar y sustituir el objeto Bot
+    def insert_bot(self, obj):
+        return obj
+
+    def replace_bot(self, obj):
+        return obj
+
+    def expire(self):
+        """ Borra las conversaciones y datos de usuario sin cambios en los últimos timeout segundos.
+            Se llama al arrancar, al parar y cada [usuarios] intervalo segundos
+        """
+        cutoff = time.time() - self.timeout
+        with self._lock:
+            conversations = self._db.execute("DELETE FROM conversations WHERE updated < ?", (cutoff,)).rowcount
+            userIds = [userId for userId, in self._db.execute(
+                    "SELECT user_id FROM user_data GROUP BY user_id HAVING MAX(updated) < ?", (cutoff,))]
+            users = self._db.execute("DELETE FROM user_data WHERE user_id IN "
+                    "(SELECT user_id FROM user_data GROUP BY user_id HAVING MAX(updated) < ?)", (cutoff,)).rowcount
+        for userId in userIds:
+            self._written.pop(userId, None)
+        if conversations or users:
+            logger.info("Persistencia: %s conversaciones y %s datos de usuario caducados", conversations, users)
+
+    # user_data
+    def get_user_data(self):
+        """ Cada usuario se carga de SQLite la primera vez que se usa """
+        return UserDataStore(maxSize=0, loader=self.loadUserData)
+
+    def loadUserData(self, userId):
+        cutoff = time.time() - self.timeout
+        with self._lock:
+            rows = self._db.execute("SELECT key, value, updated FROM user_data WHERE user_id = ?", (userId,)).fetchall()
+        if not rows or max(updated for _, _, updated in rows) < cutoff:
+            return {}
+        self.loads += 1
+        self._written[userId] = {key: value for key, value, _ in rows}
+        return {key: json.loads(value) for key, value, _ in rows}
+
+    def update_user_data(self, user_id, data):
+        previous = self._written.get(user_id, {})
+        current = {key: json.dumps(value, ensure_ascii=False) for key, value in data.items()}
+        changed = [(user_id, key, value) for key, value in current.items() if previous.get(key) != value]
+        removed = [(user_id, key) for key in previous if key not in current]
+        if not changed and not removed:
+            return
+
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT OR REPLACE INTO user_data VALUES (?, ?, ?, ?)",
+                    [row + (now,) for row in changed])
+            self._db.executemany("DELETE FROM user_data WHERE user_id = ? AND key = ?", removed)
+            self._db.execute("COMMIT")
+            self.rowsWritten += len(changed) + len(removed)
+        if current:
+            self._written[user_id] = current
+        else:
+            self._written.pop(user_id, None)
+
+    def forget(self, userId):
+        """ El usuario ya no está en memoria (UserDataStore.sweep): se olvida lo último escrito, que se
+            vuelve a leer si se carga otra vez. Sus filas se quedan hasta que caducan
+        """
+        self._written.pop(userId, None)
+
+    def drop_user_data(self, user_id):
+        """ Olvida los datos de un usuario en memoria y en la base de datos """
+        with self._lock:
+            self._db.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+        self._written.pop(user_id, None)
+
+    # Conversaciones
+    def get_conversations(self, name):
+        return _LazyConversations(self, name)
+
+    def _loadConversation(self, name, key):
+        cutoff = time.time() - self.timeout
+        with self._lock:
+            row = self._db.execute("SELECT state FROM conversations WHERE name = ? AND key = ? AND updated >= ?",
+                    (name, json.dumps(key), cutoff)).fetchone()
+        if row is None:
+            return None
+        self.loads += 1
+        return json.loads(row[0])
+
+    def storedConversations(self, name):
+        """ [(key, updated)] de las conversaciones de name sin caducar, para programar su caducidad al arrancar """
+        cutoff = time.time() - self.timeout
+        with self._lock:
+            rows = self._db.execute("SELECT key, updated FROM conversations WHERE name = ? AND updated >= ?",
+                    (name, cutoff)).fetchall()
+        return [(tuple(json.loads(key)), updated) for key, updated in rows]
+
+    def update_conversation(self, name, key, new_state):
+        with self._lock:
+            if new_state is None:
+                self._db.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+            else:
+                self._db.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)",
+                        (name, json.dumps(key), json.dumps(new_state), time.time()))
+            self.rowsWritten += 1
+
+    # chat_data y bot_data no se guardan
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def refresh_user_data(self, user_id, user_data):
+        pass
+
+    def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    def refresh_bot_data(self, bot_data):
+        pass
+
+    def flush(self):
+        """ Se llama al parar el bot. Las escrituras ya están hechas, solo se limpia lo caducado """
+        self.expire()
+        logger.info("Persistencia: %s filas escritas, %s usuarios cargados", self.rowsWritten, self.loads)
+
+    def stats(self):
+        return {"rows_written": self.rowsWritten, "loads": self.loads}
+
+
+class _LazyConversations(dict):
+    """ Conversaciones de un ConversationHandler que se cargan de SQLite la primera vez que se consultan
+        Las claves que no están en SQLite se recuerdan, así cada una se busca como mucho una vez:
+        ConversationHandler la consulta con cada mensaje de quien no está en una conversación
+    """
+
+    def __init__(self, persistence, name):
+        super().__init__()
+        self._persistence = persistence
+        self._name = name
+        self._ausentes = set()
+
+    def stored(self):
+        """ [(key, updated)] de las conversaciones a medias guardadas en SQLite, y las carga """
+        stored = self._persistence.storedConversations(self._name)
+        for key, _ in stored:
+            self._load(key)
+        return stored
+
+    def _load(self, key):
+        if not dict.__contains__(self, key) and key not in self._ausentes:
+            state = self._persistence._loadConversation(self._name, key)
+            if state is not None:
+                dict.__setitem__(self, key, state)
+            else:
+                self._ausentes.add(key)
+
+    def __setitem__(self, key, state):
+        self._ausentes.discard(key)
+        dict.__setitem__(self, key, state)
+
+    # Al terminar una conversación también se borra de SQLite (update_conversation con None)
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._ausentes.add(key)
+
+    def pop(self, key, *default):
+        self._ausentes.add(key)
+        return dict.pop(self, key, *default)
+
+    def get(self, key, default=None):
+        self._load(key)
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        self._load(key)
+        return dict.__contains__(self, key)
+
+    def __getitem__(self, key):
+        self._load(key)
+        return dict.__getitem__(self, key)
@@ -0,0 +1,96 @@
+""" Logs de RespiraBot sin bloquear a los handlers.
+Los loggers solo meten cada registro en una cola (QueueHandler) y un hilo en segundo plano
+(QueueListener) los escribe en logs/ en JSON, con rotación por tamaño, y en el terminal en texto.
+Los registros de cada mensaje, que son la mayoría, pueden muestrearse para que un pico de carga no
+llene el disco: se marcan con extra=porMensaje(...) y solo se guarda la fracción indicada en muestreo.
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from datetime import datetime
+
+# Campos de extra= que se copian al JSON si el registro los lleva
+CAMPOS = ("estado", "user_id", "duracion_ms", "hoja", "entry_id")
+
+TEXT_FORMAT = '%(asctime)s - %(funcName)s - %(levelname)s - %(message)s'
+
+
+def porMensaje(estado, userId, **campos):
+    """ extra= para un registro de un mensaje concreto: lleva el paso y el usuario y se puede muestrear """
+    campos.update(estado=estado, user_id=userId, muestreo=True)
+    return campos
+
+
+class JsonFormatter(logging.Formatter):
+    """ Una línea JSON por registro con la hora, el nivel, el logger, la función, el mensaje y los CAMPOS """
+
+    def format(self, record):
+        data = {"ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                "level": record.levelname,
+                "logger": record.name,
+                "func": record.funcName,
+                "msg": record.getMessage()}
+        for campo in CAMPOS:
+            valor = getattr(record, campo, None)
+            if valor is not None:
+                data[campo] = valor
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """ Deja pasar todos los registros salvo los marcados con muestreo, de los que deja una fracción rate """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+        self.descartados = 0
+
+    def filter(self, record):
+        if self.rate >= 1 or not getattr(record, "muestreo", False) or record.levelno >= logging.WARNING:
+            return True
+        if random.random() < self.rate:
+            return True
+        self.descartados += 1
+        return False
+
+
+class LogSetup:
+    """ Configura logger para escribir a través de una cola
+        - path: fichero de log en JSON, rota al llegar a maxBytes y guarda backups ficheros antiguos
+        - level: nivel del logger
+        - console: si también se escribe en el terminal
+        - sampleRate: fracción de los registros de cada mensaje que se guardan
+    """
+
+    def __init__(self, logger, path, level=logging.INFO, maxBytes=10 * 1024 * 1024, backups=5,
+                 console=True, sampleRate=1.0):
+        self.logger = logger
+        self.queue = queue.SimpleQueue()
+        self.sampler = SamplingFilter(sampleRate)
+
+        fileHandler = logging.handlers.RotatingFileHandler(path, maxBytes=maxBytes, backupCount=backups,
+                encoding="utf8")
+        fileHandler.setFormatter(JsonFormatter())
+        handlers = [fileHandler]
+        if console:
+            consoleHandler = logging.StreamHandler()
+            consoleHandler.setFormatter(logging.Formatter(TEXT_FORMAT))
+            handlers.append(consoleHandler)
+
+        self.queueHandler = logging.handlers.QueueHandler(self.queue)
+        self.queueHandler.addFilter(self.sampler)
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+
+        logger.setLevel(level)
+        logger.addHandler(self.queueHandler)
+        self.listener.start()
+
+    def stop(self):
+        """ Escribe lo que quede en la cola y para el hilo. Se llama al parar el bot """
+        self.logger.removeHandler(self.queueHandler)
+        self.listener.stop()
@@ -0,0 +1,189 @@
+""" Reparto de las conversaciones de RespiraBot entre varios procesos.
+El proceso principal recibe los updates (polling o webhook) y los reparte por user_id entre N procesos
+trabajadores, cada uno con su propio dispatcher y ConversationHandler: todos los mensajes de un usuario
+van siempre al mismo proceso y en el orden en que llegaron, así que su conversación no sale de él.
+
+Los trabajadores devuelven las filas terminadas por una cola común y el proceso principal es el único
+que las guarda en el diario y las escribe en Google Sheets, de modo que SheetWriter sigue juntando en
+cada lote las filas de todos los procesos. Los procesos se crean con spawn: cada uno importa el bot
+desde cero en lugar de heredar los hilos del principal.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import zlib
+
+logger = logging.getLogger("respirabot.reparto")
+
+# Mensajes de control por las colas
+FIN = None              # principal -> trabajador: no hay más updates
+LISTO = "listo"         # trabajador -> principal: (LISTO, indice) ya puede recibir updates
+TERMINADO = "fin"       # trabajador -> principal: (TERMINADO, indice, estadísticas) antes de salir
+
+
+def shardFor(userId, procesos):
+    """ Proceso de un user_id. Estable entre ejecuciones mientras no cambie el número de procesos """
+    if isinstance(userId, int):
+        return userId % procesos
+    return zlib.crc32(str(userId).encode("utf8")) % procesos
+
+
+def userIdOf(update):
+    """ Usuario del update, o el chat si no lo tiene (ej. mensajes de canal) """
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return 0
+
+
+class ShardPool:
+    """ Procesos trabajadores con una cola de entrada cada uno y una cola de salida común
+        - objetivo(indice, entrada, salida, *argumentos): lo que ejecuta cada proceso. Tiene que poder
+          importarse desde el hijo (una función de un módulo, no una lambda)
+        - route(update): encola el update en JSON en el proceso de su usuario
+        - onMessage(mensaje): lo que mandan los trabajadores por la salida, atendido en un hilo del principal
+        - stop(timeout): manda FIN, espera a que cada proceso termine y devuelve sus estadísticas
+        Si un proceso muere se vuelve a arrancar al llegar el siguiente update para él
+    """
+
+    def __init__(self, procesos, objetivo, argumentos=(), onMessage=None, queueSize=10000):
+        self.procesos = procesos
+        self.objetivo = objetivo
+        self.argumentos = tuple(argumentos)
+        self.onMessage = onMessage
+        self._contexto = multiprocessing.get_context("spawn")
+        self._entradas = [self._contexto.Queue(queueSize) for _ in range(procesos)]
+        self._salida = self._contexto.Queue()
+        self._procesos = [None] * procesos
+        self._listos = [threading.Event() for _ in range(procesos)]
+        self._lock = threading.Lock()
+        self._lector = None
+        self.estadisticas = {}
+        self.enrutados = [0] * procesos
+        self.reinicios = 0
+
+    def _arrancar(self, indice):
+        self._listos[indice].clear()
+        proceso = self._contexto.Process(target=self.objetivo, name="respirabot-%s" % indice, daemon=True,
+                args=(indice, self._entradas[indice], self._salida) + self.argumentos)
+        proceso.start()
+        self._procesos[indice] = proceso
+        return proceso
+
+    def start(self, timeout=60):
+        """ Arranca los procesos y espera a que todos estén listos """
+        self._lector = threading.Thread(target=self._leer, name="reparto-salida", daemon=True)
+        self._lector.start()
+        for indice in range(self.procesos):
+            self._arrancar(indice)
+        limite = time.monotonic() + timeout
+        for indice, listo in enumerate(self._listos):
+            if not listo.wait(max(0, limite - time.monotonic())):
+                raise RuntimeError("El proceso %s no ha arrancado en %s s" % (indice, timeout))
+        logger.info("%s procesos trabajadores listos", self.procesos)
+
+    def _leer(self):
+        while True:
+            mensaje = self._salida.get()
+            if mensaje is FIN:
+                return
+            tipo = mensaje[0]
+            if tipo == LISTO:
+                self._listos[mensaje[1]].set()
+            elif tipo == TERMINADO:
+                self.estadisticas[mensaje[1]] = mensaje[2]
+            elif self.onMessage is not None:
+                try:
+                    self.onMessage(mensaje)
+                except Exception:
+                    logger.exception("Error atendiendo el mensaje %s de un trabajador", tipo)
+
+    def route(self, update):
+        indice = shardFor(userIdOf(update), self.procesos)
+        proceso = self._procesos[indice]
+        if proceso is None or not proceso.is_alive():
+            with self._lock:
+                proceso = self._procesos[indice]
+                if proceso is None or not proceso.is_alive():
+                    logger.error("El proceso trabajador %s ha terminado (%s), se vuelve a arrancar",
+                            indice, proceso.exitcode if proceso is not None else None)
+                    self.reinicios += 1
+                    self._arrancar(indice)
+        self._entradas[indice].put(update.to_json())
+        self.enrutados[indice] += 1
+        return indice
+
+    def sendSignal(self, signum):
+        """ Manda signum a los procesos que siguen vivos (ej. SIGUSR1 para perfilarlos). Devuelve a cuántos """
+        enviados = 0
+        for proceso in self._procesos:
+            if proceso is not None and proceso.is_alive():
+                os.kill(proceso.pid, signum)
+                enviados += 1
+        return enviados
+
+    def pending(self):
+        """ Updates encolados y aún no recogidos por los trabajadores """
+        total = 0
+        for entrada in self._entradas:
+            try:
+                total += entrada.qsize()
+            except NotImplementedError:
+                return 0
+        return total
+
+    def stop(self, timeout=30):
+        """ Termina los procesos después de que atiendan lo que tienen encolado """
+        for entrada in self._entradas:
+            entrada.put(FIN)
+        limite = time.monotonic() + timeout
+        for indice, proceso in enumerate(self._procesos):
+            if proceso is None:
+                continue
+            proceso.join(max(0, limite - time.monotonic()))
+            if proceso.is_alive():
+                logger.error("El proceso trabajador %s no ha terminado en %s s, se mata", indice, timeout)
+                proceso.terminate()
+        # Lo que hayan mandado los trabajadores antes de salir llega antes que este FIN
+        self._salida.put(FIN)
+        if self._lector is not None:
+            self._lector.join(timeout)
+        return self.estadisticas
+
+    def stats(self):
+        return {"procesos": self.procesos, "enrutados": list(self.enrutados), "reinicios": self.reinicios,
+                "pendientes": self.pending()}
+
+
+def serveShard(dispatcher, entrada, salida, indice):
+    """ Bucle de un proceso trabajador: atiende en orden los updates de entrada hasta recibir FIN.
+        Ignora Ctrl+C y SIGTERM, que llegan a todo el grupo de procesos: es el principal quien lo para.
+        Devuelve (updates atendidos, segundos ocupado)
+    """
+    from telegram import Update
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    salida.put((LISTO, indice))
+
+    atendidos = 0
+    ocupado = 0.0
+    while True:
+        data = entrada.get()
+        if data is FIN:
+            break
+        t0 = time.perf_counter()
+        try:
+            dispatcher.process_update(Update.de_json(json.loads(data), dispatcher.bot))
+        except Exception:
+            logger.exception("Error atendiendo un update en el proceso %s", indice)
+        ocupado += time.perf_counter() - t0
+        atendidos += 1
+    return atendidos, ocupado
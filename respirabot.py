@@ -8,60 +8,323 @@ Instalación de prerequisitos:
 """
 
 import logging
-from telegram import (ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton)
-from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, Handler)
+from telegram import Update
+from telegram.ext import (Updater, CommandHandler, MessageHandler, TypeHandler, Filters, ConversationHandler,
+        DispatcherHandlerStop)
 import os.path
+import signal
 import sys
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import emoji
-from configparser import SafeConfigParser
+import threading
+import time
 from datetime import datetime
-import random
+from sheets import SheetSession, SheetWriter, WritePolicy
+from journal import Journal, JournalReplayer, IdempotencyIndex
+from mensajes import MessageCatalog
+from flujo import ConversationEngine, PROVINCIA, HORARIO, TELEFONO_O_CONTACTO
+from metricas import Counter, Gauge, Histogram, MetricsServer
+from registro import LogSetup, porMensaje
+from esquema import CONFIRMADAS, PROGRAMADAS, schemaFor
+from envios import OutboundScheduler
+from agregados import Aggregates, ETIQUETAS
+from rutas import PickupIndex
+from municipios import Gazetteer
+from caducidad import ExpiringConversationHandler
+from usuarios import UserDataStore
+from difusion import VolunteerDirectory, PENDIENTE, ENVIADO, BLOQUEADO, FALLIDO
+from espejo import SheetMirror
+from configuracion import ConfigWatcher
+from perfilado import HandlerProfiler
+from arranque import (StartupCheck, StartupError, checkArguments, checkDirectory, checkFile,
+        checkServiceAccount, checkTelegram)
 
 __author__ = "Angel Hernandez"
 __credits__ = ["Angel Hernandez", "Joseba Egia"]
 __license__ = "GPL"
 __version__ = "1.0.0"
 __maintainer__ = "Angel Hernandez"
-__email__ = "angel@gaubit.com
+__email__ = "angel@gaubit.com"
 __status__ = "Production"
 
-# Pasos de la conversación: Cada uno de estos pasos va enumerado para la posterior identificacion de la etapa en la que se encuentre la conversación.
-CONFIRMACION_ENTREGA, CONFIRMAR_PROGRAMAR, CANTIDAD_OSAKIDETZA, 
-    MODELO_ANTERIOR, RECEPCION_PLA, BOBINAS_ENTREGADAS, 
-    CANTIDAD_BOBINAS_ENTREGADAS, NO_ENTREGADO, PROVINCIA, DIAMETRO_PLA, 
-    CANTIDAD_OSAKIDETZA_PREPARADA, CANTIDAD_ANTERIOR_PREPARADA, MUNICIPIO, 
-    DIRECCION, HORARIO, TELEFONO = range(16)
-
 # Paths por defecto
 ownName = os.path.basename(__file__)
 ownPath = sys.argv[0].replace('/' + ownName, '')
 logsPath = ownPath + "//logs"
 ownLogPath = logsPath + "//respirabot.log"
+journalPath = logsPath + "//journal.db"
+persistencePath = logsPath + "//conversaciones.db"
+broadcastPath = logsPath + "//difusion.db"
+mirrorPath = logsPath + "//espejo.db"
 clientSecretPath = ownPath + "//client_secret.json"
 configurationPath = ownPath + "//respirabot.ini"
 
-# Lee la configuracion del archivo respirabot.ini
-config = SafeConfigParser()
-config.read(configurationPath, "utf8")
-
-# Set up del logger a un archivo y en el terminal
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-
-fh = logging.FileHandler(ownLogPath) #TODO Make sure this folder exists before doing this
-fh.setLevel(logging.DEBUG)
-
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-
-formatter = logging.Formatter('%(asctime)s - %(funcName)s - %(levelname)s - %(message)s')
-fh.setFormatter(formatter)
-ch.setFormatter(formatter)
-
-logger.addHandler(fh)
-logger.addHandler(ch)
+# Argumentos admitidos: python3 respirabot.py [produccion] [webhook]
+ARGUMENTOS = {"produccion", "webhook"}
+
+# (sección, clave, tipo, obligatoria, defecto) de respirabot.ini. Se comprueban al arrancar y al recargar
+OPCIONES = (
+    ("telegram", "token_produccion", str, False, None),
+    ("telegram", "token_dev", str, False, None),
+    ("telegram", "timeout", int, True, None),
+    ("telegram", "persistencia", bool, False, True),
+    ("telegram", "arranque_timeout", float, False, 30.0),
+    ("telegram", "admins", str, False, ""),
+    ("configuracion", "recarga", float, False, 5.0),
+    ("google", "userDataSheet", str, True, None),
+    ("google", "userDataSheet_backup", str, True, None),
+    ("google", "sheet_confirmadas", str, True, None),
+    ("google", "sheet_programadas", str, True, None),
+    ("google", "batch_size", int, False, 20),
+    ("google", "batch_window", float, False, 2.0),
+    ("google", "flushers", int, False, 1),
+    ("google", "write_timeout", float, False, 10.0),
+    ("google", "write_retries", int, False, 3),
+    ("google", "write_backoff", float, False, 1.0),
+    ("google", "write_backoff_max", float, False, 30.0),
+    ("google", "write_failure_threshold", int, False, 3),
+    ("google", "write_cooldown", float, False, 60.0),
+) + tuple(("google", "backup_" + clave, tipo, False, None) for clave, tipo in (("write_timeout", float),
+        ("write_retries", int), ("write_backoff", float), ("write_backoff_max", float),
+        ("write_failure_threshold", int), ("write_cooldown", float))) + (
+    ("journal", "replay_interval", int, False, 60),
+    ("journal", "compact_interval", int, False, 3600),
+    ("journal", "idempotency_ttl", int, False, 86400),
+    ("journal", "idempotency_size", int, False, 100000),
+    ("webhook", "listen", str, False, "127.0.0.1"),
+    ("webhook", "port", int, False, 8443),
+    ("webhook", "url_path", str, False, "respirabot"),
+    ("webhook", "secret_token", str, False, None),
+    ("webhook", "public_url", str, False, None),
+    ("webhook", "workers", int, False, 4),
+    ("webhook", "queue_size", int, False, 1000),
+    ("envios", "global_rate", float, False, 30.0),
+    ("envios", "global_burst", int, False, 30),
+    ("envios", "chat_rate", float, False, 1.0),
+    ("envios", "chat_burst", int, False, 3),
+    ("envios", "hilos", int, False, 4),
+    ("logging", "level", str, False, "INFO"),
+    ("logging", "max_bytes", int, False, 10 * 1024 * 1024),
+    ("logging", "backups", int, False, 5),
+    ("logging", "console", bool, False, True),
+    ("logging", "muestreo", float, False, 1.0),
+    ("metricas", "listen", str, False, "127.0.0.1"),
+    ("metricas", "port", int, False, 0),
+    ("procesos", "trabajadores", int, False, 0),
+    ("procesos", "cola", int, False, 10000),
+    ("usuarios", "max_usuarios", int, False, 100000),
+    ("usuarios", "ttl", int, False, None),
+    ("usuarios", "intervalo", int, False, 60),
+    ("difusion", "rate", float, False, 20.0),
+    ("difusion", "ventana", int, False, 50),
+    ("espejo", "intervalo", int, False, 300),
+    ("perfil", "muestreo", float, False, 0.05),
+    ("perfil", "duracion", int, False, 600),
+    ("mensajes", "prep_recogida", str, True, None),
+) + tuple(("mensajes", "no_entendi_%s_%s" % (parte, i), str, True, None) for parte in (1, 2) for i in (1, 2, 3))
+
+# Opciones que se aplican sin reiniciar al recargar respirabot.ini (además de todas las de [mensajes]).
+# Los nombres de las pestañas no: las filas pendientes del diario se guardan con el nombre de su pestaña
+EN_CALIENTE = {("telegram", "timeout"), ("telegram", "admins"), ("envios", "global_rate"), ("envios", "global_burst"),
+        ("envios", "chat_rate"), ("envios", "chat_burst"), ("logging", "level"), ("logging", "muestreo"),
+        ("usuarios", "max_usuarios"), ("usuarios", "ttl"), ("difusion", "rate"), ("difusion", "ventana"),
+        ("perfil", "muestreo"), ("perfil", "duracion")}
+
+def leerAdmins(valor):
+    return (valor or "").replace(",", " ").split()
+
+def validarConfig(parser):
+    """ Comprobaciones de respirabot.ini además de las claves y los tipos de OPCIONES """
+    errores = ["[telegram] admins: '%s' no es un user_id" % userId
+               for userId in leerAdmins(parser.get("telegram", "admins", fallback="")) if not userId.isdigit()]
+    if parser.get("logging", "level", fallback="INFO").strip().upper() not in logging._nameToLevel:
+        errores.append("[logging] level = %r no es un nivel de logging" % parser.get("logging", "level"))
+    try:
+        if parser.getint("telegram", "timeout", fallback=1) <= 0:
+            errores.append("[telegram] timeout tiene que ser mayor que 0")
+    except ValueError:
+        pass
+    return errores
+
+# Configuración de respirabot.ini convertida a sus tipos una sola vez (configuracion.py). Se lee siempre de
+# ajustes, que se sustituye entera cuando el fichero cambia y es válido; las claves que falten se comprueban en main()
+configuracion = ConfigWatcher(configurationPath, OPCIONES, validar=validarConfig)
+ajustes = configuracion.current
+
+# Textos y teclados de la conversación, preparados una sola vez
+mensajes = MessageCatalog(ajustes)
+
+# Set up del logger a un archivo en JSON y en el terminal, escritos por un hilo aparte (sección [logging])
+logger = logging.getLogger("respirabot")
+
+def configurarLog(path):
+    return LogSetup(logger, path,
+            level=ajustes.logging.level.upper(),
+            maxBytes=ajustes.logging.max_bytes,
+            backups=ajustes.logging.backups,
+            console=ajustes.logging.console,
+            sampleRate=ajustes.logging.muestreo)
+
+def writePolicy(prefix=""):
+    """ Política de escritura de la sección [google]. Las claves con prefix (ej. backup_write_timeout)
+        sustituyen a las generales (write_timeout) para ese destino
+    """
+    def get(key):
+        return ajustes.get("google", prefix + key, fallback=getattr(ajustes.google, key))
+
+    return WritePolicy(timeout=get("write_timeout"),
+                       retries=get("write_retries"),
+                       backoff=get("write_backoff"),
+                       backoffMax=get("write_backoff_max"),
+                       failureThreshold=get("write_failure_threshold"),
+                       cooldown=get("write_cooldown"))
+
+# Log, sesión de Google Sheets, cola de escritura y diario del proceso principal. Se crean en prepararPrincipal()
+# y no al importar: los trabajadores de reparto.py importan este módulo y no deben abrir los ficheros del principal
+logSetup = None
+sheetSession = None
+sheetWriter = None
+journal = None
+journalReplayer = None
+
+def prepararPrincipal():
+    """ Abre el log respirabot.log, la sesión de Google Sheets compartida (se autoriza en comprobarArranque),
+        la cola de escritura en segundo plano y el diario local. Las colas se arrancan en main()
+        - La hoja principal y la de backup se escriben en paralelo, cada una con su propia política
+        - Cada envío se guarda en el diario antes de mandarlo a la hoja principal y a la de backup
+    """
+    global logSetup, sheetSession, sheetWriter, journal, journalReplayer
+    os.makedirs(logsPath, exist_ok=True)
+    logSetup = configurarLog(ownLogPath)
+    sheetSession = SheetSession(clientSecretPath)
+    sheetWriter = SheetWriter(sheetSession,
+            batchSize=ajustes.google.batch_size,
+            batchWindow=ajustes.google.batch_window,
+            flushers=ajustes.google.flushers,
+            policies={ajustes.google.userDataSheet: writePolicy(),
+                      ajustes.google.userDataSheet_backup: writePolicy("backup_")})
+    journal = Journal(journalPath, [ajustes.google.userDataSheet, ajustes.google.userDataSheet_backup])
+    journalReplayer = JournalReplayer(journal, sheetWriter,
+            replayInterval=ajustes.journal.replay_interval,
+            compactInterval=ajustes.journal.compact_interval)
+
+def pestanas(ajustes):
+    """ Pestaña de cada esquema de esquema.py, y esquema de cada pestaña """
+    sheetNames = {CONFIRMADAS.nombre: ajustes.google.sheet_confirmadas, PROGRAMADAS.nombre: ajustes.google.sheet_programadas}
+    return sheetNames, {sheetNames[schema.nombre]: schema for schema in (CONFIRMADAS, PROGRAMADAS)}
+
+sheetNames, schemasPorHoja = pestanas(ajustes)
+
+# Totales de producción para /resumen, se reconstruyen en main() y se actualizan con cada envío
+agregados = Aggregates()
+# Municipios de Álava, Bizkaia y Gipuzkoa, para la conversación y para /recogidas
+indiceMunicipios = Gazetteer()
+# Recogidas pendientes por municipio y horario para /recogidas
+recogidas = PickupIndex(indiceMunicipios)
+# Voluntarios que han enviado algo, destinatarios de /difundir
+voluntarios = VolunteerDirectory()
+
+# Conversaciones ya guardadas, por (user_id, fecha_inicio, Confirmar/Programar)
+submittedIndex = IdempotencyIndex(ttl=ajustes.journal.idempotency_ttl, maxSize=ajustes.journal.idempotency_size)
+
+# Métricas que se sirven en [metricas] y se resumen con /estado
+HANDLER_LATENCY = Histogram("respirabot_handler_segundos", "Duración de los handlers por paso de la conversación", ["paso"])
+CONVERSACIONES = Counter("respirabot_conversaciones_total", "Conversaciones terminadas por resultado", ["resultado"])
+NO_ENTENDI = Counter("respirabot_no_entendi_total", "Respuestas no entendidas por teclado mostrado", ["teclado"])
+COLAS = Gauge("respirabot_cola", "Elementos esperando en cada cola", ["cola"])
+# Las repetidas descartadas por submittedIndex se cuentan en journal.DUPLICADOS
+IDEMPOTENCIA = Gauge("respirabot_idempotencia_claves", "Conversaciones recordadas para descartar repetidas")
+IDEMPOTENCIA.setFunction(lambda: len(submittedIndex))
+
+def limitesEnvio(procesos=1, reservado=0.0):
+    """ Límites de [envios] para la cola de salida de este proceso. Con varios procesos cada uno se queda
+        con su parte del límite global; el de cada chat no cambia porque un chat siempre está en el mismo proceso
+        - reservado: mensajes por segundo del límite global que usa otro proceso (las difusiones del principal)
+    """
+    return {"globalRate": max(1.0, ajustes.envios.global_rate - reservado) / procesos,
+            "globalBurst": max(1, ajustes.envios.global_burst // procesos),
+            "chatRate": ajustes.envios.chat_rate,
+            "chatBurst": ajustes.envios.chat_burst}
+
+def crearOutbox(procesos=1, reservado=0.0):
+    """ Cola de salida con los límites de limitesEnvio() """
+    global repartoEnvios
+    repartoEnvios = (procesos, reservado)
+    return OutboundScheduler(senders=ajustes.envios.hilos, **limitesEnvio(procesos, reservado))
+
+# Cola de salida hacia Telegram, se arranca en main() con el bot
+repartoEnvios = (1, 0.0)
+outbox = crearOutbox()
+
+def responder(update, texto, teclado=None):
+    """ Contesta en el chat del update a través de la cola de salida """
+    outbox.send(update.effective_chat.id, texto, teclado)
+
+# Usuarios de Telegram que pueden usar los comandos de administración
+admins = {int(userId) for userId in leerAdmins(ajustes.telegram.admins) if userId.isdigit()}
+
+def esAdmin(update):
+    user = update.effective_user
+    return user is not None and user.id in admins
+
+# Perfilado de los handlers bajo demanda (/perfil, SIGUSR1 y SIGUSR2), apagado al arrancar
+perfilador = HandlerProfiler(logsPath)
+
+def medido(nombre, callback):
+    """ Envuelve un handler para medir su duración en respirabot_handler_segundos{paso=nombre}
+        y perfilarlo cuando el perfilador está encendido
+    """
+    histograma = HANDLER_LATENCY.labels(nombre)
+    perfCounter = time.perf_counter
+
+    def handler(update, context):
+        t0 = perfCounter()
+        try:
+            if perfilador.activo:
+                return perfilador.call(nombre, callback, update, context)
+            return callback(update, context)
+        finally:
+            duracion = perfCounter() - t0
+            histograma.observe(duracion)
+            if logger.isEnabledFor(logging.DEBUG):
+                user = update.effective_user
+                logger.debug("Paso %s atendido", nombre,
+                        extra=porMensaje(nombre, user.id if user else None, duracion_ms=round(duracion * 1000, 3)))
+    return handler
+
+# user_data del Dispatcher de este proceso, para aplicar los cambios de [usuarios]
+almacenUsuarios = None
+
+def acotarUserData(dp, timeout):
+    """ user_data del Dispatcher con un registro compacto por usuario y como mucho [usuarios] max_usuarios,
+        que olvida a quien lleva más de [usuarios] ttl segundos sin escribir (por defecto dos timeouts)
+        Con persistencia, un usuario olvidado se vuelve a cargar de SQLite
+    """
+    global almacenUsuarios
+    loader = dp.user_data.loader if isinstance(dp.user_data, UserDataStore) else None
+    dp.user_data = almacenUsuarios = UserDataStore(maxSize=ajustes.usuarios.max_usuarios, ttl=ajustes.usuarios.ttl or 2 * timeout,
+            loader=loader)
+    dp.job_queue.run_repeating(lambda context: olvidarUsuarios(dp),
+            ajustes.usuarios.intervalo, name="usuarios")
+    return dp.user_data
+
+def olvidarUsuarios(dp):
+    """ Job de [usuarios] intervalo: olvida los usuarios liberados o sin escribir en ttl segundos y, con
+        persistencia, lo que se recordaba de ellos y lo que lleva más de timeout segundos en SQLite
+    """
+    olvidados = dp.user_data.sweep()
+    if dp.persistence is not None:
+        for userId in olvidados:
+            dp.persistence.forget(userId)
+        dp.persistence.expire()
+
+def liberarDatos(context, userId):
+    """ La conversación ha terminado: sus datos se vacían, también en la persistencia, y el usuario se
+        olvida en el siguiente barrido
+    """
+    context.user_data.clear()
+    if isinstance(context.dispatcher.user_data, UserDataStore):
+        context.dispatcher.user_data.release(userId)
+    if context.dispatcher.persistence is not None:
+        context.dispatcher.persistence.drop_user_data(userId)
 
 def start(update, context):
     """ Presentacion del Bot y primera pregunta 
@@ -69,607 +332,745 @@ def start(update, context):
         - Siguiente paso: Confirmación de entrega    
     """
     user = update.message.from_user
+    # Nada de una conversación anterior puede acabar en la fila de esta
+    context.user_data.clear()
     context.user_data['fecha_inicio'] = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
     context.user_data['nombre'] = user.first_name
     context.user_data['apellido'] = user.last_name
     context.user_data['user_id'] = user.id
     context.user_data['user_name'] = user.username
     
-    logger.info("Conversación iniciada con %s", user.first_name)
+    logger.info("Conversación iniciada con %s", user.first_name, extra=porMensaje("inicio", user.id))
 
-    reply_keyboard = [["Álava", "Bizkaia", "Gipuzkoa"]]
-    update.message.reply_text(emoji.emojize("Hola, " + update.message.from_user.first_name + 
-            " soy RespiraBot 💨 y estoy aquí para ayudarte a ser más eficiente con los envíos y el material que estamos recogiendo para combatir el 🦠" +
-            "\n Dime en qué provincia estás, por favor."),
-            reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
+    responder(update, mensajes.texto("bienvenida", user.first_name), mensajes.teclado("provincias"))
 
     return PROVINCIA
 
-def provincia(update, context):
-    """ Guarda la información de la provincia de este usuario 
-        - Respuesta Esperada: Si/No
-        - Siguiente paso: Confirmación de entrega    
-    """
-    user = update.message.from_user
-    context.user_data['provincia'] = update.message.text
-
-    logger.info("%s es de %s", user.first_name, update.message.text)
-
-    reply_keyboard = [['Confirmar recogida', 'Programar recogida']]
-    update.message.reply_text(emoji.emojize("\n ¿En que te puedo ayudar?"), 
-            reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
-    
-    return CONFIRMAR_PROGRAMAR
-
-def ConfirmarProgramar(update, context):
-    """ Va a la rama de confirmar o Programar 
-        - Respuesta Esperada: Confirmar/Programar
-        - Siguiente paso: Confirmación de entrega / Programar Recogida    
-    """
-    user = update.message.from_user
-    context.user_data['confirmar_programar'] = update.message.text
-
-    logger.info("%s quiere %s una entrega", user.first_name, update.message.text)
-
-    if any(ans in update.message.text for ans in ("Programar", "programar", "programar recogida", "Programar recogida")):
-        context.user_data['confirmar_programar'] = "Programar"
-        update.message.reply_text(emoji.emojize("\n 👌 Estupendo, me puedes decir cuantas viseras tienes del modelo de Osakidetza?"), 
-                reply_markup=ReplyKeyboardRemove())
-        return CANTIDAD_OSAKIDETZA_PREPARADA
-    
-    if any(ans in update.message.text for ans in ("Confirmar recogida", "confirmar recogida")):
-        context.user_data['confirmar_programar'] = "Confirmar"
-        reply_keyboard = [['Sí', 'No']]
-        update.message.reply_text(emoji.emojize("\n ¿Puedes confirmar la entrega de productos? 🚚"), 
-                reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
-        return CONFIRMACION_ENTREGA
-    
-    noEntendi(update, context, [['Confirmar recogida', 'Programar recogida']])
-    return CONFIRMAR_PROGRAMAR
-
-def cantidadOsakidetzaPreparada(update, context):
-    """ Numero de Viseras Osakidetza
-        - Respuesta Esperada: Numérica
-        - Siguiente paso: Viseras Modelo Anterior
-    """
-    user = update.message.from_user
-    try:
-        int(update.message.text)
-        context.user_data['cantidad_osakidetza_preparada'] = update.message.text
-        
-        logger.info("Cantidad Lista para recoger del modelo Osakidetza de %s: %s", user.first_name, update.message.text)
-
-        update.message.reply_text(emoji.emojize("👍 Estupendo, ¿me puedes decir cuantas tienes listas del modelo anterior?"),
-                        reply_markup=ReplyKeyboardRemove())
-    
-        return CANTIDAD_ANTERIOR_PREPARADA
-
-    except ValueError:
-        logger.info(" User Input Error Cantidad Entregada a Osakidetza de %s no es un numero %s ", user.first_name, update.message.text)
-        update.message.reply_text(emoji.emojize("👎 Por favor, introduce el número de unidades listas del modelo de Osakidetza."),
-                        reply_markup=ReplyKeyboardRemove())
-        return CANTIDAD_OSAKIDETZA_PREPARADA
-
-def cantidadAnteriorPreparada(update, context):
-    """ Numero de Viseras del modelo anterior listo para ser recogido
-        - Respuesta Esperada: Numérica
-        - Siguiente paso: Start / Direccion
-    """
-    user = update.message.from_user
-    try:
-        int(update.message.text)
-        context.user_data['cantidad_anterior_preparada'] = update.message.text
-        logger.info("Cantidad Lista para recoger del modelo Anterior de %s: %s", user.first_name, update.message.text)
-        totalPreparado = int(context.user_data["cantidad_osakidetza_preparada"]) + int(context.user_data["cantidad_anterior_preparada"])
-        update.message.reply_text(emoji.emojize("Ok, voy a necesitar algo de información para programar esta recogida.\n Dime cual es tu municipio."),
-            reply_markup=ReplyKeyboardRemove())
-        return MUNICIPIO
-    except ValueError:
-        logger.info(" User Input Error Cantidad Anterior Preparada de %s no es un numero %s ", user.first_name, update.message.text)
-        update.message.reply_text(emoji.emojize("👎 Por favor, introduce el número de unidades listas del modelo de Anterior."),
-                        reply_markup=ReplyKeyboardRemove())
-        return CANTIDAD_ANTERIOR_PREPARADA
-
-def municipio(update, context):
-    """ municipio de la recogida
-        - Respuesta Esperada: Texto
-        - Siguiente paso: Horario
-    """
-    user = update.message.from_user
-    context.user_data['municipio'] = update.message.text
-
-    logger.info("El municipio de %s es: %s", user.first_name, update.message.text)
-
-    update.message.reply_text(emoji.emojize("Muy bien, ahora la dirección para esta recogida."),
-                        reply_markup=ReplyKeyboardRemove())
-
-    return DIRECCION
-    
-def direccion(update, context):
-    """ Direccion para programar la recogida
-        - Respuesta Esperada: Texto
-        - Siguiente paso: Horario
-    """
-    user = update.message.from_user
-    context.user_data['direccion'] = update.message.text
-    logger.info("%s es de %s", user.first_name, update.message.text)
-    reply_keyboard = [['Mañana', 'Tarde', 'Todo el día']]
-    update.message.reply_text(emoji.emojize("\n ¿En qué horario podemos pasar?"), 
-            reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
-    
-    return HORARIO
-
-def horario(update, context):
-    """ Horario para programar la recogida
-        - Respuesta Esperada: Mañana/Tarde/Noche
-        - Siguiente paso: Teléfono
-    """
-    user = update.message.from_user
-
-    if any(ans in update.message.text for ans in ("Mañana", "Tarde", "Todo el día")):
-        context.user_data['horario'] = update.message.text
-        logger.info("%s quiere que se recoja por la %s", user.first_name, update.message.text)
-
-        contact_keyboard = KeyboardButton(text="Enviar Contacto", request_contact=True)
-        custom_keyboard = [[ contact_keyboard ]]
-        reply_markup = ReplyKeyboardMarkup(custom_keyboard)
-        update.message.reply_text(emoji.emojize("Muy bien, por último, dime tu teléfono"), 
-                        reply_markup=reply_markup)
-        return TELEFONO
-    else:
-        reply_keyboard = [['Mañana', 'Tarde', 'Todo el día']]
-        update.message.reply_text(emoji.emojize("\n Perdona, no he entendido eso \n ¿En qué horario podemos pasar?"), 
-            reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
-        return HORARIO
-
-def telefono(update, context):
-    """ Telefono de contacto
-        - Respuesta Esperada: Texto
-        - Siguiente paso: Teléfono
-    """
-    user = update.message.from_user
-    if hasattr(update.message.contact, "phone_number"):
-        context.user_data['telefono'] = update.message.contact.phone_number
-        logger.info("%s ha compartido su contacto: %s", user.first_name, context.user_data['telefono'])
-
-    else:
-        if len(update.message.text) < 9:
-            contact_keyboard = KeyboardButton(text="Enviar Contacto", request_contact=True)
-            custom_keyboard = [[ contact_keyboard ]]
-            reply_markup = ReplyKeyboardMarkup(custom_keyboard)
-            update.message.reply_text(emoji.emojize("\n Yo creo que ahi me faltan numeros. Dímelo de nuevo sólo con numeros (ej. 679123456) o comparte tu contacto por favor."), 
-                        reply_markup=reply_markup)
-            return TELEFONO
-
-        else:
-            context.user_data['telefono'] = update.message.text
-            logger.info("%s ha escrito su telefono: %s", user.first_name, context.user_data['telefono'])
-
-    update.message.reply_text(emoji.emojize("\n 👌 Genial, en la próxima recogida pasarán por tu dirección en el horario indicado. Gracias."), 
-                reply_markup=ReplyKeyboardRemove())
-    update.message.reply_text(emoji.emojize(config.get("mensajes", "prep_recogida")), 
-                reply_markup=ReplyKeyboardRemove())
-
-    return finConversacion(update, context)
-
-def confirmacionEntrega(update, context):
-    """ Confirmacion de entrega de modelos Osakidetza
-        - Respuesta Esperada: Numérica
-        - Siguiente paso: Cantidad Osakidetza o No Entregado
-    """
-    context.user_data['entregado_osakidetza'] = update.message.text
-
-    user = update.message.from_user
-    logger.info("Confirmación del pedido de %s: %s", user.first_name, update.message.text)
-
-    if any(ans in update.message.text for ans in ("Sí", "Si", "si", "sí", "Bai", "bai")):
-        update.message.reply_text(emoji.emojize("👌 Estupendo, ¿me puedes decir cuantos has entregado del modelo de Osakidetza?"),
-                            reply_markup=ReplyKeyboardRemove())
-    
-        return CANTIDAD_OSAKIDETZA
-
-    elif any(ans in update.message.text for ans in ("No", "no", "Ez", "ez")):
-        reply_keyboard = [["Sí", "No"]]
-        update.message.reply_text(emoji.emojize("☹️Lo sentimos, puede que nuestros compañeros de recogida hayan tenido algún problema 🚑. \n" +
-        "Te pedimos que esperes un poco antes de marcar la recogida como fallida. " +
-        "Si ya llevas un rato esperando o son más de las 20:00 marca la recogida como fallida para que lo tengamos en cuenta. \n ¿Prefieres esperar un rato?"),
-                            reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
-        return NO_ENTREGADO
-    
-    else:
-        noEntendi(update, context, [['Sí', 'No']])
-        return CONFIRMACION_ENTREGA
-
-def noEntregado(update, context):
-    """ Material no Entregado
-        - Respuesta Esperada: Recogida Fallida / Esperar
-        - Siguiente Paso: Recogida Fallida / Fin Conversación
-    """
-
-    user = update.message.from_user
-    logger.info("%s no ha podido entregar y dice que %s pude esperar", user.first_name, update.message.text)
-    
-    if any(ans in update.message.text for ans in ("No", "no", "Ez", "ez")):
-        update.message.reply_text(emoji.emojize("🤷🏻‍♀️‍ Ahora mismo no sé lo que ha podido pasar. Déjame que pase esta información y el equipo tratará de solucionarlo lo antes posible. Sentimos las molestias."),
-                            reply_markup=ReplyKeyboardRemove())
-        
-        appendToSheet(context.user_data)
-        return finConversacion(update, context)
-    
-    elif any(ans in update.message.text for ans in ("No", "no", "Ez", "ez")):
-        update.message.reply_text(emoji.emojize('Vale, gracias por tu paciencia!'),
-                            reply_markup=ReplyKeyboardRemove())
-        return finConversacion(update, context)
-    
-    else:
-        noEntendi(update, context, [['Sí', 'No']])
-        return NO_ENTREGADO
-
-def cantidadOsakidetza(update, context):
-    """ Numero de modelos Osakidetza entregados
-        - Respuesta Esperada: Numérica
-        - Siguiente paso: Modelo Anterior
-    """
-    user = update.message.from_user
-    try:
-        int(update.message.text)
-        context.user_data['cantidad_osakidetza'] = update.message.text
-        
-        logger.info("Cantidad Entregada a Osakidetza de %s: %s", user.first_name, update.message.text)
-
-        update.message.reply_text(emoji.emojize("👍 Estupendo, ¿me puedes decir cuantos has entregado del modelo anterior?"),
-                        reply_markup=ReplyKeyboardRemove())
-    
-        return MODELO_ANTERIOR
-
-    except ValueError:
-        logger.info(" User Input Error Cantidad Entregada a Osakidetza de %s no es un numero %s ", user.first_name, update.message.text)
-        update.message.reply_text(emoji.emojize("👎 Por favor, introduce el número de unidades del modelo de Osakidetza."),
-                        reply_markup=ReplyKeyboardRemove())
-        return CANTIDAD_OSAKIDETZA
-
-def modeloAnterior(update, context):
-    """ Modelo entregado anteriormente
-        - Respuesta Esperada: Texto
-        - Siguiente paso: Recepción de PLA
-    """
-    user = update.message.from_user
-    try:
-        int(update.message.text)
-        context.user_data['modelo_anterior'] = update.message.text
-        user = update.message.from_user
-        logger.info("Modelo Anterior de %s: %s", user.first_name, update.message.text)
-        reply_keyboard = [['Sí', 'No']]
-        update.message.reply_text(emoji.emojize('Vale. \n ¿Has entregado ya bobinas vacías para su reutilización?'),
-                            reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
-        return BOBINAS_ENTREGADAS
-
-    except ValueError:
-        logger.info(" User Input Error Cantidad Entregada del modelo anterior %s no es un numero %s ", user.first_name, update.message.text)
-        update.message.reply_text(emoji.emojize("👎 Por favor, introduce el número de unidades del modelo anterior."),
-                        reply_markup=ReplyKeyboardRemove())
-        return MODELO_ANTERIOR
-
-def recepcionPLA(update, context):
-    """ Confirmación de la recepción del PLA correspondiente
-        - Respuesta Esperada: Si/No
-        - Siguiente paso: Cantidad PLA recibido/ Reutilización Bobinas
-    """
-    context.user_data['recepcion_pla'] = update.message.text
-    user = update.message.from_user
-    logger.info("Recepción de PLA de %s: %s", user.first_name, update.message.text)
-    
-    if any(ans in update.message.text for ans in ("Sí", "Si", "si", "sí", "Bai", "bai")):
-        reply_keyboard = [['1.75mm', '3mm']]
-        update.message.reply_text(emoji.emojize('¿De qué diámetro lo necesitas?'),
-                                reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
-        return DIAMETRO_PLA
-    
-    elif any(ans in update.message.text for ans in ("No", "no", "Ez", "ez")):
-        # reply_keyboard = [['Sí', 'No']]
-        # update.message.reply_text(emoji.emojize('Vale. \n ¿Has entregado ya bobinas vacías para su reutilización?'),
-        #                     reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
-        return finConversacion(update, context)
-
-    else:
-        noEntendi(update, context, [['Sí', 'No']])
-        return RECEPCION_PLA
-
-def diametroPLA(update, context):
-    """ Diámetro de PLA necesario
-        - Respuesta Esperada: "1.75mm", "3mm", "Ambas"
-        - Siguiente paso: Recepción de PLA
-    """
-    user = update.message.from_user
-    logger.info("%s quiere bobinas de %s", user.first_name, update.message.text)
-    
-    if any(ans in update.message.text for ans in ("1.75mm", "1.75 mm", "1.75", "1,75", "175", "1")):
-        context.user_data['diametro'] = "1.75"
-        update.message.reply_text(emoji.emojize("1.75mm 🧵, entendido. Ya sabes lo que dicen... \n " +
-                                "Más vale pequeña y juguetona que grande y torpe 😏"),
-                                reply_markup=ReplyKeyboardRemove())
-        return finConversacion(update, context)
-    
-    if any(ans in update.message.text for ans in ("3mm", "3 mm", "3")):
-        context.user_data['diametro'] = "3"
-        update.message.reply_text(emoji.emojize("3mm 🧶, entendido. ¡Eso! \n " +
-                                "🐴 grande ande, o no ande. \n"),
-                                reply_markup=ReplyKeyboardRemove())
-        return finConversacion(update, context)
-
-    else:
-        logger.info("%s quiere bobinas de %s y no entiendo lo que quiere decir", user.first_name, update.message.text)
-        context.user_data['diametro'] = "Err"
-        noEntendi(update, context, [['1.75mm', '3mm']])
-        return DIAMETRO_PLA        
-
-def bobinasEntregadas(update, context):
-    """ Confirmación de entrega de Bobinas para reutilizar
-        - Respuesta Esperada: Si/No
-        - Siguiente paso: Numero de bobinas / Fin
-    """
-    context.user_data['bobinas_entregadas'] = update.message.text
-    user = update.message.from_user
-    logger.info("Bobinas entregadas para reutilización de %s: %s", user.first_name, update.message.text)
-    
-    if any(ans in update.message.text for ans in ("Sí", "Si", "si", "sí", "Bai", "bai")):
-        update.message.reply_text(emoji.emojize("¿Cuántas?"),
-                           reply_markup=ReplyKeyboardRemove())
-        return CANTIDAD_BOBINAS_ENTREGADAS
-    
-    elif any(ans in update.message.text for ans in ("No", "no", "Ez", "ez")):
-        reply_keyboard = [['Sí', 'No']]
-        update.message.reply_text(emoji.emojize('Muy bien. ¿Necesitas más PLA🎁?'),
-                                reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
-        return RECEPCION_PLA
-    
-    else:
-        noEntendi(update, context, [['Sí', 'No']])
-        return BOBINAS_ENTREGADAS
-
-def cantidadBobinasEntregadas(update, context):
-    """ Cantidad de bobinas Entregadas para reutilizacion
-        - Respuesta Esperada: Numérica
-        - Siguiente paso: Fin
-    """
-    user = update.message.from_user
-    try:
-        int(update.message.text)
-        context.user_data['cantidad_bobinas_entregadas'] = update.message.text
-
-        user = update.message.from_user
-        logger.info("Cantidad de bobinas entregadas para reutilización %s: %s", user.first_name, update.message.text)
-        
-        reply_keyboard = [['Sí', 'No']]
-        update.message.reply_text(emoji.emojize('Muy bien. ¿Necesitas más PLA🎁?'),
-                                reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
-        return RECEPCION_PLA
-
-    except ValueError:
-        logger.info(" User Input Error Cantidad de Bobinas Entregadas para reutilización de %s no es un numero %s ", user.first_name, update.message.text)
-        update.message.reply_text(emoji.emojize("👎 Por favor, introduce el número de bobinas entregadas para su reutilización"),
-                        reply_markup=ReplyKeyboardRemove())
-        return CANTIDAD_BOBINAS_ENTREGADAS
-
 def finSinSalvar(update, context):
     """ Finaliza la conversación sin guardar los datos """
     user = update.message.from_user
-    reply_keyboard = [['Empezar']]
-    update.message.reply_text(emoji.emojize("Esto es todo por ahora. Muchas gracias, " + user.first_name + 
-                        "\n Si quieres empezar de nuevo, dale al botón o escribe /empezar", use_aliases=True),
-                        reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
-    logger.info("Conversación con %s finalizada sin guardar los datos", user.first_name)
+    responder(update, mensajes.texto("fin_sin_salvar", user.first_name), mensajes.teclado("empezar"))
+    logger.info("Conversación con %s finalizada sin guardar los datos", user.first_name,
+            extra={"estado": "fin_sin_salvar", "user_id": user.id})
+    CONVERSACIONES.labels("sin_salvar").inc()
+    liberarDatos(context, user.id)
 
     return ConversationHandler.END
 
 def finConversacion(update, context):
     """ Guarda los datos y finaliza la conversacion """
     user = update.message.from_user
-    reply_keyboard = [['Empezar']]
-    update.message.reply_text(emoji.emojize(":tada: :tada: :tada: Debuti. Esto es todo por ahora. Muchas gracias, " + user.first_name + 
-                        "\n Si quieres empezar de nuevo, dale al botón o escribe /empezar", use_aliases=True),
-                        reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
+    responder(update, mensajes.texto("fin_conversacion", user.first_name), mensajes.teclado("empezar"))
 
-    logger.info("Conversación con %s finalizada", user.first_name)
+    logger.info("Conversación con %s finalizada", user.first_name, extra={"estado": "fin", "user_id": user.id})
+    CONVERSACIONES.labels("guardada").inc()
 
     appendToSheet(context.user_data)
+    liberarDatos(context, user.id)
     return ConversationHandler.END
 
 def cancel(update, context):
     """ Cancela la conversacion con el usuario
-        Por el momento este método no es accesible, aunque se puede forzar enviando /cancel
+        Se puede forzar enviando /cancel
     """
     user = update.message.from_user
-    logger.info("%s ha cancelado la conversación.", user.first_name)
-    update.message.reply_text("Bueno, pues nada... luego hablamos :(",
-                              reply_markup=ReplyKeyboardRemove())
+    logger.info("%s ha cancelado la conversación.", user.first_name, extra={"estado": "cancelar", "user_id": user.id})
+    CONVERSACIONES.labels("cancelada").inc()
+    responder(update, mensajes.texto("cancelar"), mensajes.teclado("quitar"))
+    liberarDatos(context, user.id)
 
     return ConversationHandler.END
 
 def error(update, context):
     """Captura errores provininetes del update"""
     logger.warning('Update "%s" caused error "%s"', update, context.error)
-    
-    reply_keyboard = [['Empezar']]
 
-    update.message.reply_text(emoji.emojize("Perdona, algo ha ido mal mientras hablábamos. \n¿Probamos de nuevo? 👉👈 😅" + 
-                        "\n Si quieres empezar de nuevo, dale al botón o escribe /empezar", use_aliases=True),
-                        reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
+    # Los errores de jobs y de la persistencia llegan sin update, y hay updates sin chat (callback_query...)
+    if isinstance(update, Update) and update.effective_chat:
+        responder(update, mensajes.texto("error"), mensajes.teclado("empezar"))
 
     return ConversationHandler.END
 
 def conversationTimeout(update, context):
     user = update.message.from_user
-    logger.info("La conversación con %s ha caducado.", user.first_name)
-
-    reply_keyboard = [['Empezar']]
+    logger.info("La conversación con %s ha caducado.", user.first_name, extra={"estado": "timeout", "user_id": user.id})
+    CONVERSACIONES.labels("caducada").inc()
 
-    update.message.reply_text(emoji.emojize("Oye, mejor hablamos luego, que ahora te veo liado. 👋" + 
-                        "\n Si quieres empezar de nuevo, dale al botón o escribe /empezar", use_aliases=True),
-                        reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
+    responder(update, mensajes.texto("timeout"), mensajes.teclado("empezar"))
+    liberarDatos(context, user.id)
 
     return ConversationHandler.END
 
-def noEntendi(update, context, _reply_keyboard):
-    """Devuelve una frase cuando no entiende la respuesta """
-    primeraParte = [config.get("mensajes", "no_entendi_1_1"), 
-                    config.get("mensajes", "no_entendi_1_2"), 
-                    config.get("mensajes", "no_entendi_1_3")]
-    segundaParte = [config.get("mensajes", "no_entendi_2_1"), 
-                    config.get("mensajes", "no_entendi_2_2"), 
-                    config.get("mensajes", "no_entendi_2_3")]
+def noEntendi(update, context, teclado):
+    """Devuelve una frase cuando no entiende la respuesta 
+        - teclado: clave del teclado de mensajes que se vuelve a mostrar
+    """
+    user = update.message.from_user
+    logger.info("%s no ha usado el boton y me ha dicho %s", user.first_name, update.message.text,
+            extra=porMensaje("no_entendi", user.id))
+    NO_ENTENDI.labels(teclado).inc()
+    responder(update, mensajes.noEntendi(user.first_name), mensajes.teclado(teclado))
+
+def resumenEstado(usuariosActivos=None):
+    """ Texto con el estado del bot para el comando /estado
+        - usuariosActivos: user_data del Dispatcher
+    """
+    lineas = ["Conversaciones:"]
+    for (resultado,), contador in sorted(CONVERSACIONES.items()):
+        lineas.append("  - %s: %s" % (resultado, contador.value))
+    lineas.append("No entendidas: %s" % sum(contador.value for _, contador in NO_ENTENDI.items()))
+
+    lineas.append("Handlers (n / p95 ms):")
+    for (paso,), histograma in sorted(HANDLER_LATENCY.items()):
+        if histograma.count:
+            lineas.append("  - %s: %s / %.2f" % (paso, histograma.count, histograma.quantile(0.95) * 1000))
+
+    lineas.append("Google Sheets:")
+    for destino, datos in sheetWriter.stats()["destinations"].items():
+        lineas.append("  - %s: %s, %s filas, %s errores, %s pendientes" % (destino, datos["health"]["state"],
+                datos["rows_written"], datos["errors"], datos["pending"]))
+
+    repetidas = submittedIndex.stats()
+    lineas.append("Repetidas descartadas: %s (%s conversaciones recordadas)" % (repetidas["duplicates_suppressed"],
+            repetidas["keys"]))
+
+    if pool is not None:
+        reparto = pool.stats()
+        lineas.append("Procesos: %s, updates enrutados %s, %s reinicios" % (reparto["procesos"],
+                reparto["enrutados"], reparto["reinicios"]))
+
+    envios = outbox.stats()
+    lineas.append("Envíos: %s enviados, %s juntados, %s retrasados, %s RetryAfter, %s errores" % (envios["sent"],
+            envios["coalesced"], envios["delayed"], envios["retry_after"], envios["errors"]))
+
+    if difusor is not None and difusor.throughput() is not None:
+        difusion = difusor.stats()
+        lineas.append("Difusión %s: %s enviados, %s bloqueados, %s fallidos, %.1f mensajes/s" % (difusion["actual"],
+                difusion["sent"], difusion["blocked"], difusion["failed"], difusion["throughput"]))
+
+    if perfilador.activo:
+        datos = perfilador.stats()
+        lineas.append("Perfilado encendido al %s%%: %s updates perfilados" % (round(datos["muestreo"] * 100, 2),
+                datos["perfilados"]))
+
+    recargas = configuracion.stats()
+    if recargas["reloads"] or recargas["rejected"]:
+        lineas.append("Configuración: %s recargas, %s descartadas por errores" % (recargas["reloads"], recargas["rejected"]))
+
+    if copiaHoja is not None:
+        copia = copiaHoja.stats()
+        lineas.append("Copia local de la hoja: %s" % ", ".join("%s %s filas (%s)" % (nombre, datos["filas"],
+                (datos["sincronizada"] or "nunca")[:19]) for nombre, datos in sorted(copia["pestanas"].items())))
+
+    if isinstance(usuariosActivos, UserDataStore):
+        usuarios = usuariosActivos.stats()
+        lineas.append("Usuarios en memoria: %s (%s olvidados por LRU/TTL, %s al terminar)" % (usuarios["users"],
+                usuarios["evicted"], usuarios["released"]))
+
+    lineas.append("Colas:")
+    for (cola,), valor in sorted(COLAS.items()):
+        lineas.append("  - %s: %s" % (cola, valor()))
+    return "\n".join(lineas)
+
+def estado(update, context):
+    """ /estado: resumen de métricas, solo para los usuarios de [telegram] admins """
+    if not esAdmin(update):
+        return
+    logger.info("%s ha pedido el estado del bot", update.effective_user.first_name)
+    responder(update, resumenEstado(context.dispatcher.user_data))
+    # El comando no debe llegar a la conversación que el administrador tenga a medias
+    raise DispatcherHandlerStop()
+
+def textoTotales(totales):
+    return "\n".join("  - %s: %s" % (etiqueta, totales[clave]) for clave, etiqueta in ETIQUETAS if totales.get(clave))
+
+def resumen(update, context):
+    """ /resumen [provincia]: totales de producción, solo para los usuarios de [telegram] admins """
+    if not esAdmin(update):
+        return
+    provincia = " ".join(context.args or ()) or None
+    datos = agregados.snapshot(provincia)
+
+    if provincia is None:
+        lineas = ["Total:", textoTotales(datos["total"]) or "  (nada todavía)"]
+        for nombre, totales in sorted(datos["provincias"].items()):
+            lineas += ["", nombre + ":", textoTotales(totales)]
+        lineas += ["", "Últimos días:"]
+        for dia, totales in sorted(datos["dias"].items())[-7:]:
+            lineas.append("  - %s: %s programadas, %s confirmadas" % (dia, totales.get("recogidas_programadas", 0),
+                    totales.get("entregas_confirmadas", 0)))
+    else:
+        lineas = [provincia + ":", textoTotales(datos["total"]) or "  (nada todavía)"]
+        for nombre, totales in sorted(datos["municipios"].items()):
+            lineas += ["", nombre + ":", textoTotales(totales)]
+    responder(update, "\n".join(lineas))
+    raise DispatcherHandlerStop()
+
+# Máximo de recogidas que se listan en un mensaje de /recogidas
+MAX_RECOGIDAS = 40
+
+def recogidasPendientes(update, context):
+    """ /recogidas [municipio][, horario]: recogidas pendientes, solo para los usuarios de [telegram] admins """
+    if not esAdmin(update):
+        return
+    partes = [parte.strip() for parte in " ".join(context.args or ()).split(",")]
+    municipio = partes[0] or None
+    horario = partes[1] if len(partes) > 1 and partes[1] else None
+    # "/recogidas Tarde" filtra por horario
+    if horario is None and municipio and len(municipio.split()) <= 3:
+        opcion = conversacion.buscarOpcion(HORARIO, municipio)
+        if opcion is not None:
+            municipio, horario = None, opcion.valor
+
+    # "Donostia" o "Bilbo" se buscan por el nombre oficial con el que se guardan las filas
+    municipio = recogidas.municipio(municipio)
+    lista = recogidas.batch(municipio, horario)
+    lineas = ["%s recogidas pendientes%s%s (de %s en total)" % (len(lista), " en " + municipio if municipio else "",
+            ", " + horario if horario else "", recogidas.pendientes)]
+    lineas += [pickup.texto() for pickup in lista[:MAX_RECOGIDAS]]
+    if len(lista) > MAX_RECOGIDAS:
+        lineas.append("... y %s más" % (len(lista) - MAX_RECOGIDAS))
+    responder(update, "\n".join(lineas))
+    raise DispatcherHandlerStop()
+
+# Difusiones de los coordinadores (difusion.py), se crea en main()
+difusor = None
+
+USO_DIFUNDIR = ("Uso: /difundir [provincia[, municipio]] y el texto a partir de la segunda línea. Ej.:\n"
+        "/difundir Bizkaia, Getxo\nA partir del lunes las recogidas de la tarde serán de 17:00 a 19:00")
+
+def difundir(update, context):
+    """ /difundir [provincia[, municipio]] con el texto en las líneas siguientes: prepara una difusión a los
+        voluntarios que han enviado algo desde ahí, que no sale hasta /difusion enviar N.
+        Solo para los usuarios de [telegram] admins
+    """
+    if not esAdmin(update):
+        return
+    if difusor is None:
+        responder(update, "Las difusiones no están disponibles")
+        raise DispatcherHandlerStop()
+    primera, _, texto = update.message.text.partition("\n")
+    texto = texto.strip()
+    partes = [parte.strip() for parte in primera.partition(" ")[2].split(",")]
+    provincia = partes[0] or None
+    municipio = partes[1] if len(partes) > 1 and partes[1] else None
+    if not texto:
+        responder(update, USO_DIFUNDIR)
+        raise DispatcherHandlerStop()
+
+    filtro = ", ".join(parte for parte in (provincia, municipio) if parte) or "todos"
+    difusionId = difusor.store.create(texto, filtro, update.effective_chat.id, voluntarios.select(provincia, municipio))
+    destinatarios = difusor.store.get(difusionId)["destinatarios"]
+    logger.info("%s ha preparado la difusión %s (%s) para %s voluntarios", update.effective_user.first_name,
+            difusionId, filtro, destinatarios[PENDIENTE])
+    responder(update, "Difusión %s (%s) preparada para %s voluntarios, más %s que tienen el bot bloqueado.\n"
+            "Para enviarla: /difusion enviar %s" % (difusionId, filtro, destinatarios[PENDIENTE],
+            destinatarios[BLOQUEADO], difusionId))
+    raise DispatcherHandlerStop()
+
+def textoDifusion(difusion):
+    destinatarios = difusion["destinatarios"]
+    ritmo = " a %.1f mensajes/s" % (destinatarios[ENVIADO] / difusion["segundos"]) if difusion["segundos"] else ""
+    return "%s. %s (%s): %s enviados de %s, %s bloqueados, %s fallidos, %s pendientes%s" % (difusion["id"],
+            difusion["estado"], difusion["filtro"], destinatarios[ENVIADO], sum(destinatarios.values()),
+            destinatarios[BLOQUEADO], destinatarios[FALLIDO], destinatarios[PENDIENTE], ritmo)
+
+def estadoDifusion(update, context):
+    """ /difusion [enviar|parar N]: envía, para o lista las últimas difusiones. Una difusión parada sigue
+        donde se quedó con enviar. Solo para los usuarios de [telegram] admins
+    """
+    if not esAdmin(update):
+        return
+    args = context.args or ()
+    if difusor is None:
+        responder(update, "Las difusiones no están disponibles")
+    elif len(args) == 2 and args[0] in ("enviar", "parar") and args[1].isdigit():
+        difusionId = int(args[1])
+        if args[0] == "enviar" and difusor.send(difusionId):
+            logger.info("%s ha enviado la difusión %s", update.effective_user.first_name, difusionId)
+            responder(update, "Enviando la difusión %s" % difusionId)
+        elif args[0] == "parar" and difusor.pause(difusionId):
+            logger.info("%s ha parado la difusión %s", update.effective_user.first_name, difusionId)
+            responder(update, "Difusión %s parada" % difusionId)
+        else:
+            responder(update, "La difusión %s no existe o no se puede %s" % (difusionId, args[0]))
+    else:
+        lineas = [textoDifusion(difusion) for difusion in difusor.store.recent()] or ["Ninguna difusión todavía"]
+        ritmo = difusor.throughput()
+        if ritmo is not None:
+            lineas.append("Enviando ahora a %.1f mensajes/s" % ritmo)
+        responder(update, "\n".join(lineas))
+    raise DispatcherHandlerStop()
+
+def finDifusion(difusion):
+    """ Avisa al coordinador que preparó la difusión de que ha terminado """
+    if difusion["chat_id"]:
+        outbox.send(difusion["chat_id"], "Difusión terminada:\n" + textoDifusion(difusion))
+
+def desbloquear(update, context):
+    """ Quien había bloqueado el bot y le vuelve a escribir recibe de nuevo las difusiones """
+    user = update.effective_user
+    if user is not None and difusor.store.unblock(user.id):
+        logger.info("%s ha vuelto a escribir al bot, deja de estar bloqueado para las difusiones", user.first_name,
+                extra={"user_id": user.id})
+
+def encenderPerfil(muestreo=None):
+    """ Perfila los handlers de este proceso y de los trabajadores con [perfil] muestreo y duracion """
+    perfilador.start(ajustes.perfil.muestreo if muestreo is None else muestreo, ajustes.perfil.duracion)
+    if pool is not None and hasattr(signal, "SIGUSR1"):
+        pool.sendSignal(signal.SIGUSR1)
+
+def apagarPerfil():
+    """ Apaga el perfilado aquí y en los trabajadores. Devuelve el fichero de resultados de este proceso """
+    if pool is not None and hasattr(signal, "SIGUSR2"):
+        pool.sendSignal(signal.SIGUSR2)
+    return perfilador.stop()
+
+def perfil(update, context):
+    """ /perfil [iniciar [fracción]|parar]: perfila los handlers de la conversación y escribe los tiempos
+        por función en logs/. Solo para los usuarios de [telegram] admins
+    """
+    if not esAdmin(update):
+        return
+    args = context.args or ()
+    if len(args) in (1, 2) and args[0] == "iniciar":
+        try:
+            muestreo = float(args[1]) if len(args) == 2 else ajustes.perfil.muestreo
+        except ValueError:
+            muestreo = 0
+        if 0 < muestreo <= 1:
+            logger.info("%s ha encendido el perfilado", update.effective_user.first_name)
+            encenderPerfil(muestreo)
+            duracion = " durante %s s" % ajustes.perfil.duracion if ajustes.perfil.duracion else ""
+            responder(update, "Perfilando el %s%% de los updates%s. Para terminar: /perfil parar" % (
+                    round(muestreo * 100, 2), duracion))
+        else:
+            responder(update, "La fracción de updates tiene que estar entre 0 y 1")
+    elif len(args) == 1 and args[0] == "parar":
+        logger.info("%s ha apagado el perfilado", update.effective_user.first_name)
+        path = apagarPerfil()
+        responder(update, "Resultados en %s" % path if path else "No había ningún update perfilado")
+    elif args:
+        responder(update, "Uso: /perfil [iniciar [fracción entre 0 y 1]|parar]")
+    else:
+        datos = perfilador.stats()
+        lineas = ["Perfilado %s: %s updates perfilados" % ("encendido al %s%%" % round(datos["muestreo"] * 100, 2)
+                if datos["activo"] else "apagado", datos["perfilados"])]
+        lineas += ["  - %s" % path for path in datos["ficheros"][-5:]]
+        responder(update, "\n".join(lineas))
+    raise DispatcherHandlerStop()
+
+def escucharSenales():
+    """ SIGUSR1 enciende el perfilado y SIGUSR2 lo apaga y escribe los resultados. En el proceso principal
+        también llegan a los trabajadores. Las señales se atienden en el hilo principal, que puede estar
+        dentro de un handler perfilado: el trabajo se hace en otro hilo
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=encenderPerfil, daemon=True).start())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=apagarPerfil, daemon=True).start())
 
-    random.shuffle(primeraParte)
-    respuesta = primeraParte[random.randrange(2)] + update.message.from_user.first_name 
-    random.shuffle(segundaParte)
-    respuesta = respuesta + segundaParte[random.randrange(2)]
+# Copia local de las pestañas de la hoja principal (espejo.py), se abre en main()
+copiaHoja = None
 
-    user = update.message.from_user
-    logger.info("%s no ha usado el boton y me ha dicho %s", user.first_name, update.message.text)
-    reply_keyboard = _reply_keyboard
-    update.message.reply_text(emoji.emojize(respuesta), 
-            reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True))
+def leerHoja(schema, rango):
+    """ Filas de un rango A1 de la pestaña de schema en la hoja principal, para la copia local """
+    return sheetSession.call(ajustes.google.userDataSheet, sheetNames[schema.nombre], lambda ws: ws.get(rango))
+
+def sincronizarEspejo(context):
+    """ Job de la JobQueue: trae a la copia local las filas nuevas de la hoja principal """
+    try:
+        copiaHoja.sync(leerHoja)
+    except Exception as e:
+        logger.warning("No se ha podido poner al día la copia local de la hoja: %r", e)
+
+def filasGuardadas():
+    """ (schema, row) de todo lo guardado, para reconstruir los índices al arrancar: la copia local de la
+        hoja principal, con las filas que se le hayan añadido desde la última vez, más lo que aún no ha
+        llegado a ella desde el diario. Si la hoja no se puede leer se usa solo el diario
+    """
+    primary = ajustes.google.userDataSheet
+    filas = []
+    try:
+        nuevas = copiaHoja.sync(leerHoja)
+        for schema in schemasPorHoja.values():
+            filas.extend((schema, row) for row in copiaHoja.rows(schema))
+        pendientes = journal.pending(primary, limit=-1)
+        fuente = "la copia local de %s (%s filas nuevas) y el diario" % (primary, sum(nuevas.values()))
+    except Exception as e:
+        logger.warning("No se ha podido leer %s para reconstruir los índices (%r), se usa solo el diario", primary, e)
+        filas = []
+        pendientes = journal.entries()
+        fuente = "el diario"
+    filas.extend((schemasPorHoja[sheet], row) for _, sheet, row in pendientes if sheet in schemasPorHoja)
+    return filas, fuente
+
+def reconstruirIndices():
+    """ Totales de /resumen y recogidas de /recogidas a partir de lo ya guardado """
+    filas, fuente = filasGuardadas()
+    logger.info("Totales reconstruidos con %s filas de %s", agregados.rebuild(filas), fuente)
+    logger.info("Índice de recogidas reconstruido: %s pendientes", recogidas.rebuild(filas))
+    logger.info("Destinatarios de difusión: %s voluntarios", voluntarios.rebuild(filas))
 
 def appendToSheet(user_data):
     """ Añade una nueva fila con los valores obtenidos 
         - Input: context.user_data
     """
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-
-    # Usa los credenciales del archivo que este en el path de clientSecretPath
-    creds = ServiceAccountCredentials.from_json_keyfile_name(clientSecretPath, scope)
-    client = gspread.authorize(creds)
-
-    managedData = list()
-    
-    if "fecha_inicio" in user_data: managedData.append(user_data["fecha_inicio"])
-    else: managedData.append("NA")
-    managedData.append(datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
-    
-    if "nombre" in user_data: managedData.append(user_data["nombre"])
-    else: managedData.append("NA")
-    if "apellido" in user_data: managedData.append(user_data["apellido"])
-    else: managedData.append("NA")
-    if "user_id" in user_data: managedData.append(user_data["user_id"])
-    else: managedData.append("NA")
-    if "user_name" in user_data:
-        if user_data["user_name"]: 
-            formula = "=HYPERLINK(\"https://t.me/" + user_data["user_name"]+"\", \""+ user_data["user_name"]+"\")"
-            linkToUser = managedData.append(formula)
-        else: managedData.append("NA")
-    else: managedData.append("NA")
-    if "provincia" in user_data: managedData.append(user_data["provincia"])
-    else: managedData.append("NA")
-
-    if "Confirmar" in user_data["confirmar_programar"]:
-        if "entregado_osakidetza" in user_data: managedData.append(user_data["entregado_osakidetza"])
-        else: managedData.append("NA")
-        if "cantidad_osakidetza" in user_data: managedData.append(user_data["cantidad_osakidetza"])
-        else: managedData.append("NA")
-        if "modelo_anterior" in user_data: managedData.append(user_data["modelo_anterior"])
-        else: managedData.append("NA")
-        if "recepcion_pla" in user_data: managedData.append(user_data["recepcion_pla"])
-        else: managedData.append("NA")
-        if "diametro" in user_data: managedData.append(user_data["diametro"])
-        else: managedData.append("NA")
-        if "cantidad_pla_recibido" in user_data: managedData.append(user_data["cantidad_pla_recibido"])
-        else: managedData.append("NA")
-        if "bobinas_entregadas" in user_data: managedData.append(user_data["bobinas_entregadas"])
-        else: managedData.append("NA")
-        if "cantidad_bobinas_entregadas" in user_data: managedData.append(user_data["cantidad_bobinas_entregadas"])
-        else: managedData.append("NA")
-
-        sheetName = config.get("google", "sheet_Confirmadas")
+    # Una misma conversación solo se guarda una vez aunque se vuelva a enviar
+    submissionKey = (user_data.get("user_id"), user_data.get("fecha_inicio"), user_data.get("confirmar_programar"))
+    if submittedIndex.seen(submissionKey):
+        logger.info("Conversación %s ya guardada, se descarta el duplicado (%s descartados)",
+                    submissionKey, submittedIndex.duplicates)
+        return
+
+    # Columnas de la pestaña según se haya elegido Confirmar o Programar recogida (esquema.py)
+    schema = schemaFor(user_data)
+    if schema is None:
+        logger.warning("Conversación sin Confirmar/Programar recogida, no se guarda: %s", submissionKey,
+                extra={"user_id": user_data.get("user_id")})
+        return
+    managedData = schema.row(user_data)
+
+    if destinoFilas is not None:
+        # En un proceso trabajador la fila la guarda el proceso principal
+        destinoFilas.put((FILA, schema.nombre, managedData))
+        return
+    guardarFila(schema, managedData)
+
+def guardarFila(schema, managedData):
+    """ Guarda una fila ya serializada en el diario local y la encola para la hoja principal
+        (userDataSheet) y la de backup
+    """
+    sheetName = sheetNames[schema.nombre]
+    userId = managedData[schema.position("user_id")]
+    entryId = journalReplayer.submit(sheetName, managedData)
+    agregados.add(schema, managedData)
+    recogidas.add(schema, managedData)
+    voluntarios.add(schema, managedData)
+    logger.info("Datos guardados en el diario para la hoja %s", sheetName,
+            extra={"user_id": userId, "hoja": sheetName, "entry_id": entryId})
+    logger.debug("Fila %s: %s", entryId, managedData, extra=porMensaje("guardar", userId))
+
+# Varios procesos (reparto.py, sección [procesos]): los trabajadores mandan sus filas al principal por
+# destinoFilas como (FILA, nombre del esquema, fila)
+FILA = "fila"
+destinoFilas = None
+esquemas = {schema.nombre: schema for schema in (CONFIRMADAS, PROGRAMADAS)}
+
+def filaDeTrabajador(mensaje):
+    """ Guarda en el proceso principal una fila terminada en un trabajador """
+    tipo, nombre, managedData = mensaje
+    if tipo == FILA:
+        guardarFila(esquemas[nombre], managedData)
+
+def trabajador(indice, entrada, salida, telegramToken, timeout, procesos, crearBot=None):
+    """ Proceso trabajador de reparto.py: atiende las conversaciones de los user_id que le tocan
+        - Cada uno escribe su propio log y su propia persistencia (respirabot-N.log, conversaciones-N.db)
+        - Envía con su parte del límite global de [envios]
+        - Las filas terminadas se guardan en el proceso principal
+        - crearBot: clase del Bot en lugar de conectarse con telegramToken (pruebas de carga)
+    """
+    global logSetup, outbox, destinoFilas
+    from reparto import TERMINADO, serveShard
+
+    logSetup = configurarLog(logsPath + "//respirabot-%s.log" % indice)
+    perfilador.prefijo = "perfil-%s" % indice
+    destinoFilas = salida
+    # Las difusiones salen del proceso principal con su propio ritmo, que se descuenta del límite global
+    outbox = crearOutbox(procesos, reservado=ajustes.difusion.rate)
+
+    persistence = None
+    if ajustes.telegram.persistencia:
+        from persistencia import SQLitePersistence
+        persistence = SQLitePersistence(logsPath + "//conversaciones-%s.db" % indice, timeout)
+    if crearBot is None:
+        updater = Updater(telegramToken, workers=1, use_context=True, persistence=persistence)
+    else:
+        updater = Updater(bot=crearBot(), workers=1, use_context=True, persistence=persistence)
+    dp = updater.dispatcher
+    acotarUserData(dp, timeout)
+    dp.add_handler(buildConversationHandler(timeout, persistent=persistence is not None))
+    conversaciones.start(dp)
+    dp.add_error_handler(error)
+    outbox.start(updater.bot)
+    updater.job_queue.start()
+    vigilarConfiguracion()
+    escucharSenales()
+    logger.info("Proceso trabajador %s de %s arrancado", indice + 1, procesos)
+
+    atendidos, ocupado = serveShard(dp, entrada, salida, indice)
+
+    configuracion.stop()
+    perfilador.stop()
+    updater.job_queue.stop()
+    if persistence is not None:
+        dp.update_persistence()
+        persistence.flush()
+    outbox.stop(timeout=10)
+    logger.info("Proceso trabajador %s terminado: %s updates en %.1f s", indice + 1, atendidos, ocupado)
+    salida.put((TERMINADO, indice, {"updates": atendidos, "ocupado_s": round(ocupado, 3), "envios": outbox.stats()}))
+    logSetup.stop()
+
+
+# Pasos de la conversación generados a partir de la tabla flujo.FLUJO
+# El municipio se reconoce con el índice de municipios de Álava, Bizkaia y Gipuzkoa
+conversacion = ConversationEngine(mensajes, finConversacion, finSinSalvar, noEntendi, enviar=responder,
+        municipios=indiceMunicipios)
+
+def buildConversationHandler(timeout, persistent=False):
+    """ ConversationHandler con un paso por cada entrada de flujo.FLUJO
+        - persistent: guarda el paso de cada conversación en la persistencia del Updater
+        - timeout: segundos sin mensajes tras los que caduca, con una sola rueda de caducidad (caducidad.py)
+    """
+    def crearHandler(paso, callback):
+        # El teléfono se puede mandar como texto o compartiendo el contacto
+        return MessageHandler(Filters.all if paso.tipo == TELEFONO_O_CONTACTO else Filters.text,
+                medido(paso.nombre, callback))
+
+    states = conversacion.estados(crearHandler)
+    states[ConversationHandler.TIMEOUT] = [MessageHandler(Filters.all, medido("timeout", conversationTimeout))]
+
+    global conversaciones
+    inicio = medido("inicio", start)
+    conversaciones = ExpiringConversationHandler(
+        entry_points=[CommandHandler('start', inicio), CommandHandler('empezar', inicio), MessageHandler(Filters.regex('^(Vamos|vamos|Empezar|empezar)$'), inicio)],
+        states=states,
+        fallbacks=[CommandHandler('cancel', medido("cancelar", cancel))],
+        allow_reentry=True,
+        conversation_timeout = timeout,
+        onRestoredTimeout=lambda conversationKey: CONVERSACIONES.labels("caducada").inc(),
+        name="respirabot",
+        persistent=persistent
+    )
+    return conversaciones
 
-    
-    elif "Programar" in user_data["confirmar_programar"]:
-        if "cantidad_osakidetza_preparada" in user_data: managedData.append(user_data["cantidad_osakidetza_preparada"])
-        else: managedData.append("NA")
-        if "cantidad_anterior_preparada" in user_data: managedData.append(user_data["cantidad_anterior_preparada"])
-        else: managedData.append("NA")
-        if "municipio" in user_data: managedData.append(user_data["municipio"])
-        else: managedData.append("NA")
-        if "direccion" in user_data: managedData.append(user_data["direccion"])
-        else: managedData.append("NA")
-        if "horario" in user_data: managedData.append(user_data["horario"])
-        else: managedData.append("NA")
-        if "telefono" in user_data: managedData.append(user_data["telefono"])
-        else: managedData.append("NA")
-
-        sheetName = config.get("google", "sheet_programadas")
-
-    logger.info("Guardando datos en la hoja %s", sheetName) 
-    logger.info(managedData)
-
-    #Hoja de excel con los resultados del bot
-    userDataSheet = config.get("google", "userDataSheet")
-    userDataSheet_backup =  config.get("google", "userDataSheet_backup")
-    #Abre la hoja con el nombre indicado por userDataSheet y añade los nuevos datos
-    sheet = client.open(userDataSheet).worksheet(sheetName).append_row(managedData, value_input_option='USER_ENTERED')
-    sheet = client.open(userDataSheet_backup).worksheet(sheetName).append_row(managedData, value_input_option='USER_ENTERED')
+# ConversationHandler de este proceso, para aplicar los cambios de [telegram] timeout
+conversaciones = None
 
+def aplicarAjustes(anterior, nuevo):
+    """ onChange de configuracion: pone en uso la nueva foto de respirabot.ini y aplica lo que no necesita
+        reiniciar (EN_CALIENTE y [mensajes]). El resto se avisa y se aplica en el siguiente arranque
+    """
+    global ajustes, mensajes, admins
+    ajustes = nuevo
+    cambios = set(nuevo.diff(anterior))
+
+    if any(seccion == "mensajes" for seccion, _ in cambios):
+        mensajes = conversacion.mensajes = MessageCatalog(nuevo)
+    if ("telegram", "admins") in cambios:
+        admins = {int(userId) for userId in leerAdmins(nuevo.telegram.admins)}
+    if conversaciones is not None:
+        conversaciones.timeout = nuevo.telegram.timeout
+        # La persistencia decide con el mismo timeout qué conversaciones guardadas siguen a medias
+        if conversaciones.persistence is not None:
+            conversaciones.persistence.timeout = nuevo.telegram.timeout
+    if almacenUsuarios is not None:
+        almacenUsuarios.maxSize = nuevo.usuarios.max_usuarios
+        almacenUsuarios.ttl = nuevo.usuarios.ttl or 2 * nuevo.telegram.timeout
+
+    outbox.setLimits(**limitesEnvio(*repartoEnvios))
+    if difusor is not None:
+        difusor.configure(nuevo.difusion.rate, nuevo.difusion.ventana)
+    logger.setLevel(nuevo.logging.level.upper())
+    logSetup.sampler.rate = nuevo.logging.muestreo
+
+    reinicio = sorted(cambio for cambio in cambios if cambio not in EN_CALIENTE and cambio[0] != "mensajes")
+    if reinicio:
+        logger.warning("Cambios de la configuración que se aplicarán al reiniciar: %s",
+                ", ".join("[%s] %s" % cambio for cambio in reinicio))
+
+def vigilarConfiguracion():
+    """ Recarga respirabot.ini cada [configuracion] recarga segundos si ha cambiado (0 = nunca) """
+    configuracion.onChange = aplicarAjustes
+    if ajustes.configuracion.recarga > 0:
+        configuracion.start(ajustes.configuracion.recarga)
+
+# Procesos trabajadores de reparto.py, solo si [procesos] trabajadores > 0
+pool = None
+
+def validarCabeceras():
+    """ Compara la primera fila de cada pestaña con las columnas de esquema.py y avisa si no coinciden """
+    for spreadsheet in (ajustes.google.userDataSheet, ajustes.google.userDataSheet_backup):
+        for schema in (CONFIRMADAS, PROGRAMADAS):
+            sheetName = sheetNames[schema.nombre]
+            try:
+                cabeceras = sheetSession.call(spreadsheet, sheetName, lambda ws: ws.row_values(1))
+            except Exception as e:
+                logger.warning("No se han podido leer las cabeceras de %s/%s: %r", spreadsheet, sheetName, e)
+                continue
+            for columna, esperada, encontrada in schema.checkHeaders(cabeceras):
+                logger.warning("%s/%s: la columna %s es '%s' y se esperaba '%s'",
+                        spreadsheet, sheetName, columna, encontrada, esperada)
+
+def comprobarGoogle():
+    """ Credenciales de Google: el fichero y, si es válido, la autorización de la sesión compartida """
+    errores = checkServiceAccount(clientSecretPath)
+    if not errores:
+        sheetSession.authorize()
+    return errores
+
+def comprobarArranque(tokenKey, telegramToken):
+    """ Comprueba a la vez todo lo que el bot necesita antes de atender a nadie. Lanza StartupError """
+    comprobaciones = StartupCheck()
+    comprobaciones.add("argumentos", lambda: checkArguments(sys.argv[1:], ARGUMENTOS))
+    comprobaciones.add("configuracion", lambda: checkFile(configurationPath, "configuración") or
+            configuracion.errors() + ([] if telegramToken else ["falta [telegram] %s" % tokenKey]))
+    comprobaciones.add("carpetas", lambda: checkDirectory(logsPath))
+    comprobaciones.add("google", comprobarGoogle)
+    if telegramToken:
+        comprobaciones.add("telegram", lambda: checkTelegram(telegramToken))
+    return comprobaciones.run(timeout=ajustes.telegram.arranque_timeout)
 
 def main():
     """ Creacion del bot, handles de conversacion y polling """
+    prepararPrincipal()
     logger.info("Respirabot started ")
 
-    if len(sys.argv)>1:
-        if sys.argv[1] == "produccion":
-            logger.warning("---      Ejecutando Bot de Producción       ---")
-            telegramToken = config.get("telegram", "token_produccion")
-        
+    # Argumentos: [produccion] [webhook]
+    if "produccion" in sys.argv[1:]:
+        logger.warning("---      Ejecutando Bot de Producción       ---")
+        tokenKey = "token_produccion"
     else:
         logger.warning("---      Ejecutando Bot de desarrollo       ---")
-        telegramToken = config.get("telegram", "token_dev")
+        tokenKey = "token_dev"
+    telegramToken = getattr(ajustes.telegram, tokenKey)
+    webhookMode = "webhook" in sys.argv[1:]
+
+    # Argumentos, configuración, carpetas y credenciales antes de nada; si algo falla se sale con todos los errores
+    try:
+        tiempos = comprobarArranque(tokenKey, telegramToken)
+    except StartupError as e:
+        for comprobacion, texto in e.errores:
+            logger.critical("Error de arranque (%s): %s", comprobacion, texto)
+        logSetup.stop()
+        sys.exit(1)
+    logger.info("Comprobaciones de arranque correctas: %s",
+            ", ".join("%s %.0f ms" % (nombre, segundos * 1000) for nombre, segundos in sorted(tiempos.items())))
 
     logger.info("  - Configuration Path: %s", configurationPath)
     logger.info("  - Log Path: %s", ownLogPath)
     logger.info("  - Google API Path: %s", clientSecretPath)
-    logger.info("  - Google Sheet: %s", config.get("google", "userDataSheet"))
+    logger.info("  - Google Sheet: %s", ajustes.google.userDataSheet)
     logger.info("  - Telegram Token: %s", telegramToken)
-    timeout = int(config.get("telegram", "timeout"))
+    timeout = ajustes.telegram.timeout
     logger.info("  - Conversation Timeout: %s", timeout)
+
+    # La sesión de Google Sheets ya se ha autorizado al comprobar los credenciales
+    validarCabeceras()
+    global copiaHoja
+    copiaHoja = SheetMirror(mirrorPath)
+    reconstruirIndices()
+    sheetWriter.start()
+    journalReplayer.start()     # Reenvía lo que quedase pendiente de la última ejecución
+
     logger.info("Waiting for conversations")
 
-    updater = Updater(telegramToken, use_context=True)
-    dp = updater.dispatcher
+    # Con [procesos] trabajadores las conversaciones se reparten por user_id entre varios procesos
+    procesos = ajustes.procesos.trabajadores
 
-    # Conversation handlers
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start), CommandHandler('empezar', start), MessageHandler(Filters.regex('^(Vamos|vamos|Empezar|empezar)$'), start)],
-        states={
-            CONFIRMACION_ENTREGA: [MessageHandler(Filters.text, confirmacionEntrega)],
-            PROVINCIA: [MessageHandler(Filters.text, provincia)],
-            CONFIRMAR_PROGRAMAR: [MessageHandler(Filters.text, ConfirmarProgramar)],
-            NO_ENTREGADO: [MessageHandler(Filters.text, noEntregado)],
-            CANTIDAD_OSAKIDETZA: [MessageHandler(Filters.text, cantidadOsakidetza)],
-            MODELO_ANTERIOR: [MessageHandler(Filters.text, modeloAnterior)],
-            RECEPCION_PLA: [MessageHandler(Filters.text, recepcionPLA)],
-            DIAMETRO_PLA: [MessageHandler(Filters.text, diametroPLA)],
-            BOBINAS_ENTREGADAS: [MessageHandler(Filters.text, bobinasEntregadas)],
-            CANTIDAD_BOBINAS_ENTREGADAS: [MessageHandler(Filters.text, cantidadBobinasEntregadas)],
-
-            CANTIDAD_OSAKIDETZA_PREPARADA: [MessageHandler(Filters.text, cantidadOsakidetzaPreparada)],
-            CANTIDAD_ANTERIOR_PREPARADA: [MessageHandler(Filters.text, cantidadAnteriorPreparada)],
-            MUNICIPIO: [MessageHandler(Filters.text, municipio)],
-            DIRECCION: [MessageHandler(Filters.text, direccion)],
-            HORARIO: [MessageHandler(Filters.text, horario)],
-            TELEFONO: [MessageHandler(Filters.all, telefono)],
-
-            ConversationHandler.TIMEOUT: [MessageHandler(Filters.all, conversationTimeout)]
-        },
-        fallbacks=[Handler(cancel, pass_update_queue=True, pass_job_queue=True, pass_user_data=True, pass_chat_data=True)],
-        allow_reentry=True,
-        conversation_timeout = timeout
-    )
+    # Las conversaciones a medias sobreviven a los reinicios salvo que se desactive en [telegram] persistencia
+    # Con varios procesos cada trabajador tiene la suya
+    persistence = None
+    if ajustes.telegram.persistencia and not procesos:
+        from persistencia import SQLitePersistence
+        persistence = SQLitePersistence(persistencePath, timeout)
+        logger.info("  - Persistence Path: %s", persistencePath)
 
-    dp.add_handler(conv_handler)    
+    workers = ajustes.webhook.workers if webhookMode else 4
+    updater = Updater(telegramToken, workers=workers, use_context=True, persistence=persistence)
+    dp = updater.dispatcher
+    outbox.start(updater.bot)
+
+    # Conversation handlers, en este proceso o repartidos entre los trabajadores
+    global pool
+    if procesos:
+        from reparto import ShardPool
+        pool = ShardPool(procesos, trabajador, (telegramToken, timeout, procesos), onMessage=filaDeTrabajador,
+                queueSize=ajustes.procesos.cola)
+        pool.start()
+        dp.add_handler(TypeHandler(Update, lambda update, context: pool.route(update)))
+        COLAS.setFunction(pool.pending, "reparto")
+    else:
+        acotarUserData(dp, timeout)
+        conv_handler = buildConversationHandler(timeout, persistent=persistence is not None)
+        dp.add_handler(conv_handler)
+        conv_handler.start(dp)      # Caducan también las conversaciones restauradas de la persistencia
+
+    # Comandos de administración, antes que la conversación
+    dp.add_handler(CommandHandler('estado', estado), group=-1)
+    dp.add_handler(CommandHandler('resumen', resumen), group=-1)
+    dp.add_handler(CommandHandler('recogidas', recogidasPendientes), group=-1)
+    dp.add_handler(CommandHandler('difundir', difundir), group=-1)
+    dp.add_handler(CommandHandler('difusion', estadoDifusion), group=-1)
+    dp.add_handler(CommandHandler('perfil', perfil), group=-1)
+
+    # Difusiones de /difundir: las que se quedaron a medias siguen donde iban
+    global difusor
+    from difusion import BroadcastStore, Broadcaster
+    difusor = Broadcaster(BroadcastStore(broadcastPath), outbox,
+            rate=ajustes.difusion.rate, ventana=ajustes.difusion.ventana, onFinish=finDifusion)
+    difusor.start()
+    dp.add_handler(TypeHandler(Update, desbloquear), group=-2)
+
+    # La copia local de la hoja se pone al día cada [espejo] intervalo segundos (0 = solo al arrancar)
+    intervaloEspejo = ajustes.espejo.intervalo
+    if intervaloEspejo:
+        updater.job_queue.run_repeating(sincronizarEspejo, intervaloEspejo, first=intervaloEspejo, name="espejo")
+
+    # Métricas en formato Prometheus en [metricas] listen:port (port = 0 las desactiva)
+    COLAS.setFunction(dp.update_queue.qsize, "updates")
+    COLAS.setFunction(sheetWriter.pending, "sheets")
+    COLAS.setFunction(outbox.pending, "envios")
+    metricsServer = None
+    metricsPort = ajustes.metricas.port
+    if metricsPort:
+        metricsServer = MetricsServer(ajustes.metricas.listen, metricsPort)
+        metricsServer.start()
 
     # log errores
     dp.add_error_handler(error)
+
+    vigilarConfiguracion()
+    escucharSenales()
     
-    updater.start_polling()
-    updater.idle()     # El bot sigue corriendo hasta que se pulse Ctrl+C
+    if webhookMode:
+        from webhook import WebhookServer, WebhookRunner
+        # Telegram envía los updates a un servidor HTTP local en lugar de hacer polling
+        server = WebhookServer(dp,
+                listen=ajustes.webhook.listen,
+                port=ajustes.webhook.port,
+                urlPath=ajustes.webhook.url_path,
+                secretToken=ajustes.webhook.secret_token,
+                queueSize=ajustes.webhook.queue_size)
+        runner = WebhookRunner(updater, server, publicUrl=ajustes.webhook.public_url)
+        runner.start()
+        runner.idle()      # El bot sigue corriendo hasta que se pulse Ctrl+C
+    else:
+        updater.start_polling()
+        updater.idle()     # El bot sigue corriendo hasta que se pulse Ctrl+C
+
+    configuracion.stop()
+    perfilador.stop()
+    if metricsServer is not None:
+        metricsServer.stop()
+
+    # Los trabajadores terminan lo que tienen encolado y mandan sus últimas filas
+    if pool is not None:
+        logger.info("Procesos trabajadores: %s", pool.stop(timeout=30))
+
+    # Envía y escribe lo que quede pendiente antes de salir. Lo que quede de las difusiones sigue al arrancar
+    difusor.stop()
+    outbox.stop(timeout=10)
+    difusor.store.close()
+    copiaHoja.close()
+    journalReplayer.stop()
+    sheetWriter.stop()
+    journal.compact()
+    journal.close()
+    logger.info("Estado de la sesión de Google Sheets: %s", sheetSession.stats())
+    logger.info("Estado de la escritura en Google Sheets: %s", sheetWriter.stats())
+    logger.info("Registros de mensajes descartados por muestreo: %s", logSetup.sampler.descartados)
+    logSetup.stop()
 
 if __name__ == '__main__':
     main()
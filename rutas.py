@@ -0,0 +1,182 @@
+""" Índice de recogidas pendientes de RespiraBot para preparar las rutas.
+Cada recogida programada entra en el índice con la clave (provincia, municipio, horario), todo normalizado,
+y una entrega confirmada ("Confirmar" con un sí, flujo.esSi) del mismo user_id quita sus recogidas pendientes.
+Las consultas por municipio o por horario van directamente a sus claves sin recorrer todas las recogidas.
+
+Se alimenta con las filas ya serializadas por esquema.py, en el orden en que se guardaron. Para ver
+una ruta sin el bot, a partir de la copia local de la hoja y de lo que aún está en el diario:
+    python3 rutas.py logs/espejo.db Getxo [--horario Tarde]
+"""
+
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+from esquema import CONFIRMADAS, PROGRAMADAS
+from flujo import esSi, normalizar
+
+
+class Pickup:
+    """ Una recogida pendiente """
+    __slots__ = ("userId", "nombre", "provincia", "municipio", "direccion", "horario", "telefono",
+                 "osakidetza", "anterior", "fecha")
+
+    def __init__(self, schema, row):
+        def valor(columna):
+            return row[schema.position(columna)]
+        self.userId = valor("user_id")
+        self.nombre = " ".join(str(v) for v in (valor("nombre"), valor("apellido")) if v and v != "NA")
+        self.provincia = valor("provincia")
+        self.municipio = valor("municipio")
+        self.direccion = valor("direccion")
+        self.horario = valor("horario")
+        self.telefono = valor("telefono")
+        self.osakidetza = valor("cantidad_osakidetza_preparada")
+        self.anterior = valor("cantidad_anterior_preparada")
+        self.fecha = valor("Fecha fin")
+
+    def texto(self):
+        return "%s - %s (%s), %s. Tel: %s. Osakidetza: %s, anterior: %s" % (self.horario, self.direccion,
+                self.municipio, self.nombre, self.telefono, self.osakidetza, self.anterior)
+
+
+def claveUsuario(userId):
+    """ Los user_id leídos de la hoja son texto y los del bot números """
+    return str(userId)
+
+
+class PickupIndex:
+    """ Recogidas pendientes por (provincia, municipio, horario) normalizados
+        - add(schema, row): una programada se añade y una confirmada con entrega quita las de ese usuario
+        - batch(municipio, horario, provincia): recogidas de un municipio y/o un horario
+        Índices secundarios por municipio y por horario con las claves completas que tienen recogidas,
+        así cada consulta solo visita los grupos que devuelve.
+        - municipios: municipios.Gazetteer. Con él, el municipio de cada recogida y el de cada consulta se
+          pasan a su nombre oficial, así "Donostia", "Bilbo" o "Vitoria" encuentran las guardadas con el oficial
+    """
+
+    def __init__(self, municipios=None):
+        self.municipios = municipios
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._grupos = defaultdict(dict)         # clave -> {id: Pickup}
+            self._porMunicipio = defaultdict(set)    # municipio -> claves
+            self._porHorario = defaultdict(set)      # horario -> claves
+            self._porUsuario = defaultdict(set)      # user_id -> {(clave, id)}
+            self._siguiente = 0
+            self.pendientes = 0
+
+    @staticmethod
+    def clave(provincia, municipio, horario):
+        return normalizar(str(provincia or "")), normalizar(str(municipio or "")), normalizar(str(horario or ""))
+
+    def add(self, schema, row):
+        if schema is PROGRAMADAS:
+            self._programada(Pickup(schema, row))
+        elif schema is CONFIRMADAS and esSi(row[schema.position("entregado_osakidetza")]):
+            self.done(row[schema.position("user_id")])
+
+    def municipio(self, texto, provincia=None):
+        """ Nombre oficial de texto si el Gazetteer lo reconoce sin dudas; si no, texto tal cual """
+        if self.municipios is None or not texto:
+            return texto
+        nombre, _ = self.municipios.resolve(str(texto), provincia)
+        return nombre or texto
+
+    def _programada(self, pickup):
+        clave = self.clave(pickup.provincia, self.municipio(pickup.municipio, pickup.provincia), pickup.horario)
+        with self._lock:
+            self._siguiente += 1
+            self._grupos[clave][self._siguiente] = pickup
+            self._porMunicipio[clave[1]].add(clave)
+            self._porHorario[clave[2]].add(clave)
+            self._porUsuario[claveUsuario(pickup.userId)].add((clave, self._siguiente))
+            self.pendientes += 1
+
+    def done(self, userId):
+        """ Quita las recogidas pendientes de userId. Devuelve cuántas se han quitado """
+        with self._lock:
+            entradas = self._porUsuario.pop(claveUsuario(userId), ())
+            for clave, pickupId in entradas:
+                grupo = self._grupos[clave]
+                del grupo[pickupId]
+                if not grupo:
+                    del self._grupos[clave]
+                    self._porMunicipio[clave[1]].discard(clave)
+                    if not self._porMunicipio[clave[1]]:
+                        del self._porMunicipio[clave[1]]
+                    self._porHorario[clave[2]].discard(clave)
+                    if not self._porHorario[clave[2]]:
+                        del self._porHorario[clave[2]]
+            self.pendientes -= len(entradas)
+            return len(entradas)
+
+    def batch(self, municipio=None, horario=None, provincia=None):
+        """ Recogidas pendientes que cumplen los filtros dados, en el orden en que se programaron """
+        municipio = normalizar(self.municipio(municipio, provincia)) if municipio else None
+        horario = normalizar(horario) if horario else None
+        provincia = normalizar(provincia) if provincia else None
+        with self._lock:
+            if municipio is not None:
+                claves = set(self._porMunicipio.get(municipio, ()))
+            elif horario is not None:
+                claves = set(self._porHorario.get(horario, ()))
+            else:
+                claves = set(self._grupos)
+            claves = [c for c in claves if (horario is None or c[2] == horario) and (provincia is None or c[0] == provincia)]
+            recogidas = [item for clave in claves for item in self._grupos[clave].items()]
+        return [pickup for _, pickup in sorted(recogidas, key=lambda item: item[0])]
+
+    def summary(self):
+        """ Número de recogidas pendientes por (provincia, municipio, horario) """
+        with self._lock:
+            return {clave: len(grupo) for clave, grupo in self._grupos.items()}
+
+    def rebuild(self, filas):
+        """ Vuelve a crear el índice a partir de (schema, row), ordenadas por fecha de fin """
+        self.clear()
+        for schema, row in sorted(filas, key=lambda fila: _fecha(fila[1][fila[0].position("Fecha fin")])):
+            self.add(schema, row)
+        return self.pendientes
+
+
+def _fecha(texto):
+    try:
+        return datetime.strptime(str(texto), "%d/%m/%Y %H:%M:%S")
+    except ValueError:
+        return datetime.min
+
+
+def main():
+    import argparse
+    import os
+    from espejo import ajustesBot, guardadas
+    from municipios import Gazetteer
+
+    carpeta = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Recogidas pendientes a partir de lo guardado, sin conexión")
+    parser.add_argument("espejo", help="ruta de logs/espejo.db, la copia local de la hoja principal")
+    parser.add_argument("municipio", nargs="?", help="municipio (todos si no se indica)")
+    parser.add_argument("--horario", help="Mañana, Tarde o Todo el día")
+    parser.add_argument("--provincia")
+    parser.add_argument("--diario", default=os.path.join(carpeta, "logs", "journal.db"),
+                        help="diario con las filas que aún no han llegado a la hoja (logs/journal.db)")
+    parser.add_argument("--ini", default=os.path.join(carpeta, "respirabot.ini"),
+                        help="configuración del bot, de la que salen la hoja principal y los nombres de las pestañas")
+    args = parser.parse_args()
+
+    hoja, pestanas = ajustesBot(args.ini)
+    index = PickupIndex(Gazetteer())
+    index.rebuild(guardadas(args.espejo, args.diario, hoja, pestanas))
+
+    recogidas = index.batch(args.municipio, args.horario, args.provincia)
+    for pickup in recogidas:
+        print(pickup.texto())
+    print("%s recogidas de %s pendientes" % (len(recogidas), index.pendientes))
+
+
+if __name__ == '__main__':
+    main()
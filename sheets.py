@@ -0,0 +1,507 @@
+""" Acceso a Google Sheets para RespiraBot.
+Mantiene una única sesión autorizada durante toda la vida del bot en lugar de volver a
+autenticarse en cada envío, y cachea los objetos Worksheet para no repetir client.open().
+Las escrituras se hacen en segundo plano y por lotes a través de SheetWriter, con una cola,
+reintentos y estado de salud independientes para cada hoja de destino.
+gspread y oauth2client se importan al autorizar la sesión: el resto del bot no los necesita para arrancar.
+"""
+
+import concurrent.futures
+import logging
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from metricas import Counter, Histogram
+
+logger = logging.getLogger("respirabot.sheets")
+
+SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+# Margen con el que se renueva el token de OAuth antes de que caduque
+REFRESH_MARGIN = timedelta(minutes=5)
+
+SHEETS_LATENCY = Histogram("respirabot_sheets_llamada_segundos",
+        "Duración de cada intento de append_rows por hoja de destino", ["destino"])
+SHEETS_ERRORS = Counter("respirabot_sheets_errores_total",
+        "Intentos de escritura fallidos o descartados por destino caído", ["destino"])
+SHEETS_TIMEOUTS = Counter("respirabot_sheets_sin_respuesta_total",
+        "Llamadas a append_rows que han pasado del timeout sin terminar", ["destino"])
+
+# Resultado de una escritura que no ha terminado cuando se para SheetWriter: puede haberse hecho o no
+DESCONOCIDO = None
+
+
+class OutcomeUnknown(Exception):
+    """ La llamada a Google sigue en marcha y no se sabe si las filas se han escrito """
+
+
+# Respuestas de la API que indican que la sesión o el Worksheet cacheado ya no valen. El resto (429 de
+# cuota, 5xx) no se arreglan abriéndolo de nuevo: se dejan a los reintentos con espera de WritePolicy
+STATUS_INVALIDO = (401, 404)
+
+
+def _worksheetInvalid(error):
+    """ True si error indica que hay que volver a abrir el Worksheet y renovar la sesión """
+    from gspread.exceptions import APIError, WorksheetNotFound
+    if isinstance(error, WorksheetNotFound):
+        return True
+    if isinstance(error, APIError):
+        return getattr(getattr(error, "response", None), "status_code", None) in STATUS_INVALIDO
+    return False
+
+
+class SheetSession:
+    """ Sesión de larga duración contra la API de Google Sheets
+        - Autoriza una sola vez con los credenciales de clientSecretPath
+        - Renueva el token de OAuth antes de que caduque
+        - Cachea los Worksheet por (hoja de cálculo, pestaña) y los reconstruye si fallan
+    """
+
+    def __init__(self, clientSecretPath, scope=SCOPE, refreshMargin=REFRESH_MARGIN):
+        self.clientSecretPath = clientSecretPath
+        self.scope = scope
+        self.refreshMargin = refreshMargin
+        self.client = None
+        self._worksheets = {}
+        self._lock = threading.RLock()
+
+        # Contadores expuestos para diagnóstico
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.reauths = 0
+        self.invalidations = 0
+
+    def authorize(self):
+        """ Crea el cliente autorizado. Se llama una vez al arrancar el bot """
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
+
+        with self._lock:
+            creds = ServiceAccountCredentials.from_json_keyfile_name(self.clientSecretPath, self.scope)
+            self.client = gspread.authorize(creds)
+            self.client.login()
+            self._worksheets.clear()
+            logger.info("Sesión de Google Sheets autorizada")
+        return self.client
+
+    def _tokenExpiry(self):
+        """ Fecha de caducidad del token actual (UTC) o None si no se conoce """
+        auth = self.client.auth
+        # google-auth usa 'expiry' y oauth2client 'token_expiry'
+        return getattr(auth, "expiry", None) or getattr(auth, "token_expiry", None)
+
+    def _ensureFresh(self):
+        """ Autoriza si no hay cliente y renueva el token si está a punto de caducar """
+        if self.client is None:
+            self.authorize()
+            return
+
+        expiry = self._tokenExpiry()
+        if expiry is None or expiry - datetime.utcnow() < self.refreshMargin:
+            self.client.login()
+            self.reauths += 1
+            logger.info("Token de Google Sheets renovado (%s renovaciones)", self.reauths)
+
+    def worksheet(self, spreadsheet, sheetName):
+        """ Devuelve el Worksheet de la cache o lo abre si no está """
+        key = (spreadsheet, sheetName)
+        with self._lock:
+            self._ensureFresh()
+            ws = self._worksheets.get(key)
+            if ws is not None:
+                self.cacheHits += 1
+                return ws
+
+            self.cacheMisses += 1
+            ws = self.client.open(spreadsheet).worksheet(sheetName)
+            self._worksheets[key] = ws
+            return ws
+
+    def invalidate(self, spreadsheet, sheetName):
+        """ Elimina un Worksheet de la cache para que se vuelva a abrir en el siguiente uso """
+        with self._lock:
+            if self._worksheets.pop((spreadsheet, sheetName), None) is not None:
+                self.invalidations += 1
+
+    def call(self, spreadsheet, sheetName, operation):
+        """ Ejecuta operation(worksheet) y, si el Worksheet cacheado ha dejado de ser válido (pestaña que
+            ya no existe, 401 o 404), lo reconstruye y lo intenta una segunda vez. Los demás errores se lanzan
+        """
+        ws = self.worksheet(spreadsheet, sheetName)
+        try:
+            return operation(ws)
+        except Exception as e:
+            if not _worksheetInvalid(e):
+                raise
+            logger.warning("Worksheet %s/%s no válido (%s), se vuelve a abrir", spreadsheet, sheetName, e)
+            self.invalidate(spreadsheet, sheetName)
+            with self._lock:
+                self.client.login()
+                self.reauths += 1
+            return operation(self.worksheet(spreadsheet, sheetName))
+
+    def appendRow(self, spreadsheet, sheetName, row):
+        """ Añade una fila en la pestaña sheetName de la hoja spreadsheet """
+        return self.call(spreadsheet, sheetName,
+                lambda ws: ws.append_row(row, value_input_option='USER_ENTERED'))
+
+    def stats(self):
+        """ Contadores de la sesión """
+        return {"cache_hits": self.cacheHits,
+                "cache_misses": self.cacheMisses,
+                "reauths": self.reauths,
+                "invalidations": self.invalidations,
+                "cached_worksheets": len(self._worksheets)}
+
+
+class WritePolicy:
+    """ Política de escritura de un destino
+        - timeout: segundos máximos por llamada a append_rows
+        - retries: reintentos tras el primer fallo
+        - backoff / backoffMax: espera inicial y máxima entre reintentos (se dobla en cada uno)
+        - failureThreshold: lotes fallidos seguidos para dar el destino por caído
+        - cooldown: segundos que se deja de intentar escribir en un destino caído
+    """
+
+    def __init__(self, timeout=10.0, retries=3, backoff=1.0, backoffMax=30.0, failureThreshold=3, cooldown=60.0):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoffMax = backoffMax
+        self.failureThreshold = failureThreshold
+        self.cooldown = cooldown
+
+
+class DestinationHealth:
+    """ Estado de salud de un destino: ok / degradado / caido """
+
+    OK = "ok"
+    DEGRADED = "degradado"
+    DOWN = "caido"
+
+    def __init__(self):
+        self.state = self.OK
+        self.consecutiveFailures = 0
+        self.lastSuccess = None
+        self.lastError = None
+        self.downUntil = 0.0
+
+    def available(self):
+        """ False mientras el destino esté caído y no haya pasado el tiempo de espera """
+        return self.state != self.DOWN or time.monotonic() >= self.downUntil
+
+    def slow(self, error):
+        """ Una llamada no ha respondido a tiempo pero no se sabe si ha fallado """
+        self.lastError = repr(error)
+        if self.state == self.OK:
+            self.state = self.DEGRADED
+
+    def success(self):
+        self.state = self.OK
+        self.consecutiveFailures = 0
+        self.lastSuccess = datetime.now()
+
+    def failure(self, error, policy):
+        self.consecutiveFailures += 1
+        self.lastError = repr(error)
+        if self.consecutiveFailures >= policy.failureThreshold:
+            self.state = self.DOWN
+            self.downUntil = time.monotonic() + policy.cooldown
+        else:
+            self.state = self.DEGRADED
+
+    def asDict(self):
+        return {"state": self.state,
+                "consecutive_failures": self.consecutiveFailures,
+                "last_success": self.lastSuccess.isoformat() if self.lastSuccess else None,
+                "last_error": self.lastError}
+
+
+class SheetWriter:
+    """ Cola de escritura diferida hacia Google Sheets
+        Los handlers encolan la fila y vuelven inmediatamente. Cada hoja de destino (principal y backup)
+        tiene su propia cola y sus propios hilos, así que se escriben en paralelo y un destino lento o
+        caído no retrasa ni bloquea al otro.
+        Los hilos agrupan las filas por pestaña en una sola llamada append_rows, que se hace cuando el
+        lote llega a batchSize filas o cuando pasan batchWindow segundos.
+        Si se indica onResult, se llama como onResult(spreadsheet, entryIds, ok) después de cada
+        escritura con los identificadores del diario que iban en ella. Las filas que fallan se quedan
+        sin confirmar en el diario y JournalReplayer las vuelve a enviar cuando el destino se recupera.
+        Una llamada que pasa del timeout no se da por fallida: Google puede terminar escribiendo las filas,
+        así que se espera a que acabe antes de reintentar. Solo si se para SheetWriter con ella aún en
+        marcha, ok es DESCONOCIDO (None).
+    """
+
+    def __init__(self, session, batchSize=20, batchWindow=2.0, flushers=1, onResult=None,
+                 policy=None, policies=None):
+        self.session = session
+        self.onResult = onResult
+        self.batchSize = max(1, batchSize)
+        self.batchWindow = batchWindow
+        self.numFlushers = max(1, flushers)
+        self.policy = policy or WritePolicy()
+        self.policies = policies or {}
+        self._destinations = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _destination(self, spreadsheet):
+        """ Devuelve el destino de spreadsheet creándolo (y arrancándolo) si no existe """
+        with self._lock:
+            destination = self._destinations.get(spreadsheet)
+            if destination is None:
+                destination = _Destination(self, spreadsheet, self.policies.get(spreadsheet, self.policy))
+                self._destinations[spreadsheet] = destination
+                if self._started:
+                    destination.start()
+            return destination
+
+    def start(self):
+        """ Arranca los hilos de todos los destinos conocidos y los que se vayan creando """
+        with self._lock:
+            self._started = True
+            for destination in self._destinations.values():
+                destination.start()
+        logger.info("SheetWriter iniciado: %s hilos por destino, lotes de %s filas o %s segundos",
+                    self.numFlushers, self.batchSize, self.batchWindow)
+
+    def submit(self, spreadsheet, sheetName, row, entryId=None):
+        """ Encola una fila para la pestaña sheetName de la hoja spreadsheet
+            - entryId: identificador de la fila en el diario local, si lo tiene
+        """
+        self._destination(spreadsheet).queue.put((sheetName, row, entryId))
+
+    def pending(self):
+        """ Número aproximado de filas esperando en todas las colas """
+        with self._lock:
+            return sum(d.queue.qsize() for d in self._destinations.values())
+
+    def health(self, spreadsheet):
+        """ Estado de salud del destino spreadsheet """
+        return self._destination(spreadsheet).health
+
+    def stop(self, timeout=None):
+        """ Detiene los hilos de todos los destinos escribiendo antes lo que quede pendiente """
+        with self._lock:
+            self._started = False
+            destinations = list(self._destinations.values())
+        for destination in destinations:
+            destination.stop(timeout)
+        stats = self.stats()
+        logger.info("SheetWriter detenido. %s filas escritas en %s lotes, %s errores",
+                    stats["rows_written"], stats["batches_written"], stats["errors"])
+
+    def stats(self):
+        """ Contadores de la cola de escritura, totales y por destino """
+        with self._lock:
+            destinations = {name: d.stats() for name, d in self._destinations.items()}
+        return {"pending": sum(d["pending"] for d in destinations.values()),
+                "rows_written": sum(d["rows_written"] for d in destinations.values()),
+                "batches_written": sum(d["batches_written"] for d in destinations.values()),
+                "errors": sum(d["errors"] for d in destinations.values()),
+                "destinations": destinations}
+
+
+class _Destination:
+    """ Cola, hilos, política y estado de salud de una hoja de destino de SheetWriter """
+
+    def __init__(self, writer, spreadsheet, policy):
+        self.writer = writer
+        self.spreadsheet = spreadsheet
+        self.policy = policy
+        self.health = DestinationHealth()
+        self.queue = queue.Queue()
+        self._threads = []
+        # Las llamadas a la API se hacen en este pool para poder esperarlas con timeout. Cada hilo tiene
+        # como mucho una llamada en marcha, así que una que no responde no deja sin sitio a las demás
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+        self.rowsWritten = 0
+        self.batchesWritten = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.unknown = 0
+        self._latency = SHEETS_LATENCY.labels(spreadsheet)
+        self._errorCount = SHEETS_ERRORS.labels(spreadsheet)
+        self._timeoutCount = SHEETS_TIMEOUTS.labels(spreadsheet)
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping.clear()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.writer.numFlushers,
+                thread_name_prefix="SheetCall-%s" % self.spreadsheet)
+        for i in range(self.writer.numFlushers):
+            t = threading.Thread(target=self._run, name="SheetWriter-%s-%s" % (self.spreadsheet, i), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=None):
+        # Una llamada sin respuesta deja de esperarse en el siguiente timeout y sus filas quedan DESCONOCIDO
+        self._stopping.set()
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for t in self._threads:
+            t.join(timeout)
+        if any(t.is_alive() for t in self._threads) and self._executor is not None:
+            # Un hilo sigue esperando a Google: lo que quede no se pone detrás de su llamada
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._threads = []
+
+        # Lo que se haya encolado después de la parada se escribe aquí mismo
+        batch = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                batch.append(item)
+        if batch:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self._flush(batch)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _run(self):
+        batchSize = self.writer.batchSize
+        batchWindow = self.writer.batchWindow
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + batchWindow
+            stopping = False
+            while len(batch) < batchSize:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch):
+        """ Agrupa las filas del lote por pestaña y las escribe con un solo append_rows por pestaña """
+        groups = {}
+        for sheetName, row, entryId in batch:
+            rows, entryIds = groups.setdefault(sheetName, ([], []))
+            rows.append(row)
+            if entryId is not None:
+                entryIds.append(entryId)
+
+        for sheetName, (rows, entryIds) in groups.items():
+            ok = self._write(sheetName, rows)
+            if ok is DESCONOCIDO:
+                logger.error("Se para la escritura con %s filas de %s/%s sin saber si se han guardado; se "
+                        "reenviarán al arrancar, conviene revisar la hoja por si quedan duplicadas (diario: %s)",
+                        len(rows), self.spreadsheet, sheetName, entryIds)
+            onResult = self.writer.onResult
+            if onResult is not None and entryIds:
+                onResult(self.spreadsheet, entryIds, ok)
+
+    def _wait(self, future, sheetName, rows):
+        """ Resultado de la llamada. Si pasa del timeout se sigue esperando, porque Google puede acabar
+            escribiendo las filas y reintentar antes las duplicaría. Lanza OutcomeUnknown si se para mientras
+        """
+        policy = self.policy
+        try:
+            return future.result(timeout=policy.timeout)
+        except concurrent.futures.TimeoutError:
+            pass
+        error = TimeoutError("Sin respuesta de %s en %s segundos" % (self.spreadsheet, policy.timeout))
+        with self._lock:
+            self.timeouts += 1
+        self._timeoutCount.inc()
+        self.health.slow(error)
+        logger.warning("%s/%s no ha respondido en %s s con %s filas; se espera a que termine antes de reintentar",
+                       self.spreadsheet, sheetName, policy.timeout, len(rows))
+        esperado = policy.timeout
+        while True:
+            try:
+                return future.result(timeout=policy.timeout)
+            except concurrent.futures.TimeoutError:
+                esperado += policy.timeout
+                if self._stopping.is_set():
+                    raise OutcomeUnknown("%s/%s sin respuesta tras %s s" % (self.spreadsheet, sheetName, esperado))
+                logger.warning("%s/%s sigue sin responder tras %s s", self.spreadsheet, sheetName, esperado)
+
+    def _write(self, sheetName, rows):
+        """ Escribe rows con timeout y reintentos con espera exponencial
+            Devuelve True si se ha escrito, False si ha fallado y DESCONOCIDO si se ha parado sin saberlo
+        """
+        policy = self.policy
+        if not self.health.available():
+            logger.warning("%s está caído, %s filas de %s se quedan pendientes en el diario",
+                           self.spreadsheet, len(rows), sheetName)
+            with self._lock:
+                self.errors += 1
+            self._errorCount.inc()
+            return False
+
+        delay = policy.backoff
+        for attempt in range(policy.retries + 1):
+            future = self._executor.submit(self.writer.session.call, self.spreadsheet, sheetName,
+                    lambda ws: ws.append_rows(rows, value_input_option='USER_ENTERED'))
+            t0 = time.perf_counter()
+            try:
+                self._wait(future, sheetName, rows)
+                self._latency.observe(time.perf_counter() - t0)
+                self.health.success()
+                with self._lock:
+                    self.rowsWritten += len(rows)
+                    self.batchesWritten += 1
+                logger.info("Guardadas %s filas en %s/%s", len(rows), self.spreadsheet, sheetName)
+                return True
+            except OutcomeUnknown:
+                with self._lock:
+                    self.unknown += 1
+                return DESCONOCIDO
+            except Exception as e:
+                self._latency.observe(time.perf_counter() - t0)
+                self._errorCount.inc()
+                with self._lock:
+                    self.errors += 1
+                logger.warning("Intento %s de guardar %s filas en %s/%s fallido: %r",
+                               attempt + 1, len(rows), self.spreadsheet, sheetName, e)
+                self.health.failure(e, policy)
+                if not self.health.available() or attempt == policy.retries:
+                    break
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, policy.backoffMax)
+
+        logger.error("No se han podido guardar %s filas en %s/%s (%s): %s",
+                     len(rows), self.spreadsheet, sheetName, self.health.state, rows)
+        return False
+
+    def stats(self):
+        with self._lock:
+            return {"pending": self.queue.qsize(),
+                    "rows_written": self.rowsWritten,
+                    "batches_written": self.batchesWritten,
+                    "errors": self.errors,
+                    "timeouts": self.timeouts,
+                    "unknown": self.unknown,
+                    "health": self.health.asDict()}
+
+
+# Marca para detener los hilos de SheetWriter
+_STOP = object()
@@ -0,0 +1,9 @@
+""" Pruebas de RespiraBot: python3 -m pytest tests
+Los módulos del bot están en la carpeta raíz, como en benchmarks/
+"""
+
+import os
+import sys
+
+ownPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ownPath)
@@ -0,0 +1,100 @@
+""" Recarga de respirabot.ini (configuracion.ConfigWatcher) """
+
+import os
+
+import pytest
+
+from configuracion import ConfigError, ConfigWatcher
+
+OPCIONES = (
+    ("telegram", "token_dev", str, True, None),
+    ("telegram", "timeout", int, False, 300),
+    ("envios", "global_rate", float, False, 30.0),
+)
+
+VALIDO = """[telegram]
+token_dev = 123:abc
+timeout = 120
+
+[envios]
+global_rate = 25
+"""
+
+
+def escribir(path, texto, version):
+    """ Escribe el fichero con una fecha de modificación distinta en cada versión """
+    with open(path, "w", encoding="utf8") as f:
+        f.write(texto)
+    os.utime(path, ns=(version * 10 ** 9, version * 10 ** 9))
+
+
+@pytest.fixture
+def ini(tmp_path):
+    path = str(tmp_path / "respirabot.ini")
+    escribir(path, VALIDO, 1)
+    return path
+
+
+def test_foto_con_tipos_y_defectos(ini):
+    watcher = ConfigWatcher(ini, OPCIONES)
+    assert watcher.current.telegram.timeout == 120
+    assert watcher.current.envios.global_rate == 25.0
+    with pytest.raises(AttributeError):
+        watcher.current.telegram = None
+
+
+def test_sin_cambios_no_recarga(ini):
+    watcher = ConfigWatcher(ini, OPCIONES)
+    assert watcher.check() is False
+    assert watcher.reloads == 0
+
+
+def test_recarga_valida_avisa_de_los_cambios(ini):
+    cambios = []
+    watcher = ConfigWatcher(ini, OPCIONES, onChange=lambda anterior, nueva: cambios.append(nueva.diff(anterior)))
+    escribir(ini, VALIDO.replace("timeout = 120", "timeout = 60"), 2)
+
+    assert watcher.check() is True
+    assert watcher.current.telegram.timeout == 60
+    assert cambios == [[("telegram", "timeout")]]
+
+
+@pytest.mark.parametrize("texto", [
+    VALIDO.replace("timeout = 120", "timeout = mucho"),
+    VALIDO.replace("token_dev = 123:abc", ""),
+    "[telegram\nroto",
+])
+def test_recarga_no_valida_se_descarta_y_sigue_la_anterior(ini, texto):
+    cambios = []
+    watcher = ConfigWatcher(ini, OPCIONES, onChange=lambda anterior, nueva: cambios.append(nueva))
+    anterior = watcher.current
+    escribir(ini, texto, 2)
+
+    assert watcher.check() is False
+    assert watcher.current is anterior
+    assert watcher.rejected == 1
+    assert cambios == []
+    # El mismo fichero erróneo no se vuelve a leer ni a contar
+    assert watcher.check() is False
+    assert watcher.rejected == 1
+
+
+def test_validar_anade_errores(ini):
+    watcher = ConfigWatcher(ini, OPCIONES, validar=lambda parser: ["timeout demasiado corto"]
+            if parser.getint("telegram", "timeout") < 100 else [])
+    anterior = watcher.current
+    escribir(ini, VALIDO.replace("timeout = 120", "timeout = 60"), 2)
+
+    assert watcher.check() is False
+    assert watcher.current is anterior
+    with pytest.raises(ConfigError) as error:
+        watcher.load()
+    assert error.value.errores == ["timeout demasiado corto"]
+
+
+def test_fichero_borrado_sigue_con_la_anterior(ini):
+    watcher = ConfigWatcher(ini, OPCIONES)
+    anterior = watcher.current
+    os.remove(ini)
+    assert watcher.check() is False
+    assert watcher.current is anterior
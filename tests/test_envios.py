@@ -0,0 +1,135 @@
+""" Cola de salida (envios.OutboundScheduler) con un reloj simulado y step(), sin hilos ni Telegram """
+
+from telegram.error import RetryAfter
+
+from envios import MAX_TEXTO, PRIORIDAD_MASIVO, SEPARADOR, OutboundScheduler
+
+
+class Reloj:
+    def __init__(self):
+        self.ahora = 100.0
+
+    def __call__(self):
+        return self.ahora
+
+
+class BotFalso:
+    """ Apunta (chat_id, texto, reply_markup) de cada envío. fallos: excepciones para los siguientes envíos """
+
+    def __init__(self):
+        self.enviados = []
+        self.fallos = []
+
+    def send_message(self, chatId, texto, reply_markup=None, **kwargs):
+        if self.fallos:
+            raise self.fallos.pop(0)
+        self.enviados.append((chatId, texto, reply_markup))
+
+
+def crear(**limites):
+    reloj = Reloj()
+    bot = BotFalso()
+    opciones = dict(globalRate=30.0, globalBurst=30, chatRate=1.0, chatBurst=1)
+    opciones.update(limites)
+    return OutboundScheduler(bot, clock=reloj, **opciones), bot, reloj
+
+
+def test_textos_seguidos_a_un_chat_se_juntan():
+    scheduler, bot, reloj = crear()
+    resultados = []
+    scheduler.send(1, "uno", onResult=lambda ok, error: resultados.append(ok))
+    scheduler.send(1, "dos", replyMarkup="teclado", onResult=lambda ok, error: resultados.append(ok))
+
+    assert scheduler.step() is None
+    assert bot.enviados == [(1, "uno" + SEPARADOR + "dos", "teclado")]
+    assert scheduler.coalesced == 1
+    assert resultados == [True, True]
+
+
+def test_el_limite_del_chat_retrasa_y_junta_lo_que_espera():
+    scheduler, bot, reloj = crear()
+    scheduler.send(1, "uno")
+    espera = scheduler.step()
+    assert bot.enviados == [(1, "uno", None)]
+    assert espera is None
+
+    # Sin token en el chat: los dos siguientes esperan juntos
+    scheduler.send(1, "dos")
+    scheduler.send(1, "tres")
+    espera = scheduler.step()
+    assert espera == 1.0
+    assert len(bot.enviados) == 1
+    assert scheduler.delayed == 1
+
+    reloj.ahora += espera
+    assert scheduler.step() is None
+    assert bot.enviados[1] == (1, "dos" + SEPARADOR + "tres", None)
+
+
+def test_no_se_juntan_textos_que_no_caben():
+    scheduler, bot, reloj = crear(chatBurst=5)
+    largo = "x" * (MAX_TEXTO - 1)
+    scheduler.send(1, largo)
+    scheduler.send(1, "dos")
+    scheduler.step()
+    assert [texto for _, texto, _ in bot.enviados] == [largo, "dos"]
+
+
+def test_no_se_juntan_textos_con_distintas_opciones():
+    scheduler, bot, reloj = crear(chatBurst=5)
+    scheduler.send(1, "uno", parse_mode="HTML")
+    scheduler.send(1, "dos")
+    scheduler.step()
+    assert len(bot.enviados) == 2
+
+
+def test_limite_global():
+    scheduler, bot, reloj = crear(globalRate=2.0, globalBurst=2)
+    for chatId in range(3):
+        scheduler.send(chatId, "hola")
+
+    espera = scheduler.step()
+    assert len(bot.enviados) == 2
+    assert espera == 0.5
+    assert scheduler.globalThrottles == 1
+
+    reloj.ahora += espera
+    assert scheduler.step() is None
+    assert [chatId for chatId, _, _ in bot.enviados] == [0, 1, 2]
+
+
+def test_conversacion_antes_que_masivo():
+    scheduler, bot, reloj = crear(globalRate=1.0, globalBurst=1)
+    scheduler.send(1, "difusión", prioridad=PRIORIDAD_MASIVO)
+    scheduler.send(2, "respuesta")
+
+    scheduler.step()
+    assert bot.enviados == [(2, "respuesta", None)]
+
+
+def test_retry_after_para_y_reintenta_el_mismo_mensaje():
+    scheduler, bot, reloj = crear(chatBurst=5)
+    bot.fallos.append(RetryAfter(3))
+    scheduler.send(1, "uno")
+
+    espera = scheduler.step()
+    assert bot.enviados == []
+    assert espera == 3
+    assert scheduler.retryAfters == 1
+
+    reloj.ahora += espera
+    assert scheduler.step() is None
+    assert bot.enviados == [(1, "uno", None)]
+
+
+def test_error_llama_a_on_result_con_el_error():
+    scheduler, bot, reloj = crear()
+    error = ValueError("chat no encontrado")
+    bot.fallos.append(error)
+    resultados = []
+    scheduler.send(1, "uno", onResult=lambda ok, e: resultados.append((ok, e)))
+
+    scheduler.step()
+    assert resultados == [(False, error)]
+    assert scheduler.errors == 1
+    assert scheduler.pending() == 0
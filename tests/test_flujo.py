@@ -0,0 +1,117 @@
+""" Pasos de la conversación (flujo.FLUJO) recorridos con ConversationEngine, sin Telegram """
+
+import configparser
+from types import SimpleNamespace
+
+import pytest
+
+from flujo import (CANTIDAD_OSAKIDETZA, CONFIRMACION_ENTREGA, CONFIRMAR_PROGRAMAR, DIAMETRO_PLA, FIN, FIN_SIN_SALVAR,
+                   FLUJO, MUNICIPIO, NO_ENTREGADO, PROVINCIA, ConversationEngine, esSi, normalizar)
+from mensajes import MessageCatalog
+from municipios import Gazetteer
+
+
+class Conversacion:
+    """ Un voluntario que contesta paso a paso. Guarda lo enviado y cómo terminó """
+
+    def __init__(self, municipios=None):
+        self.enviados = []
+        self.fin = None
+        self.noEntendidos = []
+        self.context = SimpleNamespace(user_data={})
+        self.engine = ConversationEngine(MessageCatalog(configparser.ConfigParser()),
+                lambda update, context: self._terminar(FIN), lambda update, context: self._terminar(FIN_SIN_SALVAR),
+                lambda update, context, teclado: self.noEntendidos.append(teclado),
+                enviar=lambda update, texto, teclado=None: self.enviados.append(texto), municipios=municipios)
+
+    def _terminar(self, fin):
+        self.fin = fin
+        return fin
+
+    def contestar(self, estado, texto):
+        update = SimpleNamespace(message=SimpleNamespace(text=texto, contact=None,
+                from_user=SimpleNamespace(id=1, first_name="Ane")), effective_user=SimpleNamespace(id=1))
+        return self.engine.handler(estado)(update, self.context)
+
+
+def test_flujo_compila():
+    engine = Conversacion().engine
+    assert set(engine.estados(lambda paso, callback: callback)) == set(FLUJO)
+
+
+@pytest.mark.parametrize("texto, siguiente", [
+    ("Confirmar recogida", CONFIRMACION_ENTREGA),
+    ("confirmar", CONFIRMACION_ENTREGA),
+    ("Programar recogida", FLUJO[CONFIRMAR_PROGRAMAR].opciones[0].siguiente),
+])
+def test_confirmar_o_programar(texto, siguiente):
+    conversacion = Conversacion()
+    assert conversacion.contestar(CONFIRMAR_PROGRAMAR, texto) == siguiente
+
+
+def test_opcion_no_entendida_se_queda_en_el_paso():
+    conversacion = Conversacion()
+    assert conversacion.contestar(CONFIRMACION_ENTREGA, "quizás") == CONFIRMACION_ENTREGA
+    assert conversacion.noEntendidos == ["si_no"]
+    assert "entregado_osakidetza" not in conversacion.context.user_data
+
+
+@pytest.mark.parametrize("texto", ["Sí", "si", "SI!", "Bai", "bai"])
+def test_entregado_si_en_castellano_y_euskera(texto):
+    conversacion = Conversacion()
+    assert conversacion.contestar(CONFIRMACION_ENTREGA, texto) == CANTIDAD_OSAKIDETZA
+    assert conversacion.context.user_data["entregado_osakidetza"] == "Sí"
+
+
+def test_no_entregado_lleva_a_preguntar_si_espera():
+    conversacion = Conversacion()
+    assert conversacion.contestar(CONFIRMACION_ENTREGA, "Ez") == NO_ENTREGADO
+    assert conversacion.context.user_data["entregado_osakidetza"] == "No"
+
+
+def test_no_entregado_y_espera_termina_sin_guardar():
+    """ Antes las dos ramas miraban "No" y la de esperar no se alcanzaba nunca """
+    conversacion = Conversacion()
+    assert conversacion.contestar(NO_ENTREGADO, "Sí") == FIN_SIN_SALVAR
+    assert conversacion.fin == FIN_SIN_SALVAR
+
+
+def test_no_entregado_y_no_espera_se_guarda_como_fallida():
+    conversacion = Conversacion()
+    assert conversacion.contestar(NO_ENTREGADO, "No") == FIN
+    assert conversacion.fin == FIN
+
+
+def test_numero_no_valido_repite_el_paso_con_su_error():
+    conversacion = Conversacion()
+    assert conversacion.contestar(CANTIDAD_OSAKIDETZA, "muchas") == CANTIDAD_OSAKIDETZA
+    assert "cantidad_osakidetza" not in conversacion.context.user_data
+    assert conversacion.enviados
+
+
+def test_diametro_no_entendido_guarda_err():
+    conversacion = Conversacion()
+    assert conversacion.contestar(DIAMETRO_PLA, "gordo") == DIAMETRO_PLA
+    assert conversacion.context.user_data["diametro"] == "Err"
+    assert conversacion.contestar(DIAMETRO_PLA, "1,75 mm") == FIN
+    assert conversacion.context.user_data["diametro"] == "1.75"
+
+
+def test_provincia_acepta_texto():
+    conversacion = Conversacion()
+    assert conversacion.contestar(PROVINCIA, "Bizkaia") == CONFIRMAR_PROGRAMAR
+    assert conversacion.context.user_data["provincia"] == "Bizkaia"
+
+
+def test_municipio_de_otra_provincia_se_pregunta_antes():
+    conversacion = Conversacion(Gazetteer())
+    conversacion.context.user_data["provincia"] = "Bizkaia"
+    assert conversacion.contestar(MUNICIPIO, "Eibar") == MUNICIPIO
+    assert conversacion.contestar(MUNICIPIO, "Eibar") == FLUJO[MUNICIPIO].siguiente
+    assert conversacion.context.user_data["municipio"] == "Eibar"
+
+
+def test_es_si_normaliza_las_filas_antiguas():
+    assert [esSi(valor) for valor in ("Sí", "Si", "si", "Bai", "No", "", None)] == \
+            [True, True, True, True, False, False, False]
+    assert normalizar("  ¿Sí? ") == "si"
@@ -0,0 +1,134 @@
+""" Diario local (journal.Journal) e índice de duplicados (journal.IdempotencyIndex) """
+
+import pytest
+
+from journal import IdempotencyIndex, Journal
+
+PRINCIPAL = "principal"
+BACKUP = "backup"
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = Journal(str(tmp_path / "journal.db"), [PRINCIPAL, BACKUP])
+    yield journal
+    journal.close()
+
+
+def ids(filas):
+    return [entryId for entryId, _, _ in filas]
+
+
+def test_pendientes_por_destino(journal):
+    primera = journal.append("Confirmadas", ["a"])
+    segunda = journal.append("Programadas", ["b"])
+    journal.ack(PRINCIPAL, [primera])
+
+    assert ids(journal.pending(PRINCIPAL)) == [segunda]
+    assert ids(journal.pending(BACKUP)) == [primera, segunda]
+    assert journal.pending(BACKUP)[1] == (segunda, "Programadas", ["b"])
+
+
+def test_ack_repetido_no_falla(journal):
+    entryId = journal.append("Confirmadas", ["a"])
+    journal.ack(PRINCIPAL, [entryId])
+    journal.ack(PRINCIPAL, [entryId])
+    assert journal.pending(PRINCIPAL) == []
+
+
+def test_compact_avanza_el_offset_solo_sobre_lo_contiguo(journal):
+    entradas = [journal.append("Confirmadas", [i]) for i in range(4)]
+    # La segunda sigue pendiente: el offset se queda justo antes de ella
+    journal.ack(PRINCIPAL, [entradas[0], entradas[2], entradas[3]])
+    journal.compact()
+
+    assert journal.offset(PRINCIPAL) == entradas[0]
+    assert ids(journal.pending(PRINCIPAL)) == [entradas[1]]
+
+    journal.ack(PRINCIPAL, [entradas[1]])
+    journal.compact()
+    assert journal.offset(PRINCIPAL) == entradas[3]
+    assert journal.pending(PRINCIPAL) == []
+
+
+def test_compact_borra_solo_lo_confirmado_en_todos_los_destinos(journal):
+    entradas = [journal.append("Confirmadas", [i]) for i in range(3)]
+    journal.ack(PRINCIPAL, entradas)
+    journal.ack(BACKUP, entradas[:1])
+
+    assert journal.compact() == 1
+    assert ids(journal.entries()) == entradas[1:]
+    assert journal.pending(PRINCIPAL) == []
+    assert ids(journal.pending(BACKUP)) == entradas[1:]
+
+    journal.ack(BACKUP, entradas[1:])
+    assert journal.compact() == 2
+    assert journal.entries() == []
+
+
+def test_offsets_y_pendientes_sobreviven_al_reabrir(tmp_path):
+    path = str(tmp_path / "journal.db")
+    journal = Journal(path, [PRINCIPAL, BACKUP])
+    entradas = [journal.append("Confirmadas", [i]) for i in range(3)]
+    journal.ack(PRINCIPAL, entradas[:2])
+    journal.ack(BACKUP, entradas)
+    journal.compact()
+    journal.close()
+
+    journal = Journal(path, [PRINCIPAL, BACKUP])
+    assert journal.offset(PRINCIPAL) == entradas[1]
+    assert journal.offset(BACKUP) == entradas[2]
+    assert ids(journal.pending(PRINCIPAL)) == [entradas[2]]
+    # Los ids nuevos siguen después de los ya borrados
+    assert journal.append("Confirmadas", ["otra"]) > entradas[2]
+    journal.close()
+
+
+def test_solo_lectura_no_puede_escribir(tmp_path):
+    path = str(tmp_path / "journal.db")
+    Journal(path, [PRINCIPAL]).close()
+    lectura = Journal(path, [PRINCIPAL], readOnly=True)
+    with pytest.raises(Exception):
+        lectura.append("Confirmadas", ["a"])
+    lectura.close()
+
+
+class Reloj:
+    def __init__(self):
+        self.ahora = 1000.0
+
+    def __call__(self):
+        return self.ahora
+
+
+def test_idempotencia_descarta_repetidas():
+    indice = IdempotencyIndex(ttl=60, maxSize=10, clock=Reloj())
+    assert indice.seen((1, "04/05/2020 10:00:00", "Confirmar")) is False
+    assert indice.seen((1, "04/05/2020 10:00:00", "Confirmar")) is True
+    assert indice.seen((1, "04/05/2020 10:00:00", "Programar")) is False
+    assert indice.duplicates == 1
+
+
+def test_idempotencia_caduca_por_ttl():
+    reloj = Reloj()
+    indice = IdempotencyIndex(ttl=60, maxSize=10, clock=reloj)
+    indice.seen("a")
+    reloj.ahora += 30
+    indice.seen("b")
+
+    reloj.ahora += 31
+    assert indice.seen("a") is False     # Caducada: se vuelve a registrar
+    assert indice.seen("b") is True
+    assert len(indice) == 2
+
+
+def test_idempotencia_nunca_pasa_de_max_size():
+    indice = IdempotencyIndex(ttl=60, maxSize=3, clock=Reloj())
+    for clave in "abcd":
+        indice.seen(clave)
+
+    assert len(indice) == 3
+    # Se olvida la más antigua
+    assert indice.seen("d") is True
+    assert indice.seen("a") is False
+    assert len(indice) == 3
@@ -0,0 +1,90 @@
+""" Persistencia en SQLite (persistencia.SQLitePersistence) y caducidad de las conversaciones restauradas """
+
+import queue
+import time
+
+import pytest
+from telegram.ext import CommandHandler, Dispatcher, JobQueue, MessageHandler, Filters
+
+from caducidad import ExpiringConversationHandler
+from persistencia import SQLitePersistence
+from usuarios import UserDataStore
+
+NOMBRE = "respirabot"
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "conversaciones.db")
+
+
+def test_conversacion_ausente_se_busca_una_sola_vez(path):
+    persistence = SQLitePersistence(path, 60)
+    conversations = persistence.get_conversations(NOMBRE)
+    consultas = []
+    cargar = persistence._loadConversation
+    persistence._loadConversation = lambda *args: consultas.append(args) or cargar(*args)
+
+    for _ in range(3):
+        assert conversations.get((1, 1)) is None
+        assert (1, 1) not in conversations
+    assert len(consultas) == 1
+
+    conversations[(1, 1)] = 2
+    assert conversations[(1, 1)] == 2
+    del conversations[(1, 1)]
+    assert (1, 1) not in conversations
+    assert len(consultas) == 1
+
+
+def test_conversacion_guardada_se_carga(path):
+    SQLitePersistence(path, 60).update_conversation(NOMBRE, (1, 1), 3)
+    conversations = SQLitePersistence(path, 60).get_conversations(NOMBRE)
+    assert conversations.get((1, 1)) == 3
+    assert conversations.stored()[0][0] == (1, 1)
+
+
+def test_expire_borra_usuarios_caducados_y_lo_que_se_recordaba_de_ellos(path):
+    persistence = SQLitePersistence(path, 60)
+    persistence.update_user_data(1, {"nombre": "Ane"})
+    persistence.update_user_data(2, {"nombre": "Jon"})
+    persistence._db.execute("UPDATE user_data SET updated = 0 WHERE user_id = 1")
+
+    persistence.expire()
+    assert set(persistence._written) == {2}
+    assert persistence.loadUserData(1) == {}
+    assert persistence.loadUserData(2) == {"nombre": "Jon"}
+
+
+def test_sweep_devuelve_los_olvidados():
+    reloj = [0.0]
+    store = UserDataStore(ttl=10, clock=lambda: reloj[0])
+    store[1]["nombre"] = "Ane"
+    store[2]
+    store.release(2)
+    reloj[0] = 5.0
+    store[3]["nombre"] = "Jon"
+
+    assert store.sweep(now=12.0) == [2, 1]
+    assert list(store) == [3]
+
+
+def test_conversacion_restaurada_caduca_sin_mensajes(path):
+    SQLitePersistence(path, 60).update_conversation(NOMBRE, (1, 1), 3)
+    persistence = SQLitePersistence(path, 60)
+    jobQueue = JobQueue()
+    dispatcher = Dispatcher(None, queue.Queue(), workers=1, job_queue=jobQueue, use_context=True,
+            persistence=persistence)
+    caducadas = []
+    handler = ExpiringConversationHandler(
+            entry_points=[CommandHandler("start", lambda update, context: 3)],
+            states={3: [MessageHandler(Filters.text, lambda update, context: 3)]},
+            fallbacks=[], conversation_timeout=60, name=NOMBRE, persistent=True,
+            onRestoredTimeout=caducadas.append)
+    dispatcher.add_handler(handler)
+
+    assert handler.restauradas == 1
+    assert handler.expire(time.monotonic() + 30) == 0
+    assert handler.expire(time.monotonic() + 61) == 1
+    assert caducadas == [(1, 1)]
+    assert persistence.storedConversations(NOMBRE) == []
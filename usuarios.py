@@ -0,0 +1,160 @@
+""" Datos de cada voluntario durante la conversación (context.user_data) en RespiraBot.
+En lugar de un dict por usuario que crece con cada clave y no se vacía nunca, cada usuario tiene un
+ConversationData con un campo fijo por cada clave posible (las de start() y las de flujo.FLUJO), y
+las cantidades se guardan como enteros. Se vacía al empezar y al terminar cada conversación.
+
+UserDataStore sustituye al user_data del Dispatcher: se queda como mucho con maxSize usuarios, olvida
+los que llevan más de ttl segundos sin escribir y los que han terminado su conversación. Con
+persistencia, un usuario olvidado se vuelve a cargar de SQLite si escribe otra vez.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from collections.abc import MutableMapping
+
+from flujo import FLUJO, MUNICIPIO_PENDIENTE, NUMERO
+
+# Claves que rellena start() y claves de cada paso de la conversación, en el orden del flujo
+CAMPOS = tuple(dict.fromkeys(("fecha_inicio", "nombre", "apellido", "user_id", "user_name") +
+        tuple(paso.clave for paso in FLUJO.values() if paso.clave) + (MUNICIPIO_PENDIENTE,)))
+
+# Respuestas de tipo NUMERO, que se guardan como int
+ENTEROS = frozenset(paso.clave for paso in FLUJO.values() if paso.tipo == NUMERO)
+
+_CAMPOS = frozenset(CAMPOS)
+
+
+class ConversationData(MutableMapping):
+    """ user_data de un usuario con un slot por clave de CAMPOS
+        - Se usa como un dict: get, [], in, pop, items...; una clave que no está en CAMPOS da KeyError
+        - Los campos de ENTEROS se convierten a int al guardarlos
+        - visto: última vez que se ha usado, para UserDataStore
+        Las claves se comprueban con los propios __slots__: una que no es un slot da AttributeError
+    """
+    __slots__ = CAMPOS + ("visto",)
+
+    def __init__(self, datos=None):
+        self.visto = 0.0
+        if datos:
+            for clave, valor in datos.items():
+                if clave in _CAMPOS:
+                    self[clave] = valor
+
+    def __getitem__(self, clave):
+        try:
+            return getattr(self, clave)
+        except AttributeError:
+            raise KeyError(clave) from None
+
+    def __setitem__(self, clave, valor):
+        if valor is not None and clave in ENTEROS:
+            valor = int(valor)
+        try:
+            setattr(self, clave, valor)
+        except AttributeError:
+            raise KeyError(clave) from None
+
+    def __delitem__(self, clave):
+        try:
+            delattr(self, clave)
+        except AttributeError:
+            raise KeyError(clave) from None
+
+    def __contains__(self, clave):
+        return hasattr(self, clave)
+
+    def __iter__(self):
+        return (clave for clave in CAMPOS if hasattr(self, clave))
+
+    def __len__(self):
+        return sum(1 for clave in CAMPOS if hasattr(self, clave))
+
+    def get(self, clave, defecto=None):
+        return getattr(self, clave, defecto)
+
+    def clear(self):
+        for clave in CAMPOS:
+            if hasattr(self, clave):
+                delattr(self, clave)
+
+    def __repr__(self):
+        return "ConversationData(%r)" % dict(self.items())
+
+
+class UserDataStore(defaultdict):
+    """ user_data del Dispatcher con un ConversationData por user_id y memoria acotada
+        - maxSize: con más usuarios se olvida el que lleva más tiempo sin escribir (LRU)
+        - ttl: sweep() olvida los que llevan más de ttl segundos sin escribir
+        - release(userId): la conversación ha terminado; se olvida en el siguiente sweep() si sigue vacío
+        - loader(userId): dict con los datos guardados de un usuario que no está en memoria (persistencia)
+        Cada acceso lo mueve al final, así el orden del dict es el de uso y lo más antiguo está al principio
+    """
+
+    def __init__(self, maxSize=100000, ttl=None, loader=None, clock=time.monotonic):
+        super().__init__(ConversationData)
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.loader = loader
+        self.clock = clock
+        self.evicted = 0
+        self.released = 0
+        self._liberar = set()
+        self._lock = threading.Lock()
+
+    def __missing__(self, userId):
+        datos = self.loader(userId) if self.loader is not None else None
+        registro = ConversationData(datos)
+        with self._lock:
+            dict.__setitem__(self, userId, registro)
+            while self.maxSize and len(self) > self.maxSize:
+                dict.pop(self, next(iter(self)))
+                self.evicted += 1
+        return registro
+
+    def __getitem__(self, userId):
+        with self._lock:
+            registro = dict.pop(self, userId, None)
+            if registro is not None:
+                dict.__setitem__(self, userId, registro)
+        if registro is None:
+            registro = self.__missing__(userId)
+        registro.visto = self.clock()
+        return registro
+
+    def release(self, userId):
+        with self._lock:
+            self._liberar.add(userId)
+
+    def sweep(self, now=None):
+        """ Olvida los usuarios liberados que siguen vacíos y los que llevan más de ttl sin escribir.
+            Devuelve la lista de user_id olvidados
+        """
+        now = self.clock() if now is None else now
+        olvidados = []
+        with self._lock:
+            liberar, self._liberar = self._liberar, set()
+            for userId in liberar:
+                registro = dict.get(self, userId)
+                if registro is not None and not len(registro):
+                    dict.pop(self, userId)
+                    self.released += 1
+                    olvidados.append(userId)
+            if self.ttl:
+                limite = now - self.ttl
+                while len(self):
+                    userId = next(iter(self))
+                    if dict.__getitem__(self, userId).visto >= limite:
+                        break
+                    dict.pop(self, userId)
+                    self.evicted += 1
+                    olvidados.append(userId)
+            # Un dict no devuelve la memoria de lo borrado: si se ha olvidado más de lo que queda, se rehace
+            if len(olvidados) > len(self):
+                quedan = list(dict.items(self))
+                dict.clear(self)
+                dict.update(self, quedan)
+        return olvidados
+
+    def stats(self):
+        return {"users": len(self), "evicted": self.evicted, "released": self.released}
@@ -0,0 +1,149 @@
+""" Modo webhook de RespiraBot.
+En lugar de preguntar a Telegram por los mensajes nuevos (polling), Telegram envía cada update con un
+POST a un servidor HTTP local que lo mete en la cola del dispatcher. Así se evita la latencia del polling
+y el bot puede ir detrás de un proxy o balanceador.
+
+Se puede probar sin conexión enviando un update grabado:
+    curl -X POST -H "X-Telegram-Bot-Api-Secret-Token: <secret_token>" -d @update.json http://127.0.0.1:8443/<url_path>
+"""
+
+import hmac
+import json
+import logging
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+logger = logging.getLogger("respirabot.webhook")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Tamaño máximo de un POST. Un update de Telegram ocupa unos pocos KB
+MAX_BODY = 1024 * 1024
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """ Servidor HTTP que recibe los updates de Telegram y los encola en el dispatcher
+        - urlPath: ruta en la que se aceptan los POST
+        - secretToken: si se indica, los POST tienen que traerlo en la cabecera SECRET_HEADER
+        - queueSize: con más updates que estos esperando se responde 503 y Telegram lo reintenta
+    """
+
+    daemon_threads = True
+
+    def __init__(self, dispatcher, listen, port, urlPath, secretToken=None, queueSize=1000):
+        super().__init__((listen, port), _WebhookHandler)
+        self.dispatcher = dispatcher
+        self.urlPath = "/" + urlPath.strip("/")
+        self.secretToken = secretToken or None
+        self.queueSize = queueSize
+
+        self.received = 0
+        self.rejected = 0
+
+    def accept(self, data):
+        """ Convierte el JSON en Update y lo encola. Devuelve False si la cola está llena """
+        if self.dispatcher.update_queue.qsize() >= self.queueSize:
+            self.rejected += 1
+            return False
+        update = Update.de_json(data, self.dispatcher.bot)
+        self.dispatcher.update_queue.put(update)
+        self.received += 1
+        return True
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    server_version = "RespiraBot"
+
+    def do_POST(self):
+        server = self.server
+        if self.path.split("?")[0].rstrip("/") != server.urlPath:
+            return self._reply(404)
+        if server.secretToken and not hmac.compare_digest(self.headers.get(SECRET_HEADER, ""), server.secretToken):
+            logger.warning("Webhook: POST rechazado de %s, secret token incorrecto", self.client_address[0])
+            return self._reply(403)
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            return self._reply(400)
+        if length > MAX_BODY:
+            logger.warning("Webhook: POST de %s bytes rechazado de %s", length, self.client_address[0])
+            self.close_connection = True
+            return self._reply(413)
+        try:
+            data = json.loads(self.rfile.read(max(length, 0)).decode("utf8"))
+        except (ValueError, UnicodeDecodeError):
+            return self._reply(400)
+        if not isinstance(data, dict):
+            return self._reply(400)
+
+        try:
+            aceptado = server.accept(data)
+        except Exception as e:
+            logger.warning("Webhook: update no válido de %s: %r", self.client_address[0], e)
+            return self._reply(400)
+        if not aceptado:
+            logger.warning("Webhook: cola del dispatcher llena (%s), update rechazado", server.queueSize)
+            return self._reply(503)
+        return self._reply(200)
+
+    def _reply(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug("Webhook %s - %s", self.client_address[0], format % args)
+
+
+class WebhookRunner:
+    """ Arranca el dispatcher, la job queue y el WebhookServer de un Updater, y los para con Ctrl+C
+        Hace lo mismo que updater.start_polling() + updater.idle() pero recibiendo por webhook
+    """
+
+    def __init__(self, updater, server, publicUrl=None):
+        self.updater = updater
+        self.server = server
+        self.publicUrl = publicUrl
+        self._threads = []
+        self._stopEvent = threading.Event()
+
+    def start(self):
+        dispatcher = self.updater.dispatcher
+        self.updater.job_queue.start()
+        for target, name in ((dispatcher.start, "dispatcher"), (self.server.serve_forever, "webhook")):
+            t = threading.Thread(target=target, name=name, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+        if self.publicUrl:
+            # Le dice a Telegram dónde tiene que enviar los updates
+            url = self.publicUrl.rstrip("/") + self.server.urlPath
+            kwargs = {"secret_token": self.server.secretToken} if self.server.secretToken else None
+            self.updater.bot.set_webhook(url=url, api_kwargs=kwargs)
+            logger.info("Webhook registrado en Telegram: %s", url)
+
+        host, port = self.server.server_address[:2]
+        logger.info("Webhook escuchando en http://%s:%s%s", host, port, self.server.urlPath)
+
+    def idle(self, stop_signals=(signal.SIGINT, signal.SIGTERM)):
+        """ Espera hasta recibir una de las señales y para todo """
+        for sig in stop_signals:
+            signal.signal(sig, lambda signum, frame: self._stopEvent.set())
+        while not self._stopEvent.wait(1):
+            pass
+        self.stop()
+
+    def stop(self):
+        logger.info("Parando webhook. %s updates recibidos, %s rechazados", self.server.received, self.server.rejected)
+        self.server.shutdown()
+        self.server.server_close()
+        self.updater.job_queue.stop()
+        self.updater.dispatcher.stop()
+        for t in self._threads:
+            t.join()
+        if self.updater.persistence:
+            self.updater.dispatcher.update_persistence()
+            self.updater.persistence.flush()